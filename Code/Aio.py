@@ -0,0 +1,349 @@
+"""asyncio serving mode.
+
+Selected with `"server_mode": "asyncio"`. One event loop owns every client,
+upstream and tunnel socket, so a slow client or a long CONNECT tunnel costs
+a coroutine instead of a pool thread. Request semantics are the threaded
+server's: the same parsing, filtering, cacheability and log rows. Each
+connection carries one request (responses say `Connection: close`); there
+is no client keep-alive in this mode.
+Only the blocking SQLite, cache lookup and resolver calls are pushed to the
+loop's executor; teeing a response into a cache fill is a buffered write and
+runs inline, since the default executor has only a few threads to share.
+"""
+import asyncio
+import functools
+import logging
+import time
+
+import filtering
+import logs
+import metrics
+import parse
+import server
+
+
+async def read_request(reader):
+    """Async twin of server.recv_request_head: the header block only; the
+    body is streamed by request_body(). The header size cap is the
+    StreamReader limit.
+    """
+    try:
+        buf = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        buf = e.partial
+    except asyncio.LimitOverrunError:
+        raise ValueError("Request header too large")
+
+    head = buf[:-4] if buf.endswith(b"\r\n\r\n") else buf
+    if not head:
+        return b"", []
+    return head, parse.parse_headers(head)
+
+
+async def request_body(reader, framing, length, max_body, timeout):
+    """Async twin of server.RequestBody: yield the body as it arrives, in
+    wire form (chunked framing followed, not decoded). A body cut short by
+    the client raises ConnectionError.
+    """
+    scanner = parse.ChunkedScanner() if framing == "chunked" else None
+    size = 0
+    while framing != "none":
+        want = server.BUFSIZE if scanner else min(server.BUFSIZE, length - size)
+        data = await asyncio.wait_for(reader.read(want), timeout)
+        if not data:
+            raise ConnectionError("Client closed the connection mid-body")
+        used = scanner.feed(data) if scanner else len(data)
+        size += used
+        if max_body and size > max_body:
+            raise ValueError("Request body too large")
+        yield data[:used]
+        if (scanner.done if scanner else size >= length):
+            return
+
+
+async def read_response_head(reader):
+    """The origin's final response head (interim 1xx responses skipped),
+    without its terminating blank line.
+    """
+    while True:
+        try:
+            buf = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Origin closed before the response head")
+        except asyncio.LimitOverrunError:
+            raise ValueError("Response header too large")
+        head = buf[:-4]
+        if not 100 <= (parse.parse_response_status(head) or 0) < 200:
+            return head
+
+
+async def _pipe(src, dst, timeout, activity):
+    """Copy one direction of a tunnel until EOF, then half-close `dst` so
+    the other direction can still finish. `activity` holds when either
+    direction last moved bytes; an idle tunnel raises asyncio.TimeoutError
+    once neither has for `timeout` seconds.
+    """
+    while True:
+        wait = activity[0] + timeout - time.monotonic()
+        try:
+            data = await asyncio.wait_for(src.read(server.BUFSIZE), max(0, wait))
+        except asyncio.TimeoutError:
+            if time.monotonic() - activity[0] < timeout:
+                continue                    # the other direction is busy
+            raise
+        if not data:
+            if dst.can_write_eof():
+                dst.write_eof()
+            return
+        activity[0] = time.monotonic()
+        dst.write(data)
+        await dst.drain()
+
+
+async def open_upstream(host, port, timeout, dns=None):
+    """Connect to an origin. With a resolver, the (cached) lookup and the
+    parallel connect run on an executor thread and the socket is then
+    handed to the loop.
+    """
+    start = time.perf_counter()
+    if dns is None:
+        streams = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                         timeout)
+    else:
+        sock = await asyncio.to_thread(dns.connect, host, port, timeout)
+        streams = await asyncio.open_connection(sock=sock)
+    metrics.UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - start)
+    return streams
+
+
+async def tunnel(reader, writer, host, port, timeout, dns=None, started=None):
+    """Relay bytes both ways for a CONNECT (HTTPS) tunnel until both sides
+    have finished, one fails, or neither sent anything for `timeout`
+    seconds. `started` (perf_counter) times the handshake for the
+    request-duration metric.
+    """
+    try:
+        up_reader, up_writer = await open_upstream(host, port, timeout, dns)
+        writer.write(server.TUNNEL_ESTABLISHED)
+        await writer.drain()
+    finally:
+        if started is not None:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
+    activity = [time.monotonic()]
+    pipes = [asyncio.ensure_future(_pipe(reader, up_writer, timeout, activity)),
+             asyncio.ensure_future(_pipe(up_reader, writer, timeout, activity))]
+    try:
+        done, _ = await asyncio.wait(pipes, return_when=asyncio.FIRST_EXCEPTION)
+        for pipe in done:
+            error = pipe.exception()
+            if error is not None and not isinstance(
+                    error, (asyncio.TimeoutError, OSError)):   # idle or reset: close
+                raise error
+    finally:
+        for pipe in pipes:
+            pipe.cancel()
+        up_writer.close()
+
+
+async def send_hit(writer, hit, method, req_headers):
+    """Async twin of server.send_hit, Range handling included."""
+    ranges = server.plan_ranges(hit, method, req_headers)
+    status = hit.status if ranges is None else (206 if ranges else 416)
+    if ranges is None:
+        head = parse.with_connection(hit.head)
+        parts, trailer = [(b"", 0, hit.length)], b""
+    else:
+        head, parts, trailer = server.range_parts(hit, ranges, "close")
+    writer.write(head)
+    sent = len(head)
+    for prefix, start, length in parts:
+        writer.write(prefix)
+        if hit.file is not None:
+            await asyncio.get_running_loop().sendfile(
+                writer.transport, hit.file, hit.offset + start, length)
+        else:
+            writer.write(hit.body[start:start + length])
+        sent += len(prefix) + length
+    writer.write(trailer)
+    await writer.drain()
+    return status, sent + len(trailer)
+
+
+async def serve_http(writer, host, port, method, path, headers, forward,
+                     request_id, cfg, cache, keys, compressor=None, dns=None,
+                     body=None):
+    """Plain HTTP request: try cache, else fetch + stream + maybe store.
+    A request `body` (see request_body) is streamed upstream after the head
+    and bypasses the cache.
+    """
+    cacheable_request = method.upper() == "GET" and body is None
+    primary, rewritten = keys.primary(method, host, port, path)
+    key = keys.lookup(primary, headers)
+
+    if cacheable_request:
+        hit = await asyncio.to_thread(cache.open, key)
+        if hit is not None:
+            keys.record_hit(rewritten)
+            if compressor is not None:
+                hit = await asyncio.to_thread(compressor.select, hit, key, headers)
+            try:
+                status, sent = await send_hit(writer, hit, method, headers)
+            finally:
+                hit.close()
+            await asyncio.to_thread(server.record_hit, request_id, status,
+                                    hit.ctype, sent, hit.tier)
+            metrics.record_response(method, "HIT", status, sent)
+            return
+
+    timeout = cfg["upstream_timeout"]
+    start = time.time()
+    capture = server.ResponseCapture(
+        cache, key, cacheable_request, cfg,
+        functools.partial(keys.for_response, primary, headers))
+
+    up_reader, up_writer = await open_upstream(host, port, timeout, dns)
+    try:
+        up_writer.write(forward)
+        await up_writer.drain()
+        if body is not None:
+            async for chunk in body:
+                metrics.RECEIVED_BYTES.inc(amount=len(chunk))
+                up_writer.write(chunk)
+                await up_writer.drain()
+        sent = time.perf_counter()
+        head = await asyncio.wait_for(read_response_head(up_reader), timeout)
+        metrics.UPSTREAM_FIRST_BYTE_SECONDS.observe(time.perf_counter() - sent)
+        framing, length = parse.body_framing(
+            method, parse.parse_response_status(head), parse.parse_headers(head))
+        head = parse.rebuild_response_head(head)
+        writer.write(head)
+        capture.feed(head)
+        # Only a body that reached its framing's end may be stored.
+        scanner = parse.ChunkedScanner() if framing == "chunked" else None
+        remaining = length if framing == "length" else None
+        complete = remaining == 0 if remaining is not None else framing == "none"
+        while not complete:
+            want = server.BUFSIZE if remaining is None else min(server.BUFSIZE,
+                                                                remaining)
+            chunk = await asyncio.wait_for(up_reader.read(want), timeout)
+            if not chunk:
+                complete = framing == "close"
+                break
+            if scanner is not None:
+                chunk = chunk[:scanner.feed(chunk)]
+                complete = scanner.done
+            elif remaining is not None:
+                remaining -= len(chunk)
+                complete = remaining == 0
+            writer.write(chunk)               # stream straight through
+            await writer.drain()
+            capture.feed(chunk)               # a buffered write: no thread hop
+    except BaseException:
+        capture.abort()
+        raise
+    finally:
+        up_writer.close()
+
+    await asyncio.to_thread(capture.finish, request_id,
+                            (time.time() - start) * 1000, complete)
+    metrics.record_response(method, "MISS", capture.status, capture.total)
+    server.queue_compression(compressor, capture)
+
+
+async def handle_client(reader, writer, cfg, cache, keys, compressor=None,
+                        dns=None):
+    client_ip, client_port = writer.get_extra_info("peername")[:2]
+    request_id = None
+    started = None
+    try:
+        head, headers = await asyncio.wait_for(
+            read_request(reader), cfg["client_timeout"])
+        if not head:
+            return
+        started = time.perf_counter()
+        metrics.RECEIVED_BYTES.inc(amount=len(head) + 4)
+
+        method, target, version = parse.parse_request_line(head)
+        host, port, path = parse.resolve_target(method, target, headers)
+        logging.info("%s:%s -> %s %s:%s", client_ip, client_port, method, host, port)
+
+        request_id = await asyncio.to_thread(
+            logs.log_request, client_ip, client_port, host, port,
+            method, target, version)
+
+        allowed = await asyncio.to_thread(
+            filtering.is_allowed, host, cfg["filter_mode"])
+        if not allowed:
+            writer.write(filtering.forbidden_response())
+            await writer.drain()
+            await asyncio.to_thread(
+                logs.log_response, request_id, "MISS", 403, "text/html", 0, 0)
+            await asyncio.to_thread(logs.update_request_status, request_id, 403)
+            metrics.record_response(method, None, 403,
+                                    len(filtering.forbidden_response()))
+            return
+
+        if method.upper() == "CONNECT":
+            # The request ends at the 200, not when the tunnel closes.
+            connect_started, started = started, None
+            await tunnel(reader, writer, host, port, cfg["upstream_timeout"],
+                         dns, connect_started)
+            metrics.record_response(method, None, 200,
+                                    len(server.TUNNEL_ESTABLISHED))
+            await asyncio.to_thread(logs.update_request_status, request_id, 200)
+            return
+
+        framing, length = parse.request_body_framing(headers)
+        max_body = cfg["max_body_bytes"]
+        if max_body and (length or 0) > max_body:
+            raise ValueError("Request body too large")
+        body = None
+        if framing != "none":
+            if parse.expects_continue(headers):
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                headers = [(k, v) for k, v in headers if k.lower() != "expect"]
+            body = request_body(reader, framing, length, max_body,
+                                cfg["client_timeout"])
+        forward = parse.build_forward_request(
+            method, path, version, headers, b"", host, port,
+            chunked=framing == "chunked")
+        await serve_http(writer, host, port, method, path, headers, forward,
+                         request_id, cfg, cache, keys, compressor, dns, body)
+
+    except Exception as e:  # noqa: BLE001 - log and keep the server alive
+        logging.warning("Error handling %s:%s -> %s", client_ip, client_port, e)
+        if request_id is None:
+            await asyncio.to_thread(
+                logs.log_request, client_ip, client_port, "unknown", 0,
+                "unknown", "unknown", "unknown", error_message=str(e))
+    finally:
+        if started is not None:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
+        writer.close()
+
+
+async def _serve(cfg, cache, keys, compressor, dns):
+    srv = await asyncio.start_server(
+        lambda r, w: handle_client(r, w, cfg, cache, keys, compressor, dns),
+        cfg["listen_host"], cfg["listen_port"],
+        limit=cfg["max_header_bytes"], backlog=128,
+        reuse_port=cfg["workers"] > 1 or None)
+    logging.info("Proxy listening on %s:%s  (mode=asyncio, filter=%s, cache=%s)",
+                 cfg["listen_host"], cfg["listen_port"],
+                 cfg["filter_mode"], cfg["cache"]["backend"])
+    async with srv:
+        await srv.serve_forever()
+
+
+def run(cfg, cache, keys, compressor=None, dns=None):
+    """Serve forever on one event loop; Ctrl+C shuts down cleanly."""
+    try:
+        asyncio.run(_serve(cfg, cache, keys, compressor, dns))
+    except KeyboardInterrupt:
+        logging.info("Shutting down.")
+    finally:
+        keys.log_stats()
+        if dns is not None:
+            dns.log_stats()
+        if compressor is not None:
+            compressor.shutdown()
@@ -0,0 +1,55 @@
+"""MemoryCache micro-benchmark: lookup throughput vs. worker threads.
+
+Usage:  python benchcache.py
+Each worker does random gets (about 90% hits) against a warm cache for a
+fixed time. Compare the single-lock layout (shards=1) with the striped one
+to see how contention changes as workers are added.
+"""
+import random
+import threading
+import time
+
+import cache as cachelib
+
+KEYS = 2000
+VALUE = b"x" * 2048
+DURATION = 1.0          # seconds per run
+WORKERS = (1, 2, 4, 8, 16, 32)
+SHARDS = (1, 16)
+
+
+def run(mem, workers):
+    stop = time.perf_counter() + DURATION
+    counts = [0] * workers
+
+    def worker(slot):
+        rnd = random.Random(slot)
+        get = mem.get
+        n = 0
+        while time.perf_counter() < stop:
+            for _ in range(100):
+                get(f"k{rnd.randrange(KEYS * 10 // 9)}")
+            n += 100
+        counts[slot] = n
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / DURATION
+
+
+def main():
+    print(f"{'shards':>6} {'workers':>7} {'gets/s':>12}")
+    for shards in SHARDS:
+        mem = cachelib.MemoryCache(KEYS, max_bytes=KEYS * len(VALUE) * 2,
+                                   shards=shards)
+        for i in range(KEYS):
+            mem.put(f"k{i}", VALUE, 3600)
+        for workers in WORKERS:
+            print(f"{shards:>6} {workers:>7} {run(mem, workers):>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""End-to-end load test: a local origin, the proxy, and concurrent clients.
+
+Usage:  python benchload.py [--backends memory,file] [--workloads hit,miss]
+                            [--size 16384] [--latency 0.005] [--max-age 3600]
+                            [--concurrency 16] [--duration 5] [--mode threads]
+                            [--workers 1]
+
+Everything runs on 127.0.0.1, so no network access is needed. For each
+cache backend the script starts a stand-in origin (object size, response
+delay and Cache-Control max-age taken from the options), starts
+`server.main` in a subprocess with a scratch config, database and cache
+directory, and then drives each workload for `--duration` seconds:
+
+    hit       GETs for a small set of warmed URLs, over keep-alive
+    miss      GETs for a fresh URL every time, over keep-alive
+    connect   CONNECT to the origin, one GET through the tunnel, close
+    filtered  GET for a blacklisted host (403 from the proxy), close
+
+and prints requests/s and p50/p95/p99 latency per workload. Run it before
+and after a change, on the same machine, to spot regressions.
+"""
+import argparse
+import copy
+import http.server
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import config
+import filtering
+import logs
+import parse
+
+WORKLOADS = ("hit", "miss", "connect", "filtered")
+HOT_OBJECTS = 32            # distinct URLs the hit workload cycles through
+BLOCKED_HOST = "blocked.bench.invalid"
+START_TIMEOUT = 10          # seconds to wait for the proxy to listen
+MAX_HEADER = 64 * 1024
+
+
+class _OriginHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `size` bytes for any path after `latency` seconds."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True      # head and body are separate writes
+
+    def do_GET(self):
+        opts = self.server.opts
+        if opts.latency:
+            time.sleep(opts.latency)
+        body = self.server.payload
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", f"max-age={opts.max_age}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128    # the default 5 drops SYNs under load
+
+    def __init__(self, opts):
+        super().__init__(("127.0.0.1", 0), _OriginHandler)
+        self.opts = opts
+        self.payload = os.urandom(opts.size)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Proxy:
+    """`server.main` in a child process, in its own scratch directory."""
+
+    def __init__(self, opts, backend):
+        self.dir = tempfile.mkdtemp(prefix="benchload-")
+        self.port = _free_port()
+        cfg = copy.deepcopy(config.DEFAULTS)
+        cfg.update(listen_port=self.port, server_mode=opts.mode,
+                   workers=opts.workers,
+                   max_workers=max(50, opts.concurrency * 2),
+                   filter_mode="blacklist",
+                   db_name=os.path.join(self.dir, "logs.db"))
+        cfg["cache"].update(backend=backend,
+                            dir=os.path.join(self.dir, "cache_files"),
+                            shm_path=os.path.join(self.dir, "shared.cache"),
+                            max_entries=100000, l1_max_entries=100000)
+        cfg["metrics"].update(listen_port=_free_port())
+        self.cfg = cfg
+        self.proc = None
+
+    def start(self):
+        logs.configure(self.cfg["db_name"])
+        logs.init_db()
+        filtering.add_to_filter_list(BLOCKED_HOST, "blacklist")
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=here)
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c",
+             "import json, sys, server; server.main(json.loads(sys.argv[1]))",
+             json.dumps(self.cfg)],
+            cwd=self.dir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError("proxy exited during startup")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("proxy did not start listening")
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Connection:
+    """A client socket that reads whole responses (length, chunked or
+    close-delimited) and keeps bytes that arrive past one.
+    """
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), 10)
+        self.buf = b""
+        self.open = True
+
+    def request(self, data, method="GET"):
+        """Send `data` and read the response; returns its status."""
+        self.sock.sendall(data)
+        return self.response(method)
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            self.open = False
+        return data
+
+    def response(self, method="GET"):
+        head = parse.HeadParser(MAX_HEADER, self.buf)
+        while not head.complete:
+            data = self._recv()
+            if not data:
+                raise ConnectionError("connection closed before response")
+            head.feed(data)
+        status = parse.parse_response_status(head.head)
+        framing, length = parse.body_framing(method, status, head.headers)
+        if method == "CONNECT" and status == 200:
+            framing, length = "none", 0
+        rest = bytes(head.rest)
+        if framing == "length":
+            while len(rest) < length:
+                data = self._recv()
+                if not data:
+                    raise ConnectionError("short response body")
+                rest += data
+            self.buf = rest[length:]
+        elif framing == "chunked":
+            scanner = parse.ChunkedScanner()
+            used = scanner.feed(rest)
+            while not scanner.done:
+                rest = self._recv()
+                if not rest:
+                    raise ConnectionError("short chunked body")
+                used = scanner.feed(rest)
+            self.buf = rest[used:]
+        elif framing == "close":
+            while self._recv():
+                pass
+            self.buf = b""
+        else:
+            self.buf = rest
+        if parse.get_header(head.headers, "connection", "").lower() == "close":
+            self.open = False
+        return status
+
+    def close(self):
+        self.sock.close()
+
+
+def _get(target, host):
+    return (f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n").encode("ascii")
+
+
+class Workload:
+    """One kind of request. `run(conn, n)` does request number `n`, on
+    `conn` if the workload reuses connections, and returns (status, the
+    connection to reuse or None).
+    """
+
+    expected = 200
+
+    def __init__(self, proxy_port, origin_port):
+        self.proxy_port = proxy_port
+        self.origin = f"127.0.0.1:{origin_port}"
+
+    def get(self, conn, url):
+        """GET `url` over `conn` if it is still usable. Like a browser, a
+        request that fails on a reused connection is retried once on a new
+        one: the proxy may have closed it after `max_keepalive_requests`.
+        """
+        request = _get(url, self.origin)
+        if conn is not None and conn.open:
+            try:
+                return conn.request(request), conn
+            except OSError:
+                pass
+        if conn is not None:
+            conn.close()
+        conn = Connection(self.proxy_port)
+        return conn.request(request), conn
+
+    def warm(self):
+        pass
+
+
+class HitWorkload(Workload):
+    def url(self, n):
+        return f"http://{self.origin}/hot/{n % HOT_OBJECTS}"
+
+    def warm(self):
+        conn = None
+        for n in range(HOT_OBJECTS):
+            _, conn = self.get(conn, self.url(n))
+        conn.close()
+
+    def run(self, conn, n):
+        return self.get(conn, self.url(n))
+
+
+class MissWorkload(Workload):
+    def __init__(self, proxy_port, origin_port):
+        super().__init__(proxy_port, origin_port)
+        self.prefix = f"/miss/{os.getpid()}-{time.monotonic_ns()}"
+
+    def run(self, conn, n):
+        return self.get(
+            conn, f"http://{self.origin}{self.prefix}/{threading.get_ident()}-{n}")
+
+
+class ConnectWorkload(Workload):
+    def run(self, conn, n):
+        conn = Connection(self.proxy_port)
+        try:
+            request = (f"CONNECT {self.origin} HTTP/1.1\r\n"
+                       f"Host: {self.origin}\r\n\r\n").encode("ascii")
+            status = conn.request(request, "CONNECT")
+            if status == 200:
+                status = conn.request(_get(f"/tunnel/{n}", self.origin))
+        finally:
+            conn.close()
+        return status, None
+
+
+class FilteredWorkload(Workload):
+    expected = 403
+
+    def run(self, conn, n):
+        conn = Connection(self.proxy_port)
+        try:
+            return conn.request(
+                _get(f"http://{BLOCKED_HOST}/", BLOCKED_HOST)), None
+        finally:
+            conn.close()
+
+
+WORKLOAD_TYPES = {"hit": HitWorkload, "miss": MissWorkload,
+                  "connect": ConnectWorkload, "filtered": FilteredWorkload}
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def drive(workload, concurrency, duration):
+    """Run `workload` from `concurrency` threads for `duration` seconds.
+    Returns (latencies in seconds, error count, elapsed seconds).
+    """
+    workload.warm()
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start = time.perf_counter()
+    stop = start + duration
+
+    def worker(slot):
+        conn = None
+        n = slot
+        times = latencies[slot]
+        while time.perf_counter() < stop:
+            t0 = time.perf_counter()
+            try:
+                status, conn = workload.run(conn, n)
+            except OSError:
+                status, conn = None, None
+            times.append(time.perf_counter() - t0)
+            if status != workload.expected:
+                errors[slot] += 1
+            n += concurrency
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return sorted(x for times in latencies for x in times), sum(errors), elapsed
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    p.add_argument("--backends", default="memory,file",
+                   help="comma-separated cache backends to compare")
+    p.add_argument("--workloads", default=",".join(WORKLOADS))
+    p.add_argument("--size", type=int, default=16 * 1024,
+                   help="origin object size in bytes")
+    p.add_argument("--latency", type=float, default=0.005,
+                   help="origin response delay in seconds")
+    p.add_argument("--max-age", type=int, default=3600,
+                   help="Cache-Control max-age sent by the origin")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--duration", type=float, default=5.0,
+                   help="seconds per workload")
+    p.add_argument("--mode", default="threads", choices=("threads", "asyncio"))
+    p.add_argument("--workers", type=int, default=1,
+                   help="proxy processes (pre-fork when > 1)")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    origin = Origin(opts)
+    origin.start()
+    print(f"origin: {opts.size} B objects, {opts.latency * 1000:g} ms latency, "
+          f"max-age={opts.max_age}; {opts.concurrency} clients, "
+          f"{opts.duration:g} s per workload, {opts.mode} mode, "
+          f"{opts.workers} worker process(es)")
+    print(f"{'backend':<8} {'workload':<9} {'requests':>9} {'errors':>7} "
+          f"{'req/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    try:
+        for backend in opts.backends.split(","):
+            proxy = Proxy(opts, backend)
+            proxy.start()
+            try:
+                for name in opts.workloads.split(","):
+                    workload = WORKLOAD_TYPES[name](proxy.port, origin.port)
+                    lat, errors, elapsed = drive(workload, opts.concurrency,
+                                                 opts.duration)
+                    print(f"{backend:<8} {name:<9} {len(lat):>9} {errors:>7} "
+                          f"{len(lat) / elapsed:>10,.0f} "
+                          f"{percentile(lat, 50) * 1000:>8.2f} "
+                          f"{percentile(lat, 95) * 1000:>8.2f} "
+                          f"{percentile(lat, 99) * 1000:>8.2f}")
+            finally:
+                proxy.stop()
+    finally:
+        origin.stop()
+
+
+if __name__ == "__main__":
+    main()
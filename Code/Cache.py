@@ -1,104 +1,620 @@
-"""Response cache with two interchangeable backends.
+"""Response cache with interchangeable backends: memory, file, both
+tiered (memory in front of file), or shared (one memory-mapped RAM cache
+for all processes on the host). The file tier keeps one file per entry
+(FileCache) or appends entries to large segment files (SegmentCache).
 
 Replaces the old duplicated Cache.py / dictionaryCache.py. Storage only --
 the decision of *what* is cacheable lives in the server, so HTTP semantics
-are respected in one place. Both backends are thread-safe, expire by TTL,
+are respected in one place. All backends are thread-safe, expire by TTL,
 and evict least-recently-used entries past a configured limit.
+`lookup(key)` also reports which tier served a hit, for the logs.
+
+Entries are records (see EntryInfo): the status, content type, framing and
+validators of a response are parsed once when it is stored, so a hit is
+sent and logged without touching its headers again. Keys are 32-byte
+SHA-256 digests; FileCache spells them in hex only for file names.
+
+Fills are streamed: `writer(key, ttl)` returns an object that takes the
+response chunk by chunk as it is relayed, and is then either committed or
+discarded once the server knows the whole response was cacheable.
 """
+import contextlib
 import hashlib
+import logging
+import mmap
 import os
+import struct
+import tempfile
 import threading
 import time
+import zlib
 from collections import OrderedDict
 
+try:
+    import fcntl
+except ImportError:         # not POSIX: no SharedCache
+    fcntl = None
+
+import metrics
+import parse
+
+TMP_PREFIX = ".fill-"   # in-progress FileCache fills; never read or evicted
+STALE_FILL_SECONDS = 3600
+SWEEP_FRACTION = 10     # shared FileCache: sweep after max_entries/10 fills
+TOUCH_SECONDS = 60      # shared FileCache: bump a hit file's mtime this often
+SPOOL_BYTES = 256 * 1024  # SegmentCache fills held in RAM up to this, then on disk
+COPY_BYTES = 1024 * 1024  # spool -> segment copy size
+
 
 def make_key(method, host, port, path):
     """Stable key based on the request identity, not the full header blob,
     so different clients can share cache entries.
     """
-    raw = f"{method.upper()} {host}:{port}{path}".encode("utf-8")
-    return hashlib.sha256(raw).hexdigest()
+    raw = f"{method.upper()} {host.lower()}:{port}{path}".encode("utf-8")
+    return hashlib.sha256(raw).digest()
+
+
+class EntryInfo:
+    """What a hit needs to know about a stored response, parsed from its
+    header block once, when the entry is stored (or indexed at startup).
+    `framing` is parse.body_framing's kind for a GET.
+    """
+
+    __slots__ = ("status", "ctype", "framing", "etag", "last_modified",
+                 "expires")
+
+    def _describe(self, head, expires):
+        headers = parse.parse_headers(head)
+        self.status = parse.parse_response_status(head)
+        self.ctype = parse.get_header(headers, "content-type")
+        self.framing = parse.body_framing("GET", self.status, headers)[0]
+        self.etag, self.last_modified = parse.validators(headers)
+        self.expires = expires
+
+    def _copy(self, info):
+        self.status, self.ctype, self.framing = info.status, info.ctype, info.framing
+        self.etag, self.last_modified = info.etag, info.last_modified
+        self.expires = info.expires
+
+
+class Entry(EntryInfo):
+    """An in-memory entry: the stored bytes, split into the header block
+    (without its blank line) and a view of the body, plus its EntryInfo.
+    """
+
+    __slots__ = ("head", "body")
+
+    def __init__(self, value, expires):
+        end = value.find(b"\r\n\r\n")
+        if end < 0:
+            self.head, self.body = b"", memoryview(value)
+        else:
+            self.head, self.body = value[:end], memoryview(value)[end + 4:]
+        self._describe(self.head, expires)
+
+    @property
+    def value(self):
+        """The bytes as stored, header block included (no copy)."""
+        return self.body.obj
+
+    @property
+    def size(self):
+        return len(self.body.obj)
+
+
+class _Shard:
+    """One independently locked LRU segment of a MemoryCache."""
+
+    __slots__ = ("lock", "store", "bytes", "max_entries", "max_bytes")
+
+    def __init__(self, max_entries, max_bytes):
+        self.lock = threading.Lock()
+        self.store = OrderedDict()  # key -> Entry
+        self.bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
 
 
 class MemoryCache:
-    def __init__(self, max_entries):
+    """LRU bounded by entry count *and* total payload bytes.
+
+    Keys are spread over `shards` segments, each with its own lock and an
+    equal share of both budgets, so concurrent hits on different keys don't
+    contend. LRU order (and eviction) is therefore per shard, and an object
+    larger than one shard's byte budget is not cached.
+    """
+
+    TIER = "memory"
+
+    def __init__(self, max_entries, max_bytes=None, shards=1):
+        self.on_evict = None        # called as on_evict(key, entry)
+        n = max(1, shards)
+        per_bytes = max_bytes // n if max_bytes else None
         self.max = max_entries
-        self._lock = threading.Lock()
-        self._store = OrderedDict()  # key -> (expires_at, value)
+        self.max_bytes = max_bytes
+        self._shards = [_Shard(max(1, max_entries // n), per_bytes)
+                        for _ in range(n)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def lookup(self, key):
+        """Return (value, tier name), or (None, None) on a miss."""
+        value = self.get(key)
+        return value, (self.TIER if value is not None else None)
+
+    def open(self, key, stale=False):
+        """Return a Hit, or None. With `stale`, expired entries are returned
+        too (check `Hit.expires`) so the server can revalidate them.
+        """
+        entry = self._entry(key, stale)
+        if entry is None:
+            return None
+        return Hit.from_entry(entry, self.TIER)
+
+    def peek(self, key):
+        """open() for the proxy's own readers (see compress.py): leaves the
+        entry's LRU position alone.
+        """
+        entry = self._entry(key, touch=False)
+        if entry is None:
+            return None
+        return Hit.from_entry(entry, self.TIER)
 
     def get(self, key):
-        with self._lock:
-            item = self._store.get(key)
-            if item is None:
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key, stale=False):
+        """Return (value, expires_at), or (None, None) on a miss."""
+        entry = self._entry(key, stale)
+        if entry is None:
+            return None, None
+        return entry.value, entry.expires
+
+    def _entry(self, key, stale=False, touch=True):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.store.get(key)
+            if entry is None:
                 return None
-            expires, value = item
-            if time.time() >= expires:
-                del self._store[key]
+            if not stale and time.time() >= entry.expires:
+                del shard.store[key]
+                shard.bytes -= entry.size
                 return None
-            self._store.move_to_end(key)
-            return value
+            if touch:
+                shard.store.move_to_end(key)
+            return entry
+
+    def refresh(self, key, ttl):
+        """Give an existing entry a new TTL (after a 304 Not Modified)."""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.store.get(key)
+            if entry is not None:
+                entry.expires = time.time() + ttl
 
     def put(self, key, value, ttl):
-        with self._lock:
-            self._store[key] = (time.time() + ttl, value)
-            self._store.move_to_end(key)
-            while len(self._store) > self.max:
-                self._store.popitem(last=False)
+        self.put_entry(key, Entry(value, time.time() + ttl))
+
+    def put_entry(self, key, entry):
+        shard = self._shard(key)
+        if shard.max_bytes is not None and entry.size > shard.max_bytes:
+            return
+        evicted = []
+        with shard.lock:
+            old = shard.store.pop(key, None)
+            if old is not None:
+                shard.bytes -= old.size
+            shard.store[key] = entry
+            shard.bytes += entry.size
+            while len(shard.store) > shard.max_entries or (
+                    shard.max_bytes is not None and shard.bytes > shard.max_bytes):
+                old_key, old_entry = shard.store.popitem(last=False)
+                shard.bytes -= old_entry.size
+                evicted.append((old_key, old_entry))
+        if evicted:
+            metrics.CACHE_EVICTIONS.inc(self.TIER, amount=len(evicted))
+        if self.on_evict is not None:
+            for item in evicted:
+                self.on_evict(*item)
+
+    def writer(self, key, ttl):
+        return _MemoryWriter(self, key, ttl)
 
     def clear(self):
-        with self._lock:
-            self._store.clear()
+        for shard in self._shards:
+            with shard.lock:
+                shard.store.clear()
+                shard.bytes = 0
+
+    def stats(self):
+        entries = sum(len(s.store) for s in self._shards)
+        return {"entries": entries, "bytes": sum(s.bytes for s in self._shards)}
+
+    def usage(self):
+        """{tier: stats()} for every storage tier (see metrics.watch_cache)."""
+        return {self.TIER: self.stats()}
+
+
+class _MemoryWriter:
+    """Collects chunks and joins them once on commit (a single copy)."""
+
+    def __init__(self, cache, key, ttl):
+        self.cache, self.key, self.ttl = cache, key, ttl
+        self._chunks = []
+
+    def write(self, chunk):
+        self._chunks.append(bytes(chunk))
+
+    def commit(self):
+        self.cache.put(self.key, b"".join(self._chunks), self.ttl)
+        self._chunks = []
+
+    def discard(self):
+        self._chunks = []
+
+
+class Hit(EntryInfo):
+    """A cache hit ready to send: the stored header block (without its blank
+    line) plus the body -- either in memory, or as a byte range of an open
+    file so the server can hand it to sendfile. Call close() when done.
+    The EntryInfo fields come from the entry; `headers` is parsed only if
+    asked for.
+    """
+
+    __slots__ = ("head", "body", "file", "offset", "length", "tier", "_headers")
+
+    def __init__(self, head, tier, body=None, file=None, offset=0, length=None,
+                 expires=None, info=None):
+        self.head = head
+        self.tier = tier
+        self.body = body
+        self.file = file
+        self.offset = offset
+        self.length = len(body) if length is None else length
+        self._headers = None
+        if info is None:
+            self._describe(head, expires)
+        else:
+            self._copy(info)
+
+    @classmethod
+    def from_entry(cls, entry, tier):
+        """A hit on an in-memory entry, sharing its bytes."""
+        return cls(entry.head, tier, body=entry.body, info=entry)
+
+    @classmethod
+    def from_bytes(cls, value, tier, expires=None):
+        """Split a stored response without copying its body."""
+        return cls.from_entry(Entry(value, expires), tier)
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = parse.parse_headers(self.head)
+        return self._headers
+
+    def add_header(self, name, value):
+        """Add a header to this hit's copy of the header block, keeping a
+        trailing Connection line last (see parse.with_connection).
+        """
+        line = f"{name}: {value}".encode("iso-8859-1")
+        cut = self.head.rfind(b"\r\n")
+        if self.head.startswith(b"Connection: ", cut + 2):
+            self.head = self.head[:cut] + b"\r\n" + line + self.head[cut:]
+        else:
+            self.head += b"\r\n" + line
+        self._headers = None
+
+    @property
+    def stale(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    @property
+    def size(self):
+        return len(self.head) + 4 + self.length
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def _head_length(data):
+    """Bytes up to and including the header terminator, or 0 if none."""
+    end = data.find(b"\r\n\r\n")
+    return end + 4 if end >= 0 else 0
+
+
+class _FileEntry(EntryInfo):
+    """FileCache index record: EntryInfo plus where things are in the file."""
+
+    __slots__ = ("size", "meta_len", "head_len", "ino")
+
+    def __init__(self, expires, size, meta_len, head_len, head, ino=0):
+        self.size = size
+        self.meta_len = meta_len
+        self.head_len = head_len
+        self.ino = ino              # identifies this fill of the file
+        self._describe(head, expires)
 
 
 class FileCache:
-    def __init__(self, directory, max_entries, max_object_bytes):
+    """One file per key, named by the key in hex: an ASCII expiry line,
+    then the raw response.
+
+    An in-memory index (key -> _FileEntry, in LRU order) is rebuilt once at
+    startup, so lookups, recency updates and eviction never scan the
+    directory. The lock only guards the index and
+    renames/removals; file reads happen outside it. Because the index knows
+    where each header block ends, `open()` can return the body as a file
+    range for a zero-copy sendfile.
+
+    With `shared`, other processes (pre-fork workers) fill and refresh the
+    same directory, so the index is only a hint: an opened file whose inode
+    or size differs from the index entry, or that the index lacks or thinks
+    expired, is re-read from disk (its expiry line and head) and the index
+    updated. Expired files are then left for the next fill to replace
+    rather than deleted, since another worker may have just refreshed them.
+    For the same reason a worker's index is capped at `max_entries` without
+    deleting anything; the limit is applied to the whole directory instead.
+    Every max_entries/SWEEP_FRACTION fills, a worker removes the files past
+    it with the oldest mtime. Hits bump the mtime (at most every
+    TOUCH_SECONDS), so that is least recently used across all workers.
+    """
+
+    TIER = "disk"
+
+    def __init__(self, directory, max_entries, max_object_bytes, max_header=65536,
+                 shared=False):
         self.dir = directory
         self.max = max_entries
         self.max_object_bytes = max_object_bytes
+        self.max_header = max_header
+        self.shared = shared
         self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> _FileEntry
+        self._fills = 0              # since the last sweep (shared mode)
         os.makedirs(directory, exist_ok=True)
+        self._load_index()
 
     def _path(self, key):
-        return os.path.join(self.dir, key)
+        return os.path.join(self.dir, key.hex())
 
-    def get(self, key):
-        path = self._path(key)
-        with self._lock:
+    def _load_index(self):
+        """Scan the directory once. Recency across restarts is approximated
+        by file mtime, i.e. when each entry was written.
+        """
+        now = time.time()
+        found = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
             try:
+                st = os.stat(path)
+                if name.startswith(TMP_PREFIX):
+                    if now - st.st_mtime > STALE_FILL_SECONDS:
+                        self._safe_remove(path)  # left behind by a crash
+                    continue
+                key = bytes.fromhex(name)
                 with open(path, "rb") as f:
-                    expires = float(f.readline().decode("ascii").strip())
-                    value = f.read()
-            except (FileNotFoundError, ValueError):
-                return None
-            if time.time() >= expires:
+                    item = self._read_entry(f, st)
+            except (OSError, ValueError):
                 self._safe_remove(path)
+                continue
+            found.append((st.st_mtime, key, item))
+        found.sort(key=lambda item: item[0])
+        for _, key, item in found:
+            self._index[key] = item
+        with self._lock:
+            self._evict()
+
+    def _read_entry(self, f, st):
+        """Index entry from an entry file opened at its start; raises
+        ValueError if the expiry line is garbled.
+        """
+        meta = f.readline()
+        expires = float(meta.decode("ascii").strip())
+        start = f.read(self.max_header + 4)
+        head_len = _head_length(start)
+        return _FileEntry(expires, st.st_size, len(meta), head_len,
+                          start[:max(0, head_len - 4)], st.st_ino)
+
+    def _checkout(self, key, stale=False):
+        """Index entry for `key` (marked most recent), or None. Expired
+        entries are deleted unless `stale` asks for them.
+        """
+        with self._lock:
+            item = self._index.get(key)
+            if item is None:
                 return None
-            os.utime(path, None)  # touch -> mtime tracks recency for LRU
-            return value
+            if not stale and time.time() >= item.expires:
+                del self._index[key]
+                self._safe_remove(self._path(key))
+                return None
+            self._index.move_to_end(key)
+            return item
+
+    def _forget(self, key, item):
+        """The file vanished behind our back (e.g. the dashboard's Clear
+        Cache): drop the index entry unless it has been replaced since.
+        """
+        with self._lock:
+            if self._index.get(key) is item:
+                del self._index[key]
+
+    def lookup(self, key):
+        """Return (value, tier name), or (None, None) on a miss."""
+        value = self.get(key)
+        return value, (self.TIER if value is not None else None)
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def _open(self, key, stale=False):
+        """Open the entry file for `key`: (file, index entry), or
+        (None, None) on a miss.
+        """
+        item = self._checkout(key, stale or self.shared)
+        if item is None and not self.shared:
+            return None, None
+        try:
+            f = open(self._path(key), "rb")
+        except FileNotFoundError:
+            if item is not None:
+                self._forget(key, item)
+            return None, None
+        if self.shared:
+            try:
+                item = self._revalidate(key, item, f, stale)
+            except (OSError, ValueError):
+                item = None
+            if item is None:
+                f.close()
+                return None, None
+        return f, item
+
+    def _revalidate(self, key, item, f, stale):
+        """Shared mode: check the index entry against the opened file and
+        re-read it if another worker has filled or refreshed the entry.
+        """
+        st = os.fstat(f.fileno())
+        if time.time() - st.st_mtime > TOUCH_SECONDS:
+            with contextlib.suppress(OSError):
+                os.utime(f.fileno())     # recency for _sweep
+        if (item is None or (st.st_ino, st.st_size) != (item.ino, item.size)
+                or (not stale and time.time() >= item.expires)):
+            fresh = self._read_entry(f, st)
+            with self._lock:
+                if self._index.get(key) is item:
+                    self._index[key] = fresh
+                    self._index.move_to_end(key)
+                    self._evict()
+            item = fresh
+        if not stale and time.time() >= item.expires:
+            self._forget(key, item)
+            return None
+        return item
+
+    def get_with_expiry(self, key):
+        """Return (value, expires_at), or (None, None) on a miss."""
+        f, item = self._open(key)
+        if f is None:
+            return None, None
+        with f:
+            f.seek(item.meta_len)
+            return f.read(), item.expires
+
+    def open(self, key, stale=False):
+        """Return a Hit whose body is a range of the open entry file."""
+        f, item = self._open(key, stale)
+        if f is None:
+            return None
+        f.seek(item.meta_len)
+        head = f.read(max(0, item.head_len - 4))
+        body_offset = item.meta_len + item.head_len
+        return Hit(head, self.TIER, file=f, offset=body_offset,
+                   length=item.size - body_offset, info=item)
+
+    def peek(self, key):
+        return self.open(key)
+
+    def refresh(self, key, ttl):
+        """Give an existing entry a new TTL (after a 304 Not Modified).
+
+        The expiry line is rewritten in place when the new value fits its
+        width; otherwise only the index is updated and the entry will be
+        revalidated again after a restart.
+        """
+        expires = time.time() + ttl
+        with self._lock:
+            item = self._index.get(key)
+            if item is None:
+                return
+            meta_len = item.meta_len
+            item.expires = expires
+            line = f"{expires:.6f}".ljust(meta_len - 1).encode("ascii") + b"\n"
+            if len(line) != meta_len:
+                return
+            try:
+                fd = os.open(self._path(key), os.O_WRONLY)
+            except OSError:
+                return
+            try:
+                os.pwrite(fd, line, 0)
+            finally:
+                os.close(fd)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._index.get(key)
+        return item is not None and time.time() < item.expires
 
     def put(self, key, value, ttl):
         if len(value) > self.max_object_bytes:
             return
-        path = self._path(key)
+        w = self.writer(key, ttl)
+        w.write(value)
+        w.commit()
+
+    def writer(self, key, ttl):
+        return _FileWriter(self, key, ttl)
+
+    def _install(self, tmp_path, key, item):
+        """Atomically publish a finished temp file as the entry for `key`."""
         with self._lock:
-            with open(path, "wb") as f:
-                f.write(f"{time.time() + ttl}\n".encode("ascii"))
-                f.write(value)
+            os.replace(tmp_path, self._path(key))
+            self._index[key] = item
+            self._index.move_to_end(key)
             self._evict()
+            self._fills += self.shared
+            sweep = self._fills >= max(1, self.max // SWEEP_FRACTION)
+            if sweep:
+                self._fills = 0
+        if sweep:
+            self._sweep()
 
     def _evict(self):
-        entries = [os.path.join(self.dir, n) for n in os.listdir(self.dir)]
-        if len(entries) <= self.max:
-            return
-        entries.sort(key=os.path.getmtime)  # oldest (LRU) first
-        for path in entries[: len(entries) - self.max]:
-            self._safe_remove(path)
+        """Drop least-recently-used entries past the limit. Caller holds _lock.
+        Shared mode only drops index entries: the files are _sweep's.
+        """
+        while len(self._index) > self.max:
+            key, _ = self._index.popitem(last=False)
+            if not self.shared:
+                self._safe_remove(self._path(key))
+                metrics.CACHE_EVICTIONS.inc(self.TIER)
+
+    def _sweep(self):
+        """Shared mode: remove the least recently used files past
+        `max_entries` in the whole directory. Every worker applies the same
+        rule, so a sweep never removes a file for being outside its own
+        index, and a concurrent one only repeats the work.
+        """
+        files = []
+        for name in os.listdir(self.dir):
+            if name.startswith(TMP_PREFIX):
+                continue
+            try:
+                files.append((os.stat(os.path.join(self.dir, name)).st_mtime, name))
+            except OSError:
+                continue                # replaced or removed meanwhile
+        files.sort()
+        for _, name in files[:max(0, len(files) - self.max)]:
+            self._safe_remove(os.path.join(self.dir, name))
+            metrics.CACHE_EVICTIONS.inc(self.TIER)
 
     def clear(self):
         with self._lock:
+            self._index.clear()
             for name in os.listdir(self.dir):
                 self._safe_remove(os.path.join(self.dir, name))
 
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._index),
+                    "bytes": sum(item.size for item in self._index.values())}
+
+    def usage(self):
+        return {self.TIER: self.stats()}
+
     @staticmethod
     def _safe_remove(path):
         try:
@@ -107,8 +623,972 @@ class FileCache:
             pass
 
 
+class _FileWriter:
+    """Tees chunks into a temp file in the cache directory; commit renames
+    it over the entry, so readers never see a half-written object. The
+    header terminator is located on the way through, for the index.
+    """
+
+    def __init__(self, cache, key, ttl):
+        self.cache, self.key = cache, key
+        self.expires = time.time() + ttl
+        fd, self.tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=cache.dir)
+        self._f = os.fdopen(fd, "wb")
+        meta = f"{self.expires:.6f}\n".encode("ascii")
+        self._f.write(meta)
+        self._meta_len = len(meta)
+        self._probe = b""           # leading bytes until the head is found
+        self._head_len = None
+        self._head = b""
+
+    def write(self, chunk):
+        if self._head_len is None:
+            self._probe += chunk
+            self._head_len = _head_length(self._probe) or None
+            if self._head_len or len(self._probe) > self.cache.max_header:
+                self._head_len = self._head_len or 0
+                self._head = self._probe[:max(0, self._head_len - 4)]
+                self._probe = b""
+        self._f.write(chunk)
+
+    def commit(self):
+        try:
+            size = self._f.tell()
+            self._f.flush()                 # e.g. ENOSPC surfaces here
+            ino = os.fstat(self._f.fileno()).st_ino
+            self._f.close()
+            item = _FileEntry(self.expires, size, self._meta_len,
+                              self._head_len or 0, self._head, ino)
+            self.cache._install(self.tmp_path, self.key, item)
+        except OSError:
+            self.discard()
+
+    def discard(self):
+        try:
+            self._f.close()
+        except OSError:
+            pass                            # buffered bytes we don't want
+        FileCache._safe_remove(self.tmp_path)
+
+
+class _SegEntry(EntryInfo):
+    """SegmentCache index record: EntryInfo plus where the record is. Never
+    moved once published -- compaction installs a new one -- so a reader
+    holding it can use `seg` and `offset` without the lock.
+    """
+
+    __slots__ = ("seg", "offset", "length", "head_len")
+
+    def __init__(self, seg, offset, length, head_len, head=None, expires=None,
+                 info=None):
+        self.seg = seg
+        self.offset = offset        # of the record header in the segment
+        self.length = length        # of the stored value
+        self.head_len = head_len
+        if info is None:
+            self._describe(head, expires)
+        else:
+            self._copy(info)
+
+
+class _Segment:
+    """One segment file, mapped whole. `size` is the append position and
+    `live` the bytes of records the index still points to.
+    """
+
+    __slots__ = ("number", "path", "mm", "size", "live")
+
+    def __init__(self, number, path, mm):
+        self.number = number
+        self.path = path
+        self.mm = mm
+        self.size = 0
+        self.live = 0
+
+
+class SegmentCache:
+    """Log-structured disk cache: values are appended to large segment
+    files instead of getting a file each, so hundreds of thousands of small
+    objects cost no inodes and a hit costs no system call.
+
+    A record is a RECORD header (magic, flags, key, expiry, value length,
+    CRC-32 of the value) followed by the value, padded to ALIGN bytes. A
+    removal (eviction) appends a TOMBSTONE record. The in-memory index (key
+    -> _SegEntry, in LRU order) is rebuilt at startup by scanning the
+    segments oldest first, later records winning; a scan stops at the first
+    damaged record, which is how a torn write from a crash is dropped.
+
+    Segments are created at their full size and memory-mapped, appended to
+    until full, then sealed (truncated to what they hold). At startup the
+    last segment is appended to again if nothing lies past its intact
+    records, and sealed otherwise (a torn tail). Hits are views
+    of the mapping and refresh rewrites the expiry field in place. Space of
+    replaced, evicted or long-expired records is reclaimed by compaction,
+    on a background thread: a sealed segment less than `compact_ratio` live
+    has its live records (and tombstones that may still shadow an older
+    segment) copied to the active segment, and is then deleted. Entries
+    dropped as expired get a tombstone too, so replay can't revive them.
+    Mappings
+    are never closed while in use, so a hit outlives the segment it came
+    from.
+
+    One process owns a segment directory; pre-fork workers use FileCache
+    (see build_cache).
+    """
+
+    TIER = "disk"
+    MAGIC = b"PXS1"
+    RECORD = struct.Struct("<4sI32sdII")    # magic, flags, key, expires, length, crc
+    EXPIRES_AT = 40                         # offset of the expiry in a record
+    TOMBSTONE = 1
+    ALIGN = 8
+    KEEP_EXPIRED = 3600     # seconds expired entries are kept for revalidation
+    NAME = "seg-%08d.log"
+
+    def __init__(self, directory, max_entries, max_object_bytes, max_header=65536,
+                 segment_bytes=64 * 1024 * 1024, compact_ratio=0.5,
+                 compact_interval=30):
+        self.dir = directory
+        self.max = max_entries
+        self.segment_bytes = segment_bytes
+        self.max_object_bytes = min(max_object_bytes,
+                                    segment_bytes - self.RECORD.size - self.ALIGN)
+        self.max_header = max_header
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._index = OrderedDict()     # key -> _SegEntry
+        self._segments = {}             # number -> _Segment
+        self._active = None
+        self._next = 1
+        self._stop = threading.Event()
+        self._compactor = None
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, number):
+        return os.path.join(self.dir, self.NAME % number)
+
+    def _size(self, length):
+        """Bytes taken by a record holding `length` bytes of value."""
+        return -(-(self.RECORD.size + length) // self.ALIGN) * self.ALIGN
+
+    def _map(self, number, create=False):
+        path = self._path(number)
+        flags = os.O_RDWR | (os.O_CREAT | os.O_EXCL if create else 0)
+        fd = os.open(path, flags, 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, self.segment_bytes)
+            return _Segment(number, path, mmap.mmap(fd, os.fstat(fd).st_size))
+        finally:
+            os.close(fd)
+
+    def _records(self, seg, end, verify=False):
+        """(offset, flags, key, expires, length) of each record in `seg`
+        before `end`, and where the intact records stop.
+        """
+        found, at = [], 0
+        view = memoryview(seg.mm)
+        try:
+            while at + self.RECORD.size <= end:
+                magic, flags, key, expires, length, crc = \
+                    self.RECORD.unpack_from(seg.mm, at)
+                start = at + self.RECORD.size
+                if magic != self.MAGIC or start + length > end:
+                    break
+                if verify and zlib.crc32(view[start:start + length]) != crc:
+                    break
+                found.append((at, flags, key, expires, length))
+                at += self._size(length)
+        finally:
+            view.release()
+        return found, min(at, end)
+
+    def _load_index(self):
+        """Replay every segment, oldest first. Recency across restarts is
+        approximated by write order.
+        """
+        numbers = []
+        for name in os.listdir(self.dir):
+            try:
+                number = int(name[4:-4])
+            except ValueError:
+                continue
+            if name == self.NAME % number:
+                numbers.append(number)
+        for number in sorted(numbers):
+            self._next = number + 1
+            try:
+                seg = self._map(number)
+            except (OSError, ValueError):   # an empty file can't be mapped
+                FileCache._safe_remove(self._path(number))
+                continue
+            records, seg.size = self._records(seg, len(seg.mm), verify=True)
+            self._segments[number] = seg
+            for offset, flags, key, expires, length in records:
+                old = self._index.pop(key, None)
+                if old is not None:
+                    old.seg.live -= self._size(old.length)
+                if flags & self.TOMBSTONE:
+                    continue
+                start = offset + self.RECORD.size
+                head_len = _head_length(
+                    seg.mm[start:start + min(length, self.max_header + 4)])
+                self._index[key] = _SegEntry(
+                    seg, offset, length, head_len,
+                    seg.mm[start:start + max(0, head_len - 4)], expires)
+                seg.live += self._size(length)
+        for seg in list(self._segments.values()):
+            if seg.number == self._next - 1 and self._clean_tail(seg):
+                self._active = seg          # carry on where the last run stopped
+            elif seg.size == 0:
+                self._segments.pop(seg.number)
+                FileCache._safe_remove(seg.path)
+            elif seg.size < len(seg.mm):
+                try:
+                    os.truncate(seg.path, seg.size)     # seal (drops a torn tail)
+                except OSError:
+                    pass
+        if self._segments:
+            self._start_compactor()
+        with self._lock:
+            self._evict()
+
+    def _clean_tail(self, seg):
+        """Whether `seg` is an unsealed segment with nothing written past
+        its intact records, so appending can resume there.
+        """
+        if len(seg.mm) != self.segment_bytes:
+            return False
+        zeros = bytes(1 << 20)
+        for at in range(seg.size, len(seg.mm), len(zeros)):
+            chunk = seg.mm[at:at + len(zeros)]
+            if chunk != zeros[:len(chunk)]:
+                return False
+        return True
+
+    def _append(self, header, value=b""):
+        """Write a record at the end of the active segment, starting a new
+        one if it doesn't fit: (segment, offset). Caller holds _lock.
+        """
+        seg, at = self._reserve(len(header) + len(value) - self.RECORD.size)
+        seg.mm[at:at + len(header)] = header
+        seg.mm[at + len(header):at + len(header) + len(value)] = value
+        return seg, at
+
+    def _reserve(self, length):
+        """Claim room for a record with a `length`-byte value at the end of
+        the active segment: (segment, offset). Caller holds _lock.
+        """
+        size = self._size(length)
+        seg = self._active
+        if seg is None or seg.size + size > self.segment_bytes:
+            seg = self._roll()
+        at = seg.size
+        seg.size += size
+        return seg, at
+
+    def _roll(self):
+        """Seal the active segment and start the next one. Caller holds _lock."""
+        if self._active is not None:
+            try:
+                os.truncate(self._active.path, self._active.size)
+            except OSError:
+                pass
+        while True:
+            number, self._next = self._next, self._next + 1
+            try:
+                seg = self._map(number, create=True)
+            except FileExistsError:             # another instance's
+                continue
+            break
+        self._segments[number] = self._active = seg
+        self._start_compactor()
+        return seg
+
+    def _start_compactor(self):
+        if self._compactor is None and self.compact_interval:
+            self._compactor = threading.Thread(
+                target=self._compact_loop, name="segment-compactor", daemon=True)
+            self._compactor.start()
+
+    def _tombstone(self, key):
+        self._append(self.RECORD.pack(self.MAGIC, self.TOMBSTONE, key, 0.0, 0, 0))
+
+    def _install(self, key, item):
+        """Publish `item` as the entry for `key`. Caller holds _lock."""
+        self._drop(self._index.pop(key, None))
+        self._index[key] = item
+        item.seg.live += self._size(item.length)
+        self._evict()
+
+    def _drop(self, item):
+        if item is not None:
+            item.seg.live -= self._size(item.length)
+
+    def _checkout(self, key, stale=False):
+        """Index entry for `key` (marked most recent), or None. Expired
+        entries are dropped unless `stale` asks for them.
+        """
+        with self._lock:
+            item = self._index.get(key)
+            if item is None:
+                return None
+            if not stale and time.time() >= item.expires:
+                self._drop(self._index.pop(key))
+                self._tombstone(key)
+                return None
+            self._index.move_to_end(key)
+            return item
+
+    def _value(self, item):
+        start = item.offset + self.RECORD.size
+        return memoryview(item.seg.mm)[start:start + item.length]
+
+    def lookup(self, key):
+        """Return (value, tier name), or (None, None) on a miss."""
+        value = self.get(key)
+        return value, (self.TIER if value is not None else None)
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        item = self._checkout(key)
+        if item is None:
+            return None, None
+        return bytes(self._value(item)), item.expires
+
+    def open(self, key, stale=False):
+        """Return a Hit whose body is a view of the segment mapping."""
+        item = self._checkout(key, stale)
+        if item is None:
+            return None
+        value = self._value(item)
+        return Hit(bytes(value[:max(0, item.head_len - 4)]), self.TIER,
+                   body=value[item.head_len:], info=item)
+
+    def peek(self, key):
+        return self.open(key)
+
+    def refresh(self, key, ttl):
+        """Give an existing entry a new TTL (after a 304 Not Modified)."""
+        expires = time.time() + ttl
+        with self._lock:
+            item = self._index.get(key)
+            if item is not None:
+                item.expires = expires
+                struct.pack_into("<d", item.seg.mm,
+                                 item.offset + self.EXPIRES_AT, expires)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._index.get(key)
+        return item is not None and time.time() < item.expires
+
+    def put(self, key, value, ttl):
+        if len(value) > self.max_object_bytes:
+            return
+        expires = time.time() + ttl
+        head_len = _head_length(value[:self.max_header + 4])
+        item = _SegEntry(None, 0, len(value), head_len,
+                         value[:max(0, head_len - 4)], expires)
+        header = self.RECORD.pack(self.MAGIC, 0, key, expires, len(value),
+                                  zlib.crc32(value))
+        with self._lock:
+            item.seg, item.offset = self._append(header, value)
+            self._install(key, item)
+
+    def writer(self, key, ttl):
+        return _SegmentWriter(self, key, ttl)
+
+    def _put_spooled(self, key, writer):
+        """Append a record whose value is in `writer`'s spool file."""
+        item = _SegEntry(None, 0, writer.size, writer.head_len, writer.head,
+                         writer.expires)
+        header = self.RECORD.pack(self.MAGIC, 0, key, writer.expires,
+                                  writer.size, writer.crc)
+        spool = writer.spool
+        spool.seek(0)
+        with self._lock:
+            item.seg, item.offset = self._reserve(writer.size)
+            mm, at = item.seg.mm, item.offset
+            mm[at:at + len(header)] = header
+            at += len(header)
+            while True:
+                data = spool.read(COPY_BYTES)
+                if not data:
+                    break
+                mm[at:at + len(data)] = data
+                at += len(data)
+            self._install(key, item)
+
+    def _evict(self):
+        """Drop least-recently-used entries past the limit. Caller holds _lock."""
+        while len(self._index) > self.max:
+            key, item = self._index.popitem(last=False)
+            self._drop(item)
+            self._tombstone(key)
+            metrics.CACHE_EVICTIONS.inc(self.TIER)
+
+    def compact(self):
+        """Drop long-expired entries and rewrite sealed segments that are
+        mostly dead. Returns the number of segments reclaimed.
+        """
+        cutoff = time.time() - self.KEEP_EXPIRED
+        with self._lock:
+            for key, item in list(self._index.items()):
+                if item.expires < cutoff:
+                    self._drop(self._index.pop(key))
+                    self._tombstone(key)
+            victims = sorted(
+                (s for s in self._segments.values() if s is not self._active
+                 and s.live <= s.size * self.compact_ratio),
+                key=lambda s: s.number)
+        for seg in victims:
+            self._compact(seg)
+        return len(victims)
+
+    def _compact(self, seg):
+        """Move `seg`'s live records to the active segment, then delete it."""
+        records, _ = self._records(seg, seg.size)
+        for offset, flags, key, _, length in records:
+            size = self._size(length)
+            with self._lock:
+                if flags & self.TOMBSTONE:
+                    # Still needed while an older segment may hold the key
+                    # and no newer fill shadows it.
+                    if (key not in self._index
+                            and min(self._segments, default=seg.number) < seg.number):
+                        self._append(seg.mm[offset:offset + size])
+                    continue
+                item = self._index.get(key)
+                if item is None or item.seg is not seg or item.offset != offset:
+                    continue
+                moved = _SegEntry(None, 0, length, item.head_len, info=item)
+                moved.seg, moved.offset = self._append(seg.mm[offset:offset + size])
+                moved.seg.live += size
+                seg.live -= size
+                self._index[key] = moved    # keeps its place in LRU order
+        with self._lock:
+            self._segments.pop(seg.number, None)
+        FileCache._safe_remove(seg.path)
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except OSError as e:
+                logging.warning("Segment compaction failed: %s", e)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._segments.clear()
+            self._active = None
+            for name in os.listdir(self.dir):
+                if name.startswith(self.NAME[:4]):
+                    FileCache._safe_remove(os.path.join(self.dir, name))
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._index),
+                    "bytes": sum(s.live for s in self._segments.values()),
+                    "segments": len(self._segments),
+                    "segment_bytes": sum(s.size for s in self._segments.values())}
+
+    def usage(self):
+        return {self.TIER: self.stats()}
+
+    def close(self):
+        """Stop compacting and unmap the segments not still used by hits."""
+        self._stop.set()
+        with self._lock:
+            for seg in self._segments.values():
+                try:
+                    seg.mm.close()
+                except BufferError:
+                    pass
+
+
+class _SegmentWriter:
+    """Spools a SegmentCache fill -- in memory while small, then in an
+    unnamed temp file in the segment directory -- computing the CRC and
+    locating the header on the way; commit appends it as one record. Fills
+    past max_object_bytes stop spooling and commit to nothing.
+    """
+
+    def __init__(self, cache, key, ttl):
+        self.cache, self.key = cache, key
+        self.expires = time.time() + ttl
+        self.spool = tempfile.SpooledTemporaryFile(SPOOL_BYTES, dir=cache.dir)
+        self.size = 0
+        self.crc = 0
+        self.head_len = None
+        self.head = b""
+        self._probe = b""
+
+    def write(self, chunk):
+        if self.spool is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_object_bytes:
+            self.discard()
+            return
+        if self.head_len is None:
+            self._probe += chunk
+            self.head_len = _head_length(self._probe) or None
+            if self.head_len or len(self._probe) > self.cache.max_header:
+                self.head_len = self.head_len or 0
+                self.head = self._probe[:max(0, self.head_len - 4)]
+                self._probe = b""
+        self.crc = zlib.crc32(chunk, self.crc)
+        self.spool.write(chunk)
+
+    def commit(self):
+        if self.spool is None:
+            return
+        if self.head_len is None:
+            self.head_len = 0
+        try:
+            self.cache._put_spooled(self.key, self)
+        except OSError:
+            pass
+        finally:
+            self.discard()
+
+    def discard(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+
+class _SharedInfo(EntryInfo):
+    """Parsed metadata of one shared-cache fill, kept per process."""
+
+    __slots__ = ("head_len",)
+
+    def __init__(self, head, head_len):
+        self.head_len = head_len
+        self._describe(head, None)
+
+
+class SharedCache:
+    """One RAM cache for every process on the host, in a memory-mapped file
+    (under /dev/shm by default).
+
+    Layout: a header (magic, geometry, the ring's write position), a fixed
+    hash index of `buckets` buckets holding WAYS slots each (key, data
+    offset, length, expiry), then a data ring. Values are appended to the
+    ring; a new value overwrites the oldest ones, so eviction is FIFO by
+    fill, not LRU. Ring offsets are absolute (they only grow), so an index
+    slot is valid while the write position hasn't moved a full ring past it.
+
+    Readers take no lock: each bucket starts with a sequence number that
+    writers make odd while they change the bucket, and a reader that sees
+    it odd or changed reads again. The value is copied out of the ring and
+    then checked against the write position (and its stored key) to be
+    sure it wasn't overwritten meanwhile. A hit is therefore memory reads
+    and one copy, no system call. Writers serialize on fcntl byte-range
+    locks -- one for the ring, one per bucket -- plus thread locks, since
+    fcntl locks only exclude other processes.
+    """
+
+    TIER = "shared"
+    MAGIC = b"PXYSHM01"
+    WAYS = 4
+    HEADER = struct.Struct("<8sQQQ")        # magic, buckets, ring size, ring head
+    HEAD_AT = 24                            # offset of the ring head field
+    SLOT = struct.Struct("<32sQId")         # key, ring offset, length, expires
+    RECORD_KEY = 32                         # ring records start with their key
+    READ_RETRIES = 100
+    INFO_CACHE = 4096                       # parsed heads kept per process
+    _INIT_LOCK, _RING_LOCK = 0, 1           # fcntl lock bytes in the header
+
+    def __init__(self, path, max_entries, max_bytes, max_object_bytes):
+        if fcntl is None:
+            raise OSError("the shared cache needs POSIX file locks")
+        self.path = path
+        self.buckets = max(1, -(-max_entries // self.WAYS))
+        self.ring = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes // 4)
+        self._bucket = struct.Struct("<Q" + self.SLOT.format[1:] * self.WAYS)
+        self._index_at = 64
+        self._ring_at = -(-(self._index_at + self.buckets * self._bucket.size)
+                          // 4096) * 4096
+        size = self._ring_at + self.ring
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            self._mm = self._attach(path, size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._ring_lock = threading.Lock()
+        self._bucket_locks = [threading.Lock() for _ in range(64)]
+        self._infos = {}                    # ring offset -> _SharedInfo
+
+    def _attach(self, path, size):
+        """Map the cache file, laying it out if it is new. A file that isn't
+        ours alone (another owner, group/other access) could be used to
+        poison every worker's cache, and one laid out differently may be
+        mapped by running processes: both are refused, not reused.
+        """
+        st = os.fstat(self._fd)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise OSError(f"{path}: shared cache file must be owned by this "
+                          f"user with mode 0600")
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._INIT_LOCK)
+        try:
+            if os.fstat(self._fd).st_size == 0:      # new: lay it out
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER.pack(
+                    self.MAGIC, self.buckets, self.ring, 0), 0)
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            if (os.fstat(self._fd).st_size != size or len(header) < self.HEADER.size
+                    or self.HEADER.unpack(header)[:3]
+                    != (self.MAGIC, self.buckets, self.ring)):
+                raise OSError(f"{path}: shared cache file has another layout "
+                              f"(shm_bytes/shm_entries changed?); remove it "
+                              f"once no proxy is using it")
+            return mmap.mmap(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._INIT_LOCK)
+
+    def _bucket_at(self, key):
+        n = int.from_bytes(key[:8], "little") % self.buckets
+        return self._index_at + n * self._bucket.size
+
+    def _ring_head(self):
+        return struct.unpack_from("<Q", self._mm, self.HEAD_AT)[0]
+
+    def _read_bucket(self, at):
+        """A consistent copy of the bucket at `at`: (seq, slots), or None if
+        writers kept it busy for READ_RETRIES attempts.
+        """
+        mm, unpack = self._mm, self._bucket.unpack_from
+        for _ in range(self.READ_RETRIES):
+            fields = unpack(mm, at)
+            if fields[0] & 1 or struct.unpack_from("<Q", mm, at)[0] != fields[0]:
+                continue
+            return fields[0], [fields[i:i + 4] for i in range(1, len(fields), 4)]
+        return None
+
+    def _find(self, key):
+        """(ring offset, length, expires) of `key`'s slot, or None."""
+        found = self._read_bucket(self._bucket_at(key))
+        if found is None:
+            return None
+        head = self._ring_head()
+        for slot_key, offset, length, expires in found[1]:
+            if slot_key == key and length and offset + self.ring >= head:
+                return offset, length, expires
+        return None
+
+    def _read(self, key, stale=False):
+        """(value, ring offset, expires) copied out of the ring, or None."""
+        found = self._find(key)
+        if found is None:
+            return None
+        offset, length, expires = found
+        if not stale and time.time() >= expires:
+            return None
+        at = self._ring_at + offset % self.ring
+        record = self._mm[at:at + self.RECORD_KEY + length]
+        # Written over while we copied it?
+        if (offset + self.ring < self._ring_head()
+                or record[:self.RECORD_KEY] != key):
+            return None
+        return record[self.RECORD_KEY:], offset, expires
+
+    def lookup(self, key):
+        """Return (value, tier name), or (None, None) on a miss."""
+        value = self.get(key)
+        return value, (self.TIER if value is not None else None)
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        found = self._read(key)
+        if found is None:
+            return None, None
+        return found[0], found[2]
+
+    def open(self, key, stale=False):
+        found = self._read(key, stale)
+        if found is None:
+            return None
+        value, offset, expires = found
+        info = self._infos.get(offset)
+        if info is None:
+            head_len = _head_length(value)
+            info = _SharedInfo(value[:max(0, head_len - 4)], head_len)
+            if len(self._infos) >= self.INFO_CACHE:
+                self._infos.clear()         # cheap to rebuild from the heads
+            self._infos[offset] = info
+        body = memoryview(value)[info.head_len:]
+        hit = Hit(value[:max(0, info.head_len - 4)], self.TIER, body=body,
+                  info=info)
+        hit.expires = expires
+        return hit
+
+    def peek(self, key):
+        return self.open(key)
+
+    def __contains__(self, key):
+        found = self._find(key)
+        return found is not None and time.time() < found[2]
+
+    def put(self, key, value, ttl):
+        if len(value) > self.max_object_bytes:
+            return
+        need = self.RECORD_KEY + len(value)
+        with self._ring_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._RING_LOCK)
+            try:
+                offset = self._ring_head()
+                if offset % self.ring + need > self.ring:
+                    offset += self.ring - offset % self.ring    # wrap
+                # Move the head first: readers of what we overwrite see it.
+                struct.pack_into("<Q", self._mm, self.HEAD_AT, offset + need)
+                at = self._ring_at + offset % self.ring
+                self._mm[at:at + self.RECORD_KEY] = key
+                self._mm[at + self.RECORD_KEY:at + need] = value
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._RING_LOCK)
+        self._update(key, lambda slot: (key, offset, len(value),
+                                        time.time() + ttl))
+
+    def refresh(self, key, ttl):
+        """Give an existing entry a new TTL (after a 304 Not Modified)."""
+        self._update(key, lambda slot: slot[:3] + (time.time() + ttl,),
+                     insert=False)
+
+    @contextlib.contextmanager
+    def _locked(self, at):
+        """Exclusive access to the bucket at `at`, from all threads and
+        processes. Yields (seq, slots) as currently stored.
+        """
+        stripe = (at // self._bucket.size) % len(self._bucket_locks)
+        with self._bucket_locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, at)
+            try:
+                fields = self._bucket.unpack_from(self._mm, at)
+                seq = fields[0] + (fields[0] & 1)     # a writer died mid-update
+                yield seq, [fields[i:i + 4] for i in range(1, len(fields), 4)]
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, at)
+
+    def _write_slot(self, at, seq, way, slot):
+        """Seqlock-protected slot store; caller holds the bucket lock."""
+        struct.pack_into("<Q", self._mm, at, seq + 1)
+        self.SLOT.pack_into(self._mm, at + 8 + way * self.SLOT.size, *slot)
+        struct.pack_into("<Q", self._mm, at, seq + 2)
+
+    def _update(self, key, change, insert=True):
+        """Rewrite `key`'s slot as `change(old_slot)`. With `insert`, a key
+        not yet in its bucket takes a free, dead or expired slot, or else
+        the one with the oldest value.
+        """
+        at = self._bucket_at(key)
+        with self._locked(at) as (seq, slots):
+            way = next((i for i, s in enumerate(slots) if s[0] == key), None)
+            if way is None and not insert:
+                return
+            if way is None:
+                head, now = self._ring_head(), time.time()
+                way = min(range(self.WAYS), key=lambda i: (
+                    slots[i][2] != 0 and slots[i][1] + self.ring >= head
+                    and slots[i][3] > now, slots[i][1]))
+            self._write_slot(at, seq, way, change(slots[way]))
+
+    def writer(self, key, ttl):
+        return _MemoryWriter(self, key, ttl)
+
+    def clear(self):
+        for n in range(self.buckets):
+            at = self._index_at + n * self._bucket.size
+            with self._locked(at) as (seq, slots):
+                for way, slot in enumerate(slots):
+                    if slot[2]:
+                        self._write_slot(at, seq, way, (b"", 0, 0, 0.0))
+                        seq += 2
+        self._infos.clear()
+
+    def stats(self):
+        head = self._ring_head()
+        now = time.time()
+        entries = 0
+        for fields in self._bucket.iter_unpack(
+                self._mm[self._index_at:self._index_at
+                         + self.buckets * self._bucket.size]):
+            for i in range(1, len(fields), 4):
+                if fields[i + 2] and fields[i + 1] + self.ring >= head \
+                        and fields[i + 3] > now:
+                    entries += 1
+        return {"entries": entries, "bytes": min(head, self.ring)}
+
+    def usage(self):
+        return {self.TIER: self.stats()}
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class TieredCache:
+    """MemoryCache (L1) in front of FileCache or SegmentCache (L2).
+
+    Every fill is persisted to L2; objects up to `l1_max_object_bytes` are
+    also kept in L1. L2 hits are promoted to L1 with their remaining TTL,
+    and L1 evictions are written back to L2 if L2 no longer holds them.
+    """
+
+    TIER = "tiered"
+
+    def __init__(self, l1, l2, l1_max_object_bytes):
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_max_object_bytes = l1_max_object_bytes
+        self.max_object_bytes = l2.max_object_bytes
+        self.hits = {l1.TIER: 0, l2.TIER: 0}
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        l1.on_evict = self._demote
+
+    def _count(self, tier):
+        with self._stats_lock:
+            if tier is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+
+    def lookup(self, key):
+        value = self.l1.get(key)
+        if value is not None:
+            self._count(self.l1.TIER)
+            return value, self.l1.TIER
+        value, expires = self.l2.get_with_expiry(key)
+        if value is None:
+            self._count(None)
+            return None, None
+        self._count(self.l2.TIER)
+        if len(value) <= self.l1_max_object_bytes:
+            self.l1.put(key, value, expires - time.time())
+        return value, self.l2.TIER
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def open(self, key, stale=False):
+        """Small objects come back from (or are promoted into) L1; larger
+        L2 hits stay on disk and are returned as a file range.
+        """
+        hit = self.l1.open(key, stale)
+        if hit is None:
+            hit = self.l2.open(key, stale)
+            if hit is not None and hit.size <= self.l1_max_object_bytes:
+                if hit.file is None:            # SegmentCache: a mapped view
+                    body = bytes(hit.body)
+                else:
+                    try:
+                        body = os.pread(hit.file.fileno(), hit.length, hit.offset)
+                    finally:
+                        hit.close()
+                entry = Entry(hit.head + b"\r\n\r\n" + body, hit.expires)
+                if hit.expires > time.time():
+                    self.l1.put_entry(key, entry)
+                hit = Hit.from_entry(entry, self.l2.TIER)
+        self._count(hit.tier if hit is not None else None)
+        return hit
+
+    def peek(self, key):
+        """open() without counting a hit or miss or promoting to L1."""
+        hit = self.l1.peek(key)
+        return hit if hit is not None else self.l2.peek(key)
+
+    def refresh(self, key, ttl):
+        self.l1.refresh(key, ttl)
+        self.l2.refresh(key, ttl)
+
+    def put(self, key, value, ttl):
+        self.l2.put(key, value, ttl)
+        if len(value) <= self.l1_max_object_bytes:
+            self.l1.put(key, value, ttl)
+
+    def writer(self, key, ttl):
+        return _TieredWriter(self, key, ttl)
+
+    def _demote(self, key, entry):
+        ttl = entry.expires - time.time()
+        if ttl > 0 and key not in self.l2:
+            self.l2.put(key, entry.value, ttl)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            return {"hits": dict(self.hits), "misses": self.misses,
+                    "l1": self.l1.stats()}
+
+    def usage(self):
+        return {**self.l1.usage(), **self.l2.usage()}
+
+
+class _TieredWriter:
+    """Streams into L2's writer and keeps a copy for L1 while it's small."""
+
+    def __init__(self, cache, key, ttl):
+        self.cache, self.key, self.ttl = cache, key, ttl
+        self._l2 = cache.l2.writer(key, ttl)
+        self._chunks = []
+        self._size = 0
+
+    def write(self, chunk):
+        self._l2.write(chunk)
+        if self._chunks is not None:
+            self._size += len(chunk)
+            if self._size > self.cache.l1_max_object_bytes:
+                self._chunks = None
+            else:
+                self._chunks.append(bytes(chunk))
+
+    def commit(self):
+        self._l2.commit()
+        if self._chunks is not None:
+            self.cache.l1.put(self.key, b"".join(self._chunks), self.ttl)
+
+    def discard(self):
+        self._l2.discard()
+        self._chunks = None
+
+
 def build_cache(cfg):
     c = cfg["cache"]
     if c["backend"] == "memory":
-        return MemoryCache(c["max_entries"])
-    return FileCache(c["dir"], c["max_entries"], c["max_object_bytes"])
\ No newline at end of file
+        return MemoryCache(c["max_entries"], c["max_bytes"], c["shards"])
+    if c["backend"] == "shared":
+        path = c["shm_path"] or (
+            f"/dev/shm/proxy-cache-{cfg['listen_port']}"
+            if os.path.isdir("/dev/shm") else os.path.join(c["dir"], "shared.cache"))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return SharedCache(path, c["shm_entries"], c["shm_bytes"],
+                           c["max_object_bytes"])
+    if c["file_layout"] == "segments" and cfg["workers"] > 1:
+        logging.warning("cache.file_layout \"segments\" is per process; "
+                        "using one file per entry for %s workers", cfg["workers"])
+    if c["file_layout"] == "segments" and cfg["workers"] == 1:
+        files = SegmentCache(os.path.join(c["dir"], "segments"), c["max_entries"],
+                             c["max_object_bytes"], cfg["max_header_bytes"],
+                             c["segment_bytes"], c["compact_ratio"],
+                             c["compact_interval"])
+    else:
+        files = FileCache(c["dir"], c["max_entries"], c["max_object_bytes"],
+                          cfg["max_header_bytes"], shared=cfg["workers"] > 1)
+    if c["backend"] == "tiered":
+        l1 = MemoryCache(c["l1_max_entries"], c["l1_max_bytes"], c["shards"])
+        return TieredCache(l1, files, c["l1_max_object_bytes"])
+    return files
\ No newline at end of file
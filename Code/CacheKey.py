@@ -0,0 +1,180 @@
+"""Cache keys: URL normalisation and Vary secondary keys.
+
+`cachelib.make_key` hashes the request identity exactly as given, so
+`/p?a=1&b=2` and `/p?b=2&a=1` -- or the same page with a campaign tag --
+were separate entries. The primary key is now built from a normalised path:
+percent-encodings in canonical form, query parameters in a stable order and
+tracking parameters dropped.
+
+A response with `Vary` is stored under a secondary key that also covers the
+request headers it names, so e.g. gzip and identity bodies are never
+confused. The Vary header names seen per primary key are remembered (in
+memory, bounded), so a later request can be looked up directly under its
+variant; after a restart the first response simply teaches them again.
+"""
+import fnmatch
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote
+
+import cache as cachelib
+import parse
+
+STATS_EVERY = 1000      # log the hit-ratio summary this often (requests)
+
+_PCT = re.compile(r"%[0-9A-Fa-f]{2}")
+_UNRESERVED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+
+
+def _fold_escape(m):
+    """%7e -> ~ (unreserved characters needn't be escaped), %2f -> %2F."""
+    char = chr(int(m.group(0)[1:], 16))
+    return char if char in _UNRESERVED else m.group(0).upper()
+
+
+def normalize_path(path, sort_query=True, drop_params=(), lowercase_path=False):
+    """Return the canonical form of an origin-form path used for keys.
+
+    `drop_params` are shell-style patterns (`utm_*`) matched against query
+    parameter names case-insensitively. Sorting is by name only and stable,
+    so repeated parameters keep their relative order.
+    """
+    path, _, _ = path.partition("#")
+    path, sep, query = path.partition("?")
+    path = _PCT.sub(_fold_escape, path)
+    if lowercase_path:
+        path = path.lower()
+    if not sep:
+        return path
+    params = [p for p in query.split("&") if p]
+    if drop_params:
+        params = [p for p in params
+                  if not any(fnmatch.fnmatchcase(
+                      unquote(p.partition("=")[0]).lower(), pat)
+                      for pat in drop_params)]
+    if sort_query:
+        params.sort(key=lambda p: unquote(p.partition("=")[0]))
+    params = [_PCT.sub(_fold_escape, p) for p in params]
+    return path + ("?" + "&".join(params) if params else "")
+
+
+def vary_names(resp_headers):
+    """Sorted lower-case header names from Vary, ("*",) for Vary: *, or ()."""
+    names = set()
+    for value in parse.get_all_headers(resp_headers, "vary"):
+        names.update(n.strip().lower() for n in value.split(",") if n.strip())
+    if "*" in names:
+        return ("*",)
+    return tuple(sorted(names))
+
+
+def variant_key(primary, names, req_headers):
+    """Secondary key: the primary key plus the request's values for `names`.
+    Values are compared with list whitespace collapsed (`gzip,br` ==
+    `gzip, br`); a missing header and an empty one are kept apart.
+    """
+    parts = []
+    for name in names:
+        values = parse.get_all_headers(req_headers, name)
+        if not values:
+            parts.append(name)
+            continue
+        joined = ",".join(v.strip() for value in values for v in value.split(","))
+        parts.append(f"{name}={joined}")
+    raw = "\n".join(parts).encode("utf-8")
+    return hashlib.sha256(primary + b"\n" + raw).digest()
+
+
+class CacheKeys:
+    """Builds the key a request is looked up and stored under."""
+
+    def __init__(self, normalize=True, sort_query=True, drop_params=(),
+                 lowercase_path=False, max_vary_entries=10000):
+        self.normalize = normalize
+        self.sort_query = sort_query
+        self.drop_params = tuple(p.lower() for p in drop_params)
+        self.lowercase_path = lowercase_path
+        self.max_vary = max_vary_entries
+        self._lock = threading.Lock()
+        self._vary = OrderedDict()      # primary key -> Vary header names
+        self.requests = 0
+        self.rewritten = 0      # paths that normalisation changed
+        self.hits = 0
+        self.rewritten_hits = 0  # hits on a rewritten path: likely won by it
+
+    def primary(self, method, host, port, path):
+        """Key for the normalised request URL; returns (key, rewritten)."""
+        norm = path
+        if self.normalize:
+            norm = normalize_path(path, self.sort_query, self.drop_params,
+                                  self.lowercase_path)
+        rewritten = norm != path
+        counted = method.upper() == "GET"   # the hit ratio is of cacheable requests
+        with self._lock:
+            self.requests += counted
+            self.rewritten += rewritten and counted
+            report = counted and self.requests % STATS_EVERY == 0
+        if report:
+            self.log_stats()
+        return cachelib.make_key(method, host, port, norm), rewritten
+
+    def lookup(self, primary, req_headers):
+        """Key to look a request up under: its variant if the origin is
+        known to Vary this URL, else the primary key.
+        """
+        with self._lock:
+            names = self._vary.get(primary)
+            if names is not None:
+                self._vary.move_to_end(primary)
+        if not names:
+            return primary
+        return variant_key(primary, names, req_headers)
+
+    def for_response(self, primary, req_headers, resp_headers):
+        """Key to store a response under, or None if it must not be stored
+        (`Vary: *`). Remembers the response's Vary names for lookups.
+        """
+        names = vary_names(resp_headers)
+        with self._lock:
+            if not names:
+                self._vary.pop(primary, None)
+            else:
+                self._vary[primary] = names
+                self._vary.move_to_end(primary)
+                while len(self._vary) > self.max_vary:
+                    self._vary.popitem(last=False)
+        if not names:
+            return primary
+        if names == ("*",):
+            return None
+        return variant_key(primary, names, req_headers)
+
+    def record_hit(self, rewritten):
+        with self._lock:
+            self.hits += 1
+            self.rewritten_hits += rewritten
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "rewritten": self.rewritten,
+                    "hits": self.hits, "rewritten_hits": self.rewritten_hits,
+                    "vary_urls": len(self._vary)}
+
+    def log_stats(self):
+        """Log the hit ratio and the share of it that normalisation won."""
+        s = self.stats()
+        total = s["requests"] or 1
+        logging.info("Cache keys: %s -- hit ratio %.1f%% (%.1f%% of requests "
+                     "hit on a normalised URL)", s, 100 * s["hits"] / total,
+                     100 * s["rewritten_hits"] / total)
+
+
+def build_keys(cfg):
+    c = cfg["cache"]
+    return CacheKeys(c["normalize_urls"], c["sort_query"],
+                     c["drop_query_params"], c["lowercase_path"],
+                     c["max_entries"])
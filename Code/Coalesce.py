@@ -0,0 +1,217 @@
+"""Single-flight coalescing of concurrent cache misses.
+
+When a popular object expires, every request for it misses at once. The
+first request for a key becomes the *leader* and fetches from the origin;
+requests arriving while that fetch is in flight become *followers* and
+stream the leader's bytes as they arrive instead of opening their own
+upstream connection.
+
+A response is only shared if it is cacheable (the leader decides from the
+response head), so private or uncacheable content is never handed to
+another client -- followers fall back to their own fetch instead.
+"""
+import logging
+import threading
+
+
+class FlightFailed(ConnectionError):
+    """The leader's fetch broke off after a follower had started relaying."""
+
+
+class Flight:
+    """One in-progress origin fetch that other requests can follow.
+
+    Body chunks are buffered for followers. Past `buffer_limit` bytes the
+    flight stops taking new followers (they would need the start) and drops
+    the chunks every follower has already taken; a follower still so far
+    behind that the buffer stays over the limit is detached -- its relay
+    fails with FlightFailed -- so memory stays bounded whatever the
+    response size or framing.
+    """
+
+    def __init__(self, buffer_limit):
+        self._cond = threading.Condition()
+        self._limit = buffer_limit
+        self._chunks = []
+        self._base = 0          # chunks dropped from the front of _chunks
+        self._size = 0
+        self._followers = set()  # attached _Followers
+        self.head = None        # origin response head, once the leader has it
+        self.framing = None
+        self.shared = None      # None = undecided, then True/False
+        self.done = False
+        self.ok = False
+        self.sealed = False     # no longer joinable (too big, not shared)
+
+    @property
+    def followers(self):
+        with self._cond:
+            return len(self._followers)
+
+    # -- leader side -------------------------------------------------------
+
+    def publish(self, head, framing, shared):
+        with self._cond:
+            self.head, self.framing, self.shared = head, framing, shared
+            if not shared:
+                self.sealed = True
+            self._cond.notify_all()
+
+    def append(self, chunk):
+        with self._cond:
+            if self.sealed and not self._followers:
+                return                  # nobody to feed
+            self._chunks.append(chunk)
+            self._size += len(chunk)
+            if self._size > self._limit:
+                self.sealed = True
+                self._trim()
+            self._cond.notify_all()
+
+    def _trim(self):
+        """Drop chunks until the buffer fits, detaching the slowest
+        followers if need be. Caller holds _cond.
+        """
+        while self._size > self._limit and self._chunks:
+            low = min((f.index for f in self._followers),
+                      default=self._base + len(self._chunks))
+            if low == self._base:
+                for follower in [f for f in self._followers if f.index == low]:
+                    follower.detached = True
+                    self._followers.discard(follower)
+                continue
+            for chunk in self._chunks[:low - self._base]:
+                self._size -= len(chunk)
+            del self._chunks[:low - self._base]
+            self._base = low
+
+    def finish(self, ok):
+        with self._cond:
+            self.done = True
+            self.ok = ok
+            if self.shared is None:
+                self.shared = False
+            self._cond.notify_all()
+
+    # -- follower side -----------------------------------------------------
+
+    def _attach(self):
+        """A _Follower reading from the first chunk, or None if the flight
+        can't be joined any more.
+        """
+        with self._cond:
+            if self.sealed or self.done:
+                return None
+            follower = _Follower(self)
+            self._followers.add(follower)
+            return follower
+
+    def _detach(self, follower):
+        with self._cond:
+            self._followers.discard(follower)
+
+
+class _Follower:
+    """One request following a Flight: its read position in the chunks."""
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.index = 0          # next chunk to take
+        self.detached = False
+
+    def wait_head(self, timeout):
+        """Block until the leader knows whether its response can be shared.
+        Returns (head, framing), or (None, None) to fetch independently.
+        """
+        flight = self.flight
+        with flight._cond:
+            flight._cond.wait_for(lambda: flight.shared is not None, timeout)
+            shared = flight.shared
+        if not shared:
+            flight._detach(self)
+            return None, None
+        return flight.head, flight.framing
+
+    def iter_body(self, timeout):
+        """Yield the leader's body chunks from the start, as they arrive."""
+        flight = self.flight
+        try:
+            while True:
+                with flight._cond:
+                    ready = flight._cond.wait_for(
+                        lambda: (self.detached or flight.done
+                                 or self.index < flight._base + len(flight._chunks)),
+                        timeout)
+                    if self.detached:
+                        raise FlightFailed("Fell too far behind in-flight fetch")
+                    if not ready:
+                        raise FlightFailed("Timed out following in-flight fetch")
+                    chunks = flight._chunks[self.index - flight._base:]
+                    self.index += len(chunks)
+                    finished = (flight.done
+                                and self.index == flight._base + len(flight._chunks))
+                    ok = flight.ok
+                yield from chunks
+                if finished:
+                    if not ok:
+                        raise FlightFailed("In-flight fetch failed")
+                    return
+        finally:
+            flight._detach(self)
+
+
+class Coalescer:
+    """Registry of in-flight misses keyed by cache key."""
+
+    def __init__(self, buffer_limit, enabled=True):
+        self.buffer_limit = buffer_limit
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0        # misses that went upstream with a flight open
+        self.coalesced = 0      # upstream fetches avoided by following
+        self.fallbacks = 0      # followers whose leader's response wasn't shareable
+
+    def join(self, key):
+        """Return (flight, True) for the leader, (follower, False) for a
+        request that follows one (a view with wait_head and iter_body).
+        (None, False) means coalescing is off or the existing flight can't
+        be joined: fetch independently.
+        """
+        if not self.enabled:
+            return None, False
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(self.buffer_limit)
+                self.leaders += 1
+                return flight, True
+            follower = flight._attach()
+            if follower is None:
+                return None, False
+            return follower, False
+
+    def leave(self, key, flight, ok):
+        """Leader is done with `flight`; followers drain what's buffered."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(ok)
+
+    def record(self, shared):
+        with self._lock:
+            if shared:
+                self.coalesced += 1
+            else:
+                self.fallbacks += 1
+        logging.debug("Coalesced miss: shared=%s", shared)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced,
+                    "fallbacks": self.fallbacks, "in_flight": len(self._flights)}
+
+
+def build_coalescer(cfg):
+    c = cfg["cache"]
+    return Coalescer(c["max_object_bytes"], c["coalesce_misses"])
@@ -0,0 +1,233 @@
+"""Gzip-compressed storage of cached text responses.
+
+Many origins send text assets uncompressed. With `cache.compress` on, a
+cached identity response of a compressible type is gzipped on a small
+worker pool after the fill (or on the first hit that could use it), never
+while a client waits, and the gzip copy then *replaces* the identity entry
+under the same key: the object is stored once, compressed. Hits from
+clients whose Accept-Encoding allows gzip get it as stored; the rare client
+that doesn't gets it decompressed on the way out. Both carry
+`Vary: Accept-Encoding` so downstream caches keep them apart.
+
+Stored copies are marked with an internal header (VARIANT_HEADER) that is
+never sent. The marker, not the origin's own Content-Encoding, is what
+select() decodes, so origin-encoded responses are served untouched. A
+Compressor is built even with `compress` off, so entries compressed by an
+earlier run are still decoded for clients that need identity.
+
+Only complete 200 responses with a Content-Length (up to `max_bytes`, which
+bounds the decode an identity client costs its request thread), no
+Content-Encoding and no Vary of their own are compressed; anything the
+origin already varies or encodes is left to the normal Vary keys (see
+cachekey.py).
+"""
+import gzip
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import parse
+from cache import Hit
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript",
+    "application/x-javascript", "application/xml", "image/svg+xml",
+)
+
+MAX_INCOMPRESSIBLE = 10000      # remembered keys not worth compressing
+MAX_DECISIONS = 10000           # remembered wants() answers for cached heads
+VARIANT_HEADER = b"X-Proxy-Gzip: 1"   # marks our gzip copies; never sent
+
+
+def _compressible_type(ctype):
+    ctype = (ctype or "").split(";", 1)[0].strip().lower()
+    return (ctype.startswith(COMPRESSIBLE_TYPES)
+            or ctype.endswith(("+json", "+xml")))
+
+
+def _body(hit):
+    """A hit's body as bytes (closes file-backed hits)."""
+    try:
+        if hit.file is not None:
+            return os.pread(hit.file.fileno(), hit.length, hit.offset)
+        return bytes(hit.body)
+    finally:
+        hit.close()
+
+
+def _drop_lines(head, names):
+    """`head` without the header lines named in `names` (lower case)."""
+    lines = head.split(b"\r\n")
+    return b"\r\n".join(lines[:1] + [
+        line for line in lines[1:]
+        if line.split(b":", 1)[0].strip().lower() not in names])
+
+
+class Compressor:
+    """Compresses cache entries in place and serves them per client."""
+
+    def __init__(self, cache, level=6, min_bytes=1024, workers=2, enabled=True,
+                 max_bytes=1024 * 1024):
+        self.cache = cache
+        self.level = level
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._incompressible = OrderedDict()  # keys gzip didn't shrink
+        self._decisions = OrderedDict()  # key -> (hash of head, wants())
+        self._pool = (ThreadPoolExecutor(max_workers=workers,
+                                         thread_name_prefix="compress")
+                      if enabled else None)
+        self.compressed = 0     # entries replaced by a gzip copy
+        self.skipped = 0        # bodies gzip didn't shrink
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.served = 0         # hits answered gzipped
+        self.decoded = 0        # hits decompressed for identity clients
+
+    def wants(self, status, headers):
+        """Whether a response with this status and headers gets compressed."""
+        length = parse.get_header(headers, "content-length")
+        return (self.enabled and status == 200
+                and length is not None and length.isdigit()
+                and self.min_bytes <= int(length) <= self.max_bytes
+                and parse.get_header(headers, "content-encoding") is None
+                and parse.get_header(headers, "transfer-encoding") is None
+                and parse.get_header(headers, "vary") is None
+                and _compressible_type(parse.get_header(headers, "content-type")))
+
+    def submit(self, key):
+        """Queue `key`'s entry for compression (once, however often asked)."""
+        with self._lock:
+            if (not self.enabled or key in self._pending
+                    or key in self._incompressible):
+                return
+            self._pending.add(key)
+        self._pool.submit(self._run, key)
+
+    def _run(self, key):
+        try:
+            hit = self.cache.peek(key)
+            if hit is None or not self.wants(hit.status, hit.headers):
+                if hit is not None:
+                    hit.close()
+                return
+            head, expires = hit.head, hit.expires
+            body = _body(hit)
+            packed = gzip.compress(body, self.level, mtime=0)
+            with self._lock:
+                self.bytes_in += len(body)
+                if len(packed) >= len(body):
+                    self.skipped += 1
+                    self._incompressible[key] = True
+                    if len(self._incompressible) > MAX_INCOMPRESSIBLE:
+                        self._incompressible.popitem(last=False)
+                    return
+            # Only replace the generation we compressed: a refill since then
+            # has a head of its own (its Date, validators, ...).
+            current = self.cache.peek(key)
+            if current is None:
+                return
+            current.close()
+            ttl = expires - time.time()
+            if current.head != head or ttl <= 0:
+                return
+            self.cache.put(key, self._variant_head(head, hit.headers, len(packed))
+                           + b"\r\n\r\n" + packed, ttl)
+            with self._lock:
+                self.compressed += 1
+                self.bytes_out += len(packed)
+        except Exception as e:  # noqa: BLE001 - the identity entry still serves
+            logging.warning("Compressing cache entry failed: %s", e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    @staticmethod
+    def _variant_head(head, headers, length):
+        """The identity head rewritten for the gzip body. A strong ETag is
+        weakened: the bytes differ from the origin's representation.
+        """
+        status_line = head.split(b"\r\n", 1)[0].decode("iso-8859-1")
+        lines = [status_line]
+        for k, v in headers:
+            name = k.lower()
+            if name in ("content-length", "connection"):
+                continue
+            if name == "etag" and not v.startswith("W/"):
+                v = "W/" + v
+            lines.append(f"{k}: {v}")
+        lines += ["Content-Encoding: gzip", f"Content-Length: {length}",
+                  "Vary: Accept-Encoding", VARIANT_HEADER.decode("ascii"),
+                  "Connection: close"]
+        return "\r\n".join(lines).encode("iso-8859-1")
+
+    def select(self, hit, key, req_headers):
+        """Return the hit to send for `key`: a compressed entry as stored
+        (without its marker) to clients that accept gzip, decompressed to
+        others. An identity entry that could be compressed is queued.
+        """
+        if b"\r\n" + VARIANT_HEADER in hit.head:
+            if parse.accepts_encoding(req_headers, "gzip"):
+                hit.head = _drop_lines(hit.head, (b"x-proxy-gzip",))
+                with self._lock:
+                    self.served += 1
+                return hit
+            return self._identity(hit)
+        if not self.enabled or not self._wants_hit(key, hit):
+            return hit
+        if parse.accepts_encoding(req_headers, "gzip"):
+            self.submit(key)
+        hit.add_header("Vary", "Accept-Encoding")
+        return hit
+
+    def _wants_hit(self, key, hit):
+        """wants() for a cached entry, remembered per key and head so an
+        identity hit doesn't parse its headers every time.
+        """
+        tag = hash(hit.head)        # cached on the bytes object
+        known = self._decisions.get(key)
+        if known is not None and known[0] == tag:
+            return known[1]
+        wanted = self.wants(hit.status, hit.headers)
+        with self._lock:
+            self._decisions[key] = (tag, wanted)
+            if len(self._decisions) > MAX_DECISIONS:
+                self._decisions.popitem(last=False)
+        return wanted
+
+    def _identity(self, hit):
+        """A hit on a compressed entry, decompressed for a client that
+        doesn't take gzip.
+        """
+        tier, expires = hit.tier, hit.expires
+        body = gzip.decompress(_body(hit))
+        head = _drop_lines(hit.head, (b"content-encoding", b"content-length",
+                                      b"x-proxy-gzip", b"connection"))
+        head += b"\r\nContent-Length: %d\r\nConnection: close" % len(body)
+        with self._lock:
+            self.decoded += 1
+        return Hit.from_bytes(head + b"\r\n\r\n" + body, tier, expires)
+
+    def stats(self):
+        with self._lock:
+            return {"compressed": self.compressed, "skipped": self.skipped,
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "served": self.served, "decoded": self.decoded}
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        logging.info("Compression: %s", self.stats())
+
+
+def build_compressor(cfg, cache):
+    c = cfg["cache"]
+    return Compressor(cache, c["compress_level"], c["compress_min_bytes"],
+                      c["compress_workers"], enabled=c["compress"],
+                      max_bytes=c["compress_max_bytes"])
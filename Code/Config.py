@@ -9,22 +9,95 @@ import os
 DEFAULTS = {
     "listen_host": "127.0.0.1",
     "listen_port": 8080,
+    # "threads" = one pool worker per connection
+    # "asyncio" = single event loop, non-blocking sockets (see aio.py)
+    "server_mode": "threads",
+    # Processes: > 1 pre-forks that many workers sharing the port through
+    # SO_REUSEPORT, under a supervisor that restarts them (see prefork.py)
+    "workers": 1,
     "max_workers": 50,          # bounded thread pool instead of unbounded threads
     "client_timeout": 10,       # seconds to wait on the client socket
     "upstream_timeout": 15,     # seconds to wait on the origin server
+    "keepalive_timeout": 5,     # idle seconds between client requests (0 = off)
+    "max_keepalive_requests": 100,
     "max_header_bytes": 64 * 1024,
-    "max_body_bytes": 10 * 1024 * 1024,
+    "max_body_bytes": 10 * 1024 * 1024,  # largest upload accepted (0 = no limit)
     # "blacklist" = allow everything except listed hosts
     # "whitelist" = deny everything except listed hosts
     # "off"       = no filtering
     "filter_mode": "blacklist",
     "db_name": "proxy_logs.db",
+    "log_writer": {
+        "enabled": True,        # batch log rows on a background thread
+        "queue_size": 10000,    # rows waiting to be written, at most
+        "flush_interval": 0.5,  # seconds between batch commits
+        "batch_size": 500,
+        "overflow": "drop",     # queue full: "drop" the row, or "block" briefly
+        "block_timeout": 0.05,  # seconds a "block" caller waits for room
+    },
+    "dns": {
+        "enabled": True,        # cache getaddrinfo answers
+        "positive_ttl": 60,     # seconds a resolved address list is reused
+        "negative_ttl": 5,      # seconds a failed lookup is remembered
+        "max_entries": 1024,
+        "happy_eyeballs_delay": 0.25,  # stagger between parallel connects
+    },
+    "metrics": {                # Prometheus text at http://host:port/metrics
+        "enabled": True,
+        "listen_host": "127.0.0.1",
+        "listen_port": 9090,
+    },
+    "relay": {                  # CONNECT tunnels (threaded mode)
+        "threads": 1,           # event-loop threads shared by all tunnels
+        "buffer_bytes": 65536,  # per direction; a full buffer pauses reads
+        "idle_timeout": 300,    # seconds with no traffic either way
+        "splice": False,        # Linux: move bytes with os.splice
+    },
+    "upstream_pool": {
+        "enabled": True,        # reuse keep-alive connections to origins
+        "max_idle_per_host": 8,
+        "idle_timeout": 30,     # seconds an idle origin connection is kept
+    },
     "cache": {
-        "backend": "file",      # "file" or "memory"
+        # "file", "memory", "tiered" (memory over file) or "shared" (one
+        # mmap'd RAM cache for all worker processes, see cache.SharedCache)
+        "backend": "file",
         "dir": "cache_files",
+        # File tier storage: "files" (one per entry) or "segments" (appended
+        # to segment files under dir/segments, see cache.SegmentCache)
+        "file_layout": "files",
+        "segment_bytes": 64 * 1024 * 1024,
+        "compact_ratio": 0.5,   # rewrite a full segment once less is live
+        "compact_interval": 30,  # seconds between compaction passes
         "default_ttl": 60,      # used only when the origin gives no max-age
         "max_entries": 500,     # LRU eviction past this many objects
+        "max_bytes": 256 * 1024 * 1024,  # memory backend: total payload budget
+        "shards": 16,           # memory backend: independently locked segments
         "max_object_bytes": 5 * 1024 * 1024,
+        "coalesce_misses": True,  # concurrent misses for one key share a fetch
+        # Key normalisation: equivalent URLs share one entry
+        "normalize_urls": True,
+        "sort_query": True,
+        "drop_query_params": ["utm_*", "fbclid", "gclid"],
+        "lowercase_path": False,  # only for origins with case-blind paths
+        # Gzip variants of cached text responses (served per Accept-Encoding)
+        "compress": False,
+        "compress_level": 6,
+        "compress_min_bytes": 1024,
+        "compress_max_bytes": 1024 * 1024,  # decoded per identity hit, so bounded
+        "compress_workers": 2,
+        "revalidate": True,     # expired entries with ETag/Last-Modified -> 304 check
+        "stale_while_revalidate": True,  # honour the origin's stale-while-revalidate
+        "revalidate_workers": 4,  # background refreshes running at once
+        # "tiered" backend: limits for the in-memory L1 (L2 uses the above)
+        "l1_max_entries": 1000,
+        "l1_max_bytes": 64 * 1024 * 1024,
+        "l1_max_object_bytes": 256 * 1024,
+        # "shared" backend: file to map ("" = /dev/shm/proxy-cache-<port>),
+        # its data ring size and index capacity
+        "shm_path": "",
+        "shm_bytes": 256 * 1024 * 1024,
+        "shm_entries": 65536,
     },
 }
 
@@ -2,9 +2,123 @@
 
 Fixes the old logic where a host had to satisfy BOTH lists (which blocked
 everything by default). Now a single `mode` decides the policy.
+
+The lists are compiled into in-memory suffix tries (one per list type), so
+a check is a walk over the host's labels instead of a SQLite query. An
+entry matches:
+
+    example.com     that host only
+    *.example.com   any subdomain of example.com, not example.com itself
+    .example.com    example.com and all of its subdomains
+
+Every change to the `filters` table bumps `filter_version` (by trigger, so
+edits from the dashboard process count too). The proxy looks at the version
+at most once every RELOAD_CHECK_SECONDS and rebuilds the tries when it moved.
 """
+import logging
+import threading
+import time
+
 import logs
 
+RELOAD_CHECK_SECONDS = 1.0
+
+_EXACT = "\0exact"      # trie node flags; "\0" can't occur in a label
+_SUBDOMAINS = "\0sub"
+
+
+def normalize_address(address):
+    return address.strip().lower().rstrip(".")
+
+
+class SuffixTrie:
+    """Domain patterns keyed by reversed labels (com -> example -> www)."""
+
+    def __init__(self, patterns=()):
+        self.root = {}
+        self.size = 0
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        pattern = normalize_address(pattern)
+        if pattern.startswith("*."):
+            pattern, flags = pattern[2:], (_SUBDOMAINS,)
+        elif pattern.startswith("."):
+            pattern, flags = pattern[1:], (_EXACT, _SUBDOMAINS)
+        else:
+            flags = (_EXACT,)
+        if not pattern:
+            return
+        node = self.root
+        for label in reversed(pattern.split(".")):
+            node = node.setdefault(label, {})
+        for flag in flags:
+            node[flag] = True
+        self.size += 1
+
+    def matches(self, host):
+        node = self.root
+        labels = normalize_address(host).split(".")
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                return False
+            if depth == len(labels):
+                return _EXACT in node
+            if _SUBDOMAINS in node:
+                return True
+        return False
+
+
+class FilterLists:
+    """The compiled blacklist and whitelist, reloaded when the table changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lists = {"blacklist": SuffixTrie(), "whitelist": SuffixTrie()}
+        self._version = None
+        self._checked = 0.0
+
+    def get(self, list_type):
+        if (self._version is None
+                or time.monotonic() - self._checked >= RELOAD_CHECK_SECONDS):
+            self._maybe_reload()
+        return self._lists[list_type]
+
+    def invalidate(self):
+        """Check the table again on the next lookup (after a local edit)."""
+        self._checked = 0.0
+
+    def _maybe_reload(self):
+        # Until the first load there is nothing to fall back on (empty lists
+        # would let everything through, or block everything), so wait for it.
+        if not self._lock.acquire(blocking=self._version is None):
+            return                      # another thread is on it; use current
+        try:
+            if self._version is not None and (
+                    time.monotonic() - self._checked < RELOAD_CHECK_SECONDS):
+                return                  # loaded while we waited
+            self._checked = time.monotonic()
+            rows = logs.query("SELECT version FROM filter_version WHERE id = 1")
+            version = rows[0][0] if rows else 0
+            if version == self._version:
+                return
+            lists = {"blacklist": SuffixTrie(), "whitelist": SuffixTrie()}
+            for address, list_type in logs.query(
+                    "SELECT address, type FROM filters"):
+                lists[list_type].add(address)
+            self._lists = lists         # swap: readers see old or new, whole
+            self._version = version
+            logging.info("Filter lists loaded (version %s): %s blacklist, "
+                         "%s whitelist", version, lists["blacklist"].size,
+                         lists["whitelist"].size)
+        finally:
+            self._lock.release()
+
+
+_filters = FilterLists()
+
 
 def is_allowed(host, mode):
     mode = (mode or "blacklist").lower()
@@ -17,37 +131,40 @@ def is_allowed(host, mode):
 
 
 def _in_list(host, list_type):
-    rows = logs.query(
-        "SELECT 1 FROM filters WHERE address = ? AND type = ? LIMIT 1",
-        (host, list_type),
-    )
-    return len(rows) > 0
+    return _filters.get(list_type).matches(host)
 
 
 def add_to_filter_list(address, filter_type):
     logs.execute_with_retry(
         "INSERT OR IGNORE INTO filters (address, type) VALUES (?, ?)",
-        (address, filter_type),
+        (normalize_address(address), filter_type),
     )
+    _filters.invalidate()
 
 
 def remove_from_filter_list(address, filter_type):
+    # Rows added before addresses were normalised may be stored as typed.
     logs.execute_with_retry(
-        "DELETE FROM filters WHERE address = ? AND type = ?",
-        (address, filter_type),
+        "DELETE FROM filters WHERE rtrim(lower(trim(address)), '.') = ? "
+        "AND type = ?",
+        (normalize_address(address), filter_type),
     )
+    _filters.invalidate()
 
 
-def send_forbidden(client_socket):
+def forbidden_response():
     body = (b"<html><body><h1>403 Forbidden</h1>"
             b"<p>This host is blocked by the proxy.</p></body></html>")
-    response = (
+    return (
         b"HTTP/1.1 403 Forbidden\r\n"
         b"Content-Type: text/html\r\n"
         b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n"
         b"Connection: close\r\n\r\n" + body
     )
+
+
+def send_forbidden(client_socket):
     try:
-        client_socket.sendall(response)
+        client_socket.sendall(forbidden_response())
     except OSError:
-        pass
\ No newline at end of file
+        pass
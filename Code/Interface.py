@@ -46,6 +46,8 @@ elif option == "Manage Filters":
     st.dataframe(current if not current.empty else pd.DataFrame())
 
     domain = st.text_input(f"Domain to add/remove ({list_type})")
+    st.caption("`example.com` matches that host only, `*.example.com` its "
+               "subdomains, `.example.com` the domain and its subdomains.")
     col_add, col_remove = st.columns(2)
     if col_add.button("Add") and domain:
         filtering.add_to_filter_list(domain.strip(), list_type)
@@ -78,6 +80,15 @@ elif option == "Statistics":
     served = n_hits + n_misses
     c3.metric("Hit Rate", f"{(100 * n_hits / served):.1f}%" if served else "—")
 
+    tiers = df(
+        """SELECT COALESCE(cache_tier, 'unknown') AS tier, COUNT(*) AS hits
+           FROM responses WHERE cache_status = 'HIT'
+           GROUP BY tier ORDER BY hits DESC"""
+    )
+    if not tiers.empty:
+        st.subheader("Hits by cache tier")
+        st.dataframe(tiers)
+
     top = df(
         """SELECT target_host, COUNT(*) AS requests
            FROM requests GROUP BY target_host
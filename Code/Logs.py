@@ -3,15 +3,40 @@
 Keeps the original schema but adds: a read helper (`query`), a way to fill in
 the request's final status, an index on responses.request_id, and a proper
 docstring placement. WAL mode + retry handle concurrent writes from threads.
+
+The proxy itself logs through a background `LogWriter` (see start_writer):
+request ids are handed out in-process, and rows are queued and written in
+batches -- one transaction on one long-lived connection -- so a request
+never waits on SQLite. Without a started writer (the dashboard, scripts)
+every call writes synchronously as before. Pre-fork workers share the
+database, so each hands out only the ids congruent to its worker number
+modulo the number of workers.
 """
+import itertools
 import logging
+import queue
 import sqlite3
+import threading
 import time
 from datetime import datetime
 
 DB_NAME = "proxy_logs.db"
 MAX_RETRIES = 5
 RETRY_DELAY = 0.1  # seconds
+DROP_WARN_EVERY = 1000  # log a warning per this many dropped log rows
+_WAKE = object()        # queued by LogWriter.stop to end a wait for rows
+
+INSERT_REQUEST = """INSERT INTO requests
+    (id, timestamp, client_ip, client_port, target_host, target_port,
+     method, url, protocol, error_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+UPDATE_STATUS = "UPDATE requests SET status = ? WHERE id = ?"
+INSERT_RESPONSE = """INSERT INTO responses
+    (request_id, timestamp, cache_status, response_status,
+     response_content_type, response_size, response_time_ms, cache_tier)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+_writer = None
 
 
 def configure(db_name):
@@ -88,6 +113,7 @@ def init_db():
                 response_content_type TEXT,
                 response_size INTEGER,
                 response_time_ms INTEGER,
+                cache_tier TEXT,
                 FOREIGN KEY(request_id) REFERENCES requests(id)
             );
             CREATE TABLE IF NOT EXISTS filters (
@@ -99,41 +125,215 @@ def init_db():
                 ON responses(request_id);
             CREATE UNIQUE INDEX IF NOT EXISTS idx_filters_unique
                 ON filters(address, type);
+            -- Bumped on every filters change so the proxy knows to reload.
+            CREATE TABLE IF NOT EXISTS filter_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO filter_version (id, version) VALUES (1, 0);
+            CREATE TRIGGER IF NOT EXISTS filters_insert_version
+                AFTER INSERT ON filters BEGIN
+                UPDATE filter_version SET version = version + 1 WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS filters_delete_version
+                AFTER DELETE ON filters BEGIN
+                UPDATE filter_version SET version = version + 1 WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS filters_update_version
+                AFTER UPDATE ON filters BEGIN
+                UPDATE filter_version SET version = version + 1 WHERE id = 1;
+            END;
             """
         )
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(responses)")}
+        if "cache_tier" not in columns:  # databases created before tiering
+            cursor.execute("ALTER TABLE responses ADD COLUMN cache_tier TEXT")
         conn.commit()
         logging.info("Database initialized.")
     finally:
         conn.close()
 
 
+class LogWriter:
+    """Background thread that batches log rows into single transactions.
+
+    `submit` never waits on the database: rows go into a bounded queue that
+    the writer drains every `flush_interval` seconds (or as soon as
+    `batch_size` rows are waiting). Consecutive rows for the same statement
+    go through one `executemany`, and a whole batch is one commit. When the
+    queue is full, `overflow="drop"` discards the row and counts it, while
+    `"block"` waits up to `block_timeout` seconds for room first. A batch
+    the database rejects is logged and counted as dropped too.
+
+    Request ids are `offset` plus multiples of `stride`, so writers in
+    `stride` processes with distinct offsets never collide.
+    """
+
+    def __init__(self, db_name, queue_size=10000, flush_interval=0.5,
+                 batch_size=500, overflow="drop", block_timeout=0.05,
+                 offset=0, stride=1):
+        self.db_name = db_name
+        self.offset = offset
+        self.stride = stride
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.block = overflow == "block"
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._ids = None
+        self._id_lock = threading.Lock()    # also guards `dropped`
+        self._thread = threading.Thread(target=self._run, name="log-writer",
+                                        daemon=True)
+
+    def start(self):
+        """Reserve request ids after the highest one on disk, then run."""
+        conn = sqlite3.connect(self.db_name)
+        try:
+            last = conn.execute("SELECT MAX(id) FROM requests").fetchone()[0]
+        finally:
+            conn.close()
+        first = (last or 0) + 1
+        first += (self.offset - first) % self.stride
+        self._ids = itertools.count(first, self.stride)
+        self._thread.start()
+
+    def next_id(self):
+        with self._id_lock:
+            return next(self._ids)
+
+    def submit(self, sql, params):
+        try:
+            if self.block:
+                self._queue.put((sql, params), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((sql, params))
+        except queue.Full:
+            with self._id_lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped % DROP_WARN_EVERY == 1:
+                logging.warning("Log queue full; %s rows dropped so far",
+                                dropped)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        try:
+            while not self._stop.is_set() or not self._queue.empty():
+                batch = self._collect()
+                if batch:
+                    self._flush(conn, batch)
+        finally:
+            conn.close()
+
+    def _collect(self):
+        """Wait for the first row, then gather more until the flush
+        interval has passed or the batch is full.
+        """
+        try:
+            row = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        batch = [] if row is _WAKE else [row]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = 0 if self._stop.is_set() else deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    row = self._queue.get(timeout=remaining)
+                else:
+                    row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is _WAKE:
+                break
+            batch.append(row)
+        return batch
+
+    def _flush(self, conn, batch):
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                with conn:                  # one transaction per batch
+                    for sql, rows in itertools.groupby(batch, lambda r: r[0]):
+                        conn.executemany(sql, [params for _, params in rows])
+                self.written += len(batch)
+                return
+            except sqlite3.Error as e:
+                # Anything but a lock loses this batch, never the thread.
+                if "database is locked" not in str(e):
+                    logging.error("Log batch of %s rows failed: %s", len(batch), e)
+                    break
+                logging.warning("DB locked, retry %s/%s", attempt, MAX_RETRIES)
+                time.sleep(RETRY_DELAY)
+        else:
+            logging.error("Max retries reached; %s log rows lost.", len(batch))
+        with self._id_lock:
+            self.dropped += len(batch)
+
+    def stop(self):
+        """Write out everything queued so far and stop the thread."""
+        self._stop.set()
+        self._queue.put(_WAKE)          # don't wait out a flush interval
+        self._thread.join()
+        logging.info("Log writer: %s rows written, %s dropped",
+                     self.written, self.dropped)
+
+
+def start_writer(queue_size=10000, flush_interval=0.5, batch_size=500,
+                 overflow="drop", block_timeout=0.05, worker=0, workers=1):
+    """Route log_* calls through a background LogWriter (call after init_db).
+    `worker` of `workers` processes picks this process's share of ids.
+    """
+    global _writer
+    writer = LogWriter(DB_NAME, queue_size, flush_interval, batch_size,
+                       overflow, block_timeout, worker, workers)
+    writer.start()
+    _writer = writer
+
+
+def stop_writer():
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+
 def log_request(client_ip, client_port, target_host, target_port,
                 method, url, protocol, error_message=None):
-    return execute_with_retry(
-        """INSERT INTO requests
-           (timestamp, client_ip, client_port, target_host, target_port,
-            method, url, protocol, error_message)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (datetime.now(), client_ip, client_port, target_host, target_port,
-         method, url, protocol, error_message),
-    )
+    """Record a request and return its id."""
+    writer = _writer
+    if writer is None:
+        return execute_with_retry(
+            INSERT_REQUEST,
+            (None, datetime.now(), client_ip, client_port, target_host,
+             target_port, method, url, protocol, error_message))
+    request_id = writer.next_id()
+    writer.submit(INSERT_REQUEST,
+                  (request_id, datetime.now(), client_ip, client_port,
+                   target_host, target_port, method, url, protocol,
+                   error_message))
+    return request_id
+
+
+def _write(sql, params):
+    writer = _writer
+    if writer is None:
+        execute_with_retry(sql, params)
+    else:
+        writer.submit(sql, params)
 
 
 def update_request_status(request_id, status):
     if request_id is None:
         return
-    execute_with_retry(
-        "UPDATE requests SET status = ? WHERE id = ?", (status, request_id)
-    )
+    _write(UPDATE_STATUS, (status, request_id))
 
 
 def log_response(request_id, cache_status, response_status, content_type,
-                 response_size, response_time_ms):
-    execute_with_retry(
-        """INSERT INTO responses
-           (request_id, timestamp, cache_status, response_status,
-            response_content_type, response_size, response_time_ms)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (request_id, datetime.now(), cache_status, response_status,
-         content_type, response_size, int(response_time_ms)),
-    )
\ No newline at end of file
+                 response_size, response_time_ms, cache_tier=None):
+    """`cache_tier` names the cache tier that served a HIT ("memory"/"disk")."""
+    _write(INSERT_RESPONSE,
+           (request_id, datetime.now(), cache_status, response_status,
+            content_type, response_size, int(response_time_ms), cache_tier))
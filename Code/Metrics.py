@@ -0,0 +1,396 @@
+"""In-process counters and histograms, exposed in Prometheus text format.
+
+The request log in SQLite is for looking at individual requests; it is too
+slow to aggregate for monitoring. Metrics here are kept in memory and read
+over a small admin HTTP endpoint (GET /metrics) on `metrics.listen_port`.
+
+Recording takes no lock: each thread updates its own shard (a dict from
+label values to numbers), found through a threading.local. A scrape sums
+the shards. A thread registers its shard once, under a lock, and shards of
+threads that have exited are folded into a single retired shard then, so
+the list stays as long as the number of live threads.
+
+Values that already live elsewhere (cache size, tunnels open, ...) are
+read at scrape time by callbacks instead of being mirrored here.
+"""
+import bisect
+import http.server
+import logging
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Method label values; anything else is counted as OTHER so a client can't
+# create unbounded label sets.
+METHODS = {"GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS",
+           "TRACE", "CONNECT"}
+
+
+def method_label(method):
+    method = method.upper()
+    return method if method in METHODS else "OTHER"
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+class _Metric:
+    """A named metric whose values are split into per-thread shards."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []               # (thread, shard) for live threads
+        self._retired = {}              # merged shards of exited threads
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """Fold the shards of exited threads together. Caller holds _lock."""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def _merge(self, into, shard):
+        raise NotImplementedError
+
+    def values(self):
+        """Label values -> value, summed over all threads."""
+        with self._lock:
+            self._retire()
+            shards = [shard.copy() for _, shard in self._shards]
+            total = {}
+            self._merge(total, self._retired)
+        for shard in shards:
+            self._merge(total, shard)
+        return total
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} "
+                         f"{_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, into, shard):
+        for labels, value in shard.items():
+            into[labels] = into.get(labels, 0) + value
+
+
+class Gauge(Counter):
+    """Like a counter, but may go down: inc and dec can happen on
+    different threads; the shards still sum to the current value.
+    """
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets. A shard row is the count
+    per bucket (the last one is +Inf) followed by the sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        row = shard.get(labels)
+        if row is None:
+            row = shard[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def _merge(self, into, shard):
+        for labels, row in shard.items():
+            total = into.get(labels)
+            if total is None:
+                into[labels] = list(row)
+            else:
+                for i, value in enumerate(row):
+                    total[i] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+        for labels, row in sorted(self.values().items()):
+            cumulative = 0
+            for le, count in zip(bounds, row):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{_labels(self.labelnames, labels, [('le', le)])} "
+                             f"{cumulative}")
+            tag = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{tag} {_number(row[-1])}")
+            lines.append(f"{self.name}_count{tag} {cumulative}")
+        return lines
+
+
+class Callback:
+    """A value read at scrape time: `fn()` returns a number, or a dict of
+    label-value tuples -> number.
+    """
+
+    def __init__(self, name, help, kind, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        try:
+            values = self.fn()
+        except Exception as e:  # noqa: BLE001 - a bad source mustn't break /metrics
+            logging.warning("Metric %s unavailable: %s", self.name, e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} "
+                         f"{_number(value)}")
+        return lines
+
+
+class Registry:
+    """Metrics by name, in registration order; registering a name again
+    replaces the old metric.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, kind, fn, labelnames=()):
+        return self.add(Callback(name, help, kind, fn, labelnames))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "proxy_requests_total", "Requests answered, by method and status.",
+    ("method", "status"))
+CACHE_RESULTS = REGISTRY.counter(
+    "proxy_cache_results_total",
+    "HTTP responses served from the cache (HIT) or the origin (MISS).",
+    ("result",))
+RECEIVED_BYTES = REGISTRY.counter(
+    "proxy_client_received_bytes_total",
+    "Request bytes read from clients, heads and bodies.")
+SENT_BYTES = REGISTRY.counter(
+    "proxy_client_sent_bytes_total",
+    "Response bytes sent to clients (tunnels not included).")
+REQUEST_SECONDS = REGISTRY.histogram(
+    "proxy_request_duration_seconds",
+    "Time from a request head arriving to the response being sent.")
+UPSTREAM_CONNECT_SECONDS = REGISTRY.histogram(
+    "proxy_upstream_connect_seconds",
+    "Time to open a new origin connection, DNS included.")
+UPSTREAM_FIRST_BYTE_SECONDS = REGISTRY.histogram(
+    "proxy_upstream_first_byte_seconds",
+    "Time from a request being sent upstream to the origin's response.")
+CACHE_EVICTIONS = REGISTRY.counter(
+    "proxy_cache_evictions_total",
+    "Entries dropped to stay within the cache limits, by tier.", ("tier",))
+WORKERS_QUEUED = REGISTRY.gauge(
+    "proxy_worker_queue_depth",
+    "Accepted connections waiting for a free worker (threaded mode).")
+WORKERS_BUSY = REGISTRY.gauge(
+    "proxy_workers_busy", "Workers serving a connection (threaded mode).")
+
+
+def record_response(method, cache_status, status, sent):
+    """Count one answered request. `cache_status` is "HIT" or "MISS", or
+    None for answers that don't involve the cache (403, CONNECT).
+    """
+    REQUESTS.inc(method_label(method), str(status or 0))
+    if cache_status is not None:
+        CACHE_RESULTS.inc(cache_status)
+    SENT_BYTES.inc(amount=sent)
+
+
+def watch_cache(cache, registry=REGISTRY):
+    """Report the size of `cache` (any backend) per tier at scrape time."""
+    registry.callback(
+        "proxy_cache_entries", "Objects in the cache, by tier.", "gauge",
+        lambda: {(tier,): s["entries"] for tier, s in cache.usage().items()},
+        ("tier",))
+    registry.callback(
+        "proxy_cache_bytes", "Bytes stored in the cache, by tier.", "gauge",
+        lambda: {(tier,): s["bytes"] for tier, s in cache.usage().items()},
+        ("tier",))
+
+
+def watch_relay(relay, registry=REGISTRY):
+    registry.callback("proxy_tunnels_active", "CONNECT tunnels open.",
+                      "gauge", lambda: relay.stats()["active"])
+    registry.callback("proxy_tunnel_bytes_total",
+                      "Bytes relayed by closed CONNECT tunnels.", "counter",
+                      lambda: relay.stats()["bytes"])
+
+
+def watch_coalescer(flights, registry=REGISTRY):
+    """Report miss coalescing (see coalesce.Coalescer) at scrape time."""
+    registry.callback("proxy_coalesce_leaders_total",
+                      "Misses fetched upstream with a flight open for others.",
+                      "counter", lambda: flights.stats()["leaders"])
+    registry.callback("proxy_coalesce_saved_fetches_total",
+                      "Upstream fetches avoided by following another miss.",
+                      "counter", lambda: flights.stats()["coalesced"])
+    registry.callback("proxy_coalesce_fallbacks_total",
+                      "Followers that fetched on their own: the leader's "
+                      "response wasn't shareable.",
+                      "counter", lambda: flights.stats()["fallbacks"])
+    registry.callback("proxy_coalesce_in_flight", "Misses being fetched now.",
+                      "gauge", lambda: flights.stats()["in_flight"])
+
+
+def watch_resolver(dns, registry=REGISTRY):
+    """Report the DNS cache and connects (see resolver.Resolver) at scrape
+    time.
+    """
+    registry.callback(
+        "proxy_dns_lookups_total",
+        "Host lookups: answered from the cache (hit), by a cached failure "
+        "(negative_hit), or by getaddrinfo (miss).", "counter",
+        lambda: {(result,): dns.stats()[field] for result, field in (
+            ("hit", "hits"), ("negative_hit", "negative_hits"),
+            ("miss", "misses"))},
+        ("result",))
+    registry.callback("proxy_dns_resolve_seconds_total",
+                      "Time spent in getaddrinfo.", "counter",
+                      lambda: dns.resolve_seconds)
+    registry.callback("proxy_dns_cache_entries", "Hosts in the DNS cache.",
+                      "gauge", lambda: dns.stats()["entries"])
+    registry.callback("proxy_upstream_connects_total",
+                      "Origin connections opened by the resolver.", "counter",
+                      lambda: dns.stats()["connects"])
+    registry.callback("proxy_upstream_connect_fallbacks_total",
+                      "Origin connections won by an address other than the "
+                      "first.", "counter", lambda: dns.stats()["fallbacks"])
+
+
+class _AdminHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("admin: " + format, *args)
+
+
+class AdminServer(http.server.ThreadingHTTPServer):
+    """Serves GET /metrics on a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, host, port, registry=REGISTRY):
+        super().__init__((host, port), _AdminHandler)
+        self.registry = registry
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="metrics-admin", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info("Metrics on http://%s:%s/metrics", *self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def start_admin(cfg, worker=0):
+    """Start the admin endpoint if enabled; None if off or the port is
+    taken (the proxy runs without it rather than not at all). Pre-fork
+    worker number `worker` listens on `listen_port` + `worker`.
+    """
+    m = cfg["metrics"]
+    if not m["enabled"]:
+        return None
+    try:
+        admin = AdminServer(m["listen_host"], m["listen_port"] + worker)
+    except OSError as e:
+        logging.warning("Metrics endpoint not started: %s", e)
+        return None
+    admin.start()
+    return admin
@@ -6,6 +6,8 @@ opaque bytes, which fixes the old UnicodeDecodeError on images/gzip.
 """
 from urllib.parse import urlsplit
 
+MAX_CHUNK_LINE = 8192   # longest chunk-size or trailer line accepted
+
 # Headers that must not be forwarded by a proxy (RFC 7230 sec 6.1).
 HOP_BY_HOP = {
     "connection", "proxy-connection", "keep-alive", "proxy-authorization",
@@ -23,24 +25,53 @@ def parse_request_line(head: bytes):
     return parts[0], parts[1], parts[2]
 
 
-def parse_headers(head: bytes):
+class Headers(list):
+    """A parsed (name, value) list plus a case-insensitive index of it.
+
+    Still a plain list to everything that iterates it, but `get_header` and
+    `get_all_headers` answer from a dict built once at parse time instead
+    of lower-casing every name on every lookup. Treat it as read-only: the
+    index is not updated if the list is changed.
+    """
+
+    __slots__ = ("_index",)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        index = {}
+        for k, v in self:
+            index.setdefault(k.lower(), []).append(v)
+        self._index = index
+
+    def get(self, name, default=None):
+        values = self._index.get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name):
+        return list(self._index.get(name.lower(), ()))
+
+
+def parse_headers(head):
     """Parse header lines into an ordered list of (name, value) tuples.
 
     A list (not a dict) preserves duplicates like multiple Cookie/Set-Cookie
-    headers. The leading request/status line is skipped.
+    headers. The leading request/status line is skipped. `head` may be
+    bytes, a bytearray or a memoryview.
     """
-    text = head.decode("iso-8859-1", errors="replace")
+    text = str(head, "iso-8859-1")
     headers = []
     for line in text.split("\r\n")[1:]:
         if not line or ":" not in line:
             continue
         name, _, value = line.partition(":")
         headers.append((name.strip(), value.strip()))
-    return headers
+    return Headers(headers)
 
 
 def get_header(headers, name, default=None):
     """Case-insensitive lookup over a (name, value) list."""
+    if type(headers) is Headers:
+        return headers.get(name, default)
     name = name.lower()
     for k, v in headers:
         if k.lower() == name:
@@ -48,6 +79,80 @@ def get_header(headers, name, default=None):
     return default
 
 
+def get_all_headers(headers, name):
+    """All values of a (possibly repeated) header, in order."""
+    if type(headers) is Headers:
+        return headers.get_all(name)
+    name = name.lower()
+    return [v for k, v in headers if k.lower() == name]
+
+
+class HeadParser:
+    """Incremental reader of one message head (request or response).
+
+    Bytes are appended to a single bytearray as they arrive; the search for
+    the blank line resumes where the previous one stopped instead of
+    rescanning the buffer, so reading a head in many small pieces stays
+    linear. Once `feed` returns True, `head`, `headers` and `rest` (the
+    bytes after the blank line, as a memoryview) are available.
+    """
+
+    def __init__(self, max_header, data=b""):
+        self.max_header = max_header
+        self.buf = bytearray(data)
+        self.end = -1               # offset of the terminating CRLFCRLF
+        self._scan = 0
+        self._headers = None
+        if data:
+            self._locate()
+
+    def feed(self, data):
+        """Append received bytes; True once the head is complete.
+        Raises ValueError if the head outgrows `max_header`.
+        """
+        if self.end < 0:
+            self.buf += data
+            self._locate()
+        return self.end >= 0
+
+    @property
+    def complete(self):
+        return self.end >= 0
+
+    def _locate(self):
+        end = self.buf.find(b"\r\n\r\n", self._scan)
+        if end < 0:
+            self._scan = max(0, len(self.buf) - 3)
+            if len(self.buf) > self.max_header:
+                raise ValueError("Header block too large")
+        elif end > self.max_header:
+            raise ValueError("Header block too large")
+        else:
+            self.end = end
+
+    @property
+    def head(self):
+        """The head without its blank line (everything buffered at EOF)."""
+        return bytes(self.buf[:self.end] if self.end >= 0 else self.buf)
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            view = memoryview(self.buf)
+            self._headers = parse_headers(
+                view[:self.end] if self.end >= 0 else view)
+        return self._headers
+
+    @property
+    def rest(self):
+        """Bytes received past the head: the start of the body, or of the
+        next pipelined message.
+        """
+        if self.end < 0:
+            return memoryview(b"")
+        return memoryview(self.buf)[self.end + 4:]
+
+
 def resolve_target(method, target, headers, default_port=80):
     """Work out (host, port, origin_form_path) for any proxy request form.
 
@@ -78,24 +183,295 @@ def resolve_target(method, target, headers, default_port=80):
     return host, port, path
 
 
+def wants_keep_alive(version, headers):
+    """Whether the client wants its connection kept open after this request.
+
+    HTTP/1.1 is persistent unless it says `close`; HTTP/1.0 must opt in.
+    Browsers talking to a proxy often use Proxy-Connection for this.
+    """
+    tokens = ",".join(v for k, v in headers
+                      if k.lower() in ("connection", "proxy-connection")).lower()
+    if "close" in tokens:
+        return False
+    if version.upper() == "HTTP/1.1":
+        return True
+    return "keep-alive" in tokens
+
+
+def expects_continue(headers):
+    """Whether the client waits for `100 Continue` before sending its body."""
+    return (get_header(headers, "expect") or "").strip().lower() == "100-continue"
+
+
+def body_framing(method, status, headers):
+    """How a response body is delimited: ("none", 0), ("length", n),
+    ("chunked", None) or ("close", None) when it runs until EOF.
+    """
+    if method.upper() == "HEAD" or status in (204, 304) or (
+            status is not None and 100 <= status < 200):
+        return "none", 0
+    te = (get_header(headers, "transfer-encoding", "") or "").lower()
+    if "chunked" in te:
+        return "chunked", None
+    content_length = get_header(headers, "content-length")
+    if content_length is not None:
+        try:
+            return "length", int(content_length)
+        except ValueError:
+            pass
+    return "close", None
+
+
+def request_body_framing(headers):
+    """How a request body is delimited: ("chunked", None), ("length", n)
+    or ("none", 0). Raises ValueError for framing we can't follow.
+    """
+    te = get_header(headers, "transfer-encoding")
+    if te is not None:
+        if te.strip().lower() != "chunked":
+            raise ValueError(f"Unsupported request Transfer-Encoding: {te}")
+        return "chunked", None
+    content_length = get_header(headers, "content-length")
+    if content_length is None:
+        return "none", 0
+    try:
+        length = int(content_length)
+    except ValueError:
+        raise ValueError(f"Bad request Content-Length: {content_length!r}")
+    if length < 0:
+        raise ValueError(f"Bad request Content-Length: {content_length!r}")
+    return ("length", length) if length else ("none", 0)
+
+
+class ChunkedScanner:
+    """Follows `Transfer-Encoding: chunked` framing in a byte stream
+    without decoding it, so the body can be passed on as it arrives.
+
+    `feed(data)` returns how many leading bytes of `data` belong to the
+    body; once `done` is set, the rest of `data` is past its end (the
+    next pipelined message).
+    """
+
+    def __init__(self):
+        self.done = False
+        self.size = 0               # decoded payload bytes seen
+        self._remaining = 0         # chunk data (+ CRLF) still to pass
+        self._line = b""            # partial size or trailer line
+        self._trailer = False
+
+    def feed(self, data):
+        pos, end = 0, len(data)
+        while pos < end and not self.done:
+            if self._remaining:
+                take = min(self._remaining, end - pos)
+                pos += take
+                self._remaining -= take
+                continue
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                self._line += data[pos:]
+                if len(self._line) > MAX_CHUNK_LINE:
+                    raise ValueError("Chunk line too long")
+                return end
+            line = self._line + data[pos:nl]
+            self._line = b""
+            pos = nl + 1
+            if self._trailer:
+                self.done = not line.strip()
+                continue
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise ValueError(f"Bad chunk size line: {line[:40]!r}")
+            if size == 0:
+                self._trailer = True
+            else:
+                self._remaining = size + 2
+                self.size += size
+        return pos
+
+
 def _host_header_value(host, port):
     return host if port in (80, 443) else f"{host}:{port}"
 
 
-def build_forward_request(method, path, version, headers, body, host, port):
+def build_forward_request(method, path, version, headers, body, host, port,
+                          keep_alive=False, chunked=False):
     """Rebuild an origin-form request: strip hop-by-hop headers, normalise
-    Host, and force `Connection: close` so the upstream read loop terminates.
+    Host, and set our own Connection header. `Connection: close` (the
+    default) makes the origin end the response with EOF; `keep_alive` is for
+    pooled connections whose responses are framed by length. `chunked`
+    says the body follows (streamed separately) in chunked framing; a
+    Content-Length sent alongside is dropped, since chunked framing wins
+    (RFC 7230 3.3.3) and an origin that read both could be smuggled a
+    request.
     """
+    drop = {"host", "content-length"} if chunked else {"host"}
     kept = [(k, v) for (k, v) in headers
-            if k.lower() not in HOP_BY_HOP and k.lower() != "host"]
+            if k.lower() not in HOP_BY_HOP and k.lower() not in drop]
     lines = [f"{method} {path} {version}",
              f"Host: {_host_header_value(host, port)}"]
     lines += [f"{k}: {v}" for k, v in kept]
-    lines.append("Connection: close")
+    if chunked:
+        lines.append("Transfer-Encoding: chunked")
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
     head = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
     return head + body
 
 
+def parse_cache_control(value):
+    """Split a Cache-Control value into {directive: argument-or-None}.
+    Directive names are lower-cased; quoted arguments are unquoted.
+    """
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"') if arg else None
+    return directives
+
+
+def validators(headers):
+    """Return the (ETag, Last-Modified) a response can be revalidated with."""
+    return get_header(headers, "etag"), get_header(headers, "last-modified")
+
+
+def with_validators(request: bytes, etag, last_modified):
+    """Turn a built forward request into a conditional one for a cached copy.
+
+    Any conditional headers from the client are replaced by ours: the answer
+    is for the cache, which then serves the client from the stored response.
+    """
+    head, _, body = request.partition(b"\r\n\r\n")
+    lines = [line for line in head.split(b"\r\n")
+             if line.split(b":", 1)[0].strip().lower()
+             not in (b"if-none-match", b"if-modified-since")]
+    if etag:
+        lines.append(b"If-None-Match: " + etag.encode("iso-8859-1"))
+    if last_modified:
+        lines.append(b"If-Modified-Since: " + last_modified.encode("iso-8859-1"))
+    return b"\r\n".join(lines) + b"\r\n\r\n" + body
+
+
+def accepts_encoding(headers, coding):
+    """Whether Accept-Encoding allows `coding` (by name or `*`, with q > 0)."""
+    allowed = None
+    for value in get_all_headers(headers, "accept-encoding"):
+        for item in value.split(","):
+            name, _, params = item.partition(";")
+            name = name.strip().lower()
+            if name not in (coding, "*"):
+                continue
+            q = 1.0
+            for param in params.split(";"):
+                k, _, v = param.partition("=")
+                if k.strip().lower() == "q":
+                    try:
+                        q = float(v)
+                    except ValueError:
+                        q = 0.0
+            if name == coding:
+                return q > 0
+            allowed = q > 0
+    return bool(allowed)
+
+
+def parse_range(value, size, max_ranges=16):
+    """Resolve a `Range: bytes=...` header against a body of `size` bytes.
+
+    Returns a list of (start, length) slices, [] if no range is satisfiable
+    (answer 416), or None if the header should be ignored and the whole body
+    sent: not a bytes range, malformed, or more than `max_ranges` parts.
+    Overlapping and adjacent ranges are merged (in offset order), so no byte
+    is sent twice however the ranges are written.
+    """
+    unit, _, spec = (value or "").partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    parts = [p.strip() for p in spec.split(",") if p.strip()]
+    if len(parts) > max_ranges:
+        return None
+    ranges = []
+    for part in parts:
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        try:
+            if not first:                   # suffix: the last N bytes
+                n = int(last)
+                if n < 0:
+                    return None
+                if n and size:
+                    ranges.append((max(0, size - n), min(n, size)))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < size:
+            end = size - 1 if end is None else min(end, size - 1)
+            ranges.append((start, end - start + 1))
+    merged = []
+    for start, length in sorted(ranges):
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            first, n = merged[-1]
+            merged[-1] = (first, max(n, start + length - first))
+        else:
+            merged.append((start, length))
+    return merged
+
+
+def rebuild_response_head(head: bytes, connection="close"):
+    """Re-emit an origin response header block for the client.
+
+    Connection-scoped headers (Connection, Keep-Alive and anything the
+    Connection header names) describe the proxy<->origin hop only, so they
+    are replaced by our own `Connection` value. Transfer-Encoding is kept:
+    bodies are relayed with their chunk framing intact.
+    """
+    text = head.decode("iso-8859-1", errors="replace")
+    status_line = text.split("\r\n", 1)[0]
+    headers = parse_headers(head)
+    drop = {"connection", "keep-alive", "proxy-connection"}
+    for token in (get_header(headers, "connection", "") or "").split(","):
+        drop.add(token.strip().lower())
+    lines = [status_line]
+    lines += [f"{k}: {v}" for k, v in headers if k.lower() not in drop]
+    lines.append(f"Connection: {connection}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+def is_rebuilt_head(head: bytes):
+    """True if `head` (without its blank line) is already in the form
+    rebuild_response_head gives: no hop-by-hop header but one final
+    `Connection: close` or `Connection: keep-alive` line. A raw origin head
+    can end that way too, so the rest is checked, though without parsing.
+    """
+    cut = head.rfind(b"\r\n")
+    if cut < 0 or head[cut + 2:] not in (b"Connection: close",
+                                         b"Connection: keep-alive"):
+        return False
+    lower = head.lower()
+    return (lower.count(b"\r\nconnection:") == 1
+            and b"\r\nkeep-alive:" not in lower
+            and b"\r\nproxy-connection:" not in lower)
+
+
+def with_connection(head: bytes, connection="close"):
+    """Client header block for a stored head: when rebuild_response_head
+    produced it (see is_rebuilt_head), only its final Connection line is
+    swapped. Any other head -- e.g. one stored raw by an older version --
+    is rebuilt in full.
+    """
+    if is_rebuilt_head(head):
+        return (head[:head.rfind(b"\r\n")] + b"\r\nConnection: "
+                + connection.encode("ascii") + b"\r\n\r\n")
+    return rebuild_response_head(head, connection)
+
+
 def parse_response_status(head: bytes):
     """Pull the numeric status code out of a response header block, or None."""
     try:
@@ -0,0 +1,122 @@
+"""Pre-fork worker processes.
+
+One process runs all parsing, header rewriting and hashing under one GIL,
+whatever `max_workers` is. With `"workers": N` (N > 1) the proxy forks N
+worker processes instead; each opens its own listening socket with
+SO_REUSEPORT, so the kernel spreads incoming connections across them, and
+runs the ordinary accept loop (threads or asyncio).
+
+The parent only supervises: a worker that exits on its own (a crash, a
+kill) is started again after RESTART_DELAY seconds, doubling up to
+MAX_RESTART_DELAY while it keeps dying young. Ctrl+C or SIGTERM to the
+parent stops every worker with SIGTERM, so each writes out its queued log
+rows, and waits for them. Workers ignore SIGINT: Ctrl+C signals the whole
+process group, and the supervisor's SIGTERM is their one stop signal.
+
+State shared through the filesystem stays consistent between workers: the
+file cache directory (see FileCache `shared`), the filter lists (reloaded
+from SQLite by version) and the request log (ids split per worker, see
+logs.LogWriter). Memory caches, connection pools and metrics are per
+worker; each worker serves metrics on `metrics.listen_port` + its number.
+"""
+import logging
+import os
+import signal
+import socket
+import time
+
+RESTART_DELAY = 1.0         # seconds before restarting a dead worker
+MAX_RESTART_DELAY = 30.0
+HEALTHY_UPTIME = 10.0       # a worker that lived this long resets the backoff
+STOP_TIMEOUT = 15.0         # seconds to wait for workers before SIGKILL
+
+
+def available():
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+class Supervisor:
+    """Forks `workers` processes running `target(worker_number)` and keeps
+    them running until stopped.
+    """
+
+    def __init__(self, workers, target):
+        self.workers = workers
+        self.target = target
+        self.children = {}                  # pid -> worker number
+        self.started = {}                   # worker number -> monotonic time
+        self.delay = {}                     # worker number -> next backoff
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:                        # the worker
+            # Ctrl+C reaches the whole process group; the worker waits for
+            # the supervisor's SIGTERM so it stops exactly once.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                self.target(number)
+            except BaseException:           # noqa: BLE001 - report, then exit
+                logging.exception("Worker %s failed", number)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = number
+        self.started[number] = time.monotonic()
+        logging.info("Started worker %s (pid %s)", number, pid)
+
+    def run(self):
+        try:
+            for number in range(self.workers):
+                self.spawn(number)
+            while True:
+                pid, status = os.wait()
+                number = self.children.pop(pid, None)
+                if number is None:
+                    continue
+                self._restart(number, pid, status)
+        except KeyboardInterrupt:
+            logging.info("Stopping %s workers.", len(self.children))
+        finally:
+            self.stop()
+
+    def _restart(self, number, pid, status):
+        code = os.waitstatus_to_exitcode(status)
+        uptime = time.monotonic() - self.started[number]
+        if uptime >= HEALTHY_UPTIME:
+            delay = RESTART_DELAY
+        else:
+            delay = self.delay.get(number, RESTART_DELAY)
+        self.delay[number] = min(delay * 2, MAX_RESTART_DELAY)
+        logging.warning("Worker %s (pid %s) exited with %s after %.1fs; "
+                        "restarting in %.0fs", number, pid, code, uptime, delay)
+        time.sleep(delay)
+        self.spawn(number)
+
+    def stop(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_IGN)      # let the workers finish
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.children:
+            logging.warning("Worker pid %s did not stop; killing it", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.children.clear()
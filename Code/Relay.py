@@ -0,0 +1,329 @@
+"""Event-driven relay for CONNECT tunnels.
+
+A tunnel used to pin a pool worker for its whole life, blocking in its own
+select loop (and calling sendall on a non-blocking socket, which fails when
+the peer is slow). Established tunnels are now handed to a Relay: a few
+threads, each multiplexing many tunnels on one selector.
+
+Each direction of a tunnel has a bounded buffer. A socket is only polled
+for reading while the buffer it fills has room, and for writing while the
+buffer it drains has data, so a slow receiver throttles its sender instead
+of growing memory. EOF from one side is passed on as a half-close
+(shutdown(SHUT_WR)) once that direction's buffer is flushed; the tunnel
+ends when both directions are done, on an error, or after `idle_timeout`
+seconds without traffic either way.
+
+With `use_splice` (Linux), bytes move socket -> pipe -> socket with
+os.splice and never enter Python; the pipe is the direction's buffer, sized
+to `buffer_size` where the kernel allows and never assumed to be larger
+than it is.
+"""
+import fcntl
+import itertools
+import logging
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+
+SWEEP_INTERVAL = 1.0        # seconds between idle-tunnel sweeps
+PIPE_SIZE = 65536           # Linux's default, if the pipe can't be asked
+
+_SPLICE_FLAGS = (getattr(os, "SPLICE_F_MOVE", 0)
+                 | getattr(os, "SPLICE_F_NONBLOCK", 0))
+
+
+def splice_available():
+    return hasattr(os, "splice")
+
+
+def _size_pipe(fd, size):
+    """Ask for a `size`-byte pipe buffer; return the size it really has
+    (the kernel rounds up to pages and caps unprivileged requests).
+    """
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError):
+        pass
+    try:
+        return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+    except (AttributeError, OSError):
+        return PIPE_SIZE
+
+
+class _Direction:
+    """Bytes flowing from `src` to `dst`, at most `limit` of them buffered.
+    A splice pipe smaller than the limit lowers it: asking splice for more
+    than the pipe holds would fail with EAGAIN while src stays readable.
+    """
+
+    __slots__ = ("src", "dst", "limit", "buf", "pipe", "pending", "eof", "shut")
+
+    def __init__(self, src, dst, limit, initial=b"", splice=False):
+        self.src = src
+        self.dst = dst
+        self.limit = limit
+        self.buf = bytearray(initial)
+        self.pipe = None
+        if splice and not initial:
+            r, w = os.pipe()
+            os.set_blocking(r, False)
+            os.set_blocking(w, False)
+            self.pipe = (r, w)
+            self.limit = min(limit, _size_pipe(w, limit))
+        self.pending = len(self.buf)    # bytes read but not yet written
+        self.eof = False                # src sent FIN
+        self.shut = False               # FIN passed on to dst
+
+    def read(self):
+        """Move what src has (up to the buffer limit) into the buffer."""
+        room = self.limit - self.pending
+        if self.pipe is not None:
+            n = os.splice(self.src.fileno(), self.pipe[1], room,
+                          flags=_SPLICE_FLAGS)
+        else:
+            data = self.src.recv(room)
+            self.buf += data
+            n = len(data)
+        if n == 0:
+            self.eof = True
+        self.pending += n
+        return n
+
+    def write(self):
+        """Send as much of the buffer as dst takes without blocking; pass
+        the FIN on once src has closed and the buffer is empty.
+        """
+        n = 0
+        if not self.pending:
+            pass
+        elif self.pipe is not None:
+            n = os.splice(self.pipe[0], self.dst.fileno(), self.pending,
+                          flags=_SPLICE_FLAGS)
+        else:
+            n = self.dst.send(self.buf)
+            del self.buf[:n]
+        self.pending -= n
+        if self.eof and not self.pending and not self.shut:
+            self.dst.shutdown(socket.SHUT_WR)
+            self.shut = True
+        return n
+
+    @property
+    def done(self):
+        return self.shut
+
+    def close(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+
+class _Tunnel:
+    __slots__ = ("client", "upstream", "up", "down", "last_active", "bytes")
+
+    def __init__(self, client, upstream, initial, splice, limit):
+        self.client = client
+        self.upstream = upstream
+        self.up = _Direction(client, upstream, limit, initial, splice)
+        self.down = _Direction(upstream, client, limit, b"", splice)
+        self.last_active = time.monotonic()
+        self.bytes = 0
+
+    def directions(self):
+        return self.up, self.down
+
+
+class _Loop(threading.Thread):
+    """One selector thread and the tunnels assigned to it."""
+
+    def __init__(self, relay, name):
+        super().__init__(name=name, daemon=True)
+        self.relay = relay
+        self.sel = selectors.DefaultSelector()
+        self.tunnels = set()
+        self.incoming = queue.SimpleQueue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self.stopping = False
+
+    def submit(self, tunnel):
+        self.incoming.put(tunnel)
+        self.wake()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass                        # already pending a wake-up
+
+    def run(self):
+        last_sweep = time.monotonic()
+        try:
+            while not self.stopping:
+                for key, events in self.sel.select(SWEEP_INTERVAL):
+                    if key.data is None:
+                        self._drain_wakeups()
+                    else:
+                        self._service(key.data, key.fileobj, events)
+                now = time.monotonic()
+                if now - last_sweep >= SWEEP_INTERVAL:
+                    last_sweep = now
+                    self._sweep(now)
+        finally:
+            for tunnel in list(self.tunnels):
+                self._close(tunnel)
+            self.sel.close()
+            self._wake_r.close()
+            self._wake_w.close()
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while True:
+            try:
+                tunnel = self.incoming.get_nowait()
+            except queue.Empty:
+                break
+            self.tunnels.add(tunnel)
+            self._update(tunnel)
+
+    def _interest(self, tunnel, sock):
+        mask = 0
+        for d in tunnel.directions():
+            if d.src is sock and not d.eof and d.pending < d.limit:
+                mask |= selectors.EVENT_READ
+            if d.dst is sock and d.pending:
+                mask |= selectors.EVENT_WRITE
+        return mask
+
+    def _update(self, tunnel):
+        """Re-register both sockets for what their buffers allow, and
+        finish the tunnel once both directions have been half-closed.
+        """
+        if tunnel.up.done and tunnel.down.done:
+            self._close(tunnel)
+            return
+        for sock in (tunnel.client, tunnel.upstream):
+            mask = self._interest(tunnel, sock)
+            try:
+                registered = self.sel.get_key(sock).events
+            except KeyError:
+                registered = 0
+            if mask == registered:
+                continue
+            if not mask:
+                self.sel.unregister(sock)
+            elif not registered:
+                self.sel.register(sock, mask, tunnel)
+            else:
+                self.sel.modify(sock, mask, tunnel)
+
+    def _service(self, tunnel, sock, events):
+        received = sent = 0
+        try:
+            for d in tunnel.directions():
+                if events & selectors.EVENT_READ and d.src is sock:
+                    if not d.eof and d.pending < d.limit:
+                        received += d.read()
+                        sent += d.write()       # optimistic: usually succeeds
+                if events & selectors.EVENT_WRITE and d.dst is sock and d.pending:
+                    sent += d.write()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            logging.debug("Tunnel closed: %s", e)
+            self._close(tunnel)
+            return
+        finally:
+            if received or sent:
+                tunnel.last_active = time.monotonic()
+                tunnel.bytes += sent
+        self._update(tunnel)
+
+    def _sweep(self, now):
+        for tunnel in list(self.tunnels):
+            if now - tunnel.last_active > self.relay.idle_timeout:
+                self._close(tunnel)
+
+    def _close(self, tunnel):
+        if tunnel not in self.tunnels:
+            return
+        self.tunnels.discard(tunnel)
+        for sock in (tunnel.client, tunnel.upstream):
+            try:
+                self.sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+        for d in tunnel.directions():
+            d.close()
+        self.relay._finished(tunnel)
+
+
+class Relay:
+    """Owns established tunnels after the CONNECT handshake."""
+
+    def __init__(self, threads=1, buffer_size=65536, idle_timeout=300,
+                 use_splice=False):
+        self.buffer_size = buffer_size
+        self.idle_timeout = idle_timeout
+        self.splice = use_splice and splice_available()
+        self._loops = [_Loop(self, f"relay-{i}") for i in range(max(1, threads))]
+        self._next = itertools.cycle(self._loops)
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.bytes = 0
+
+    def start(self):
+        for loop in self._loops:
+            loop.start()
+
+    def add(self, client, upstream, initial=b""):
+        """Take ownership of a connected tunnel: both sockets are closed by
+        the relay when it ends. `initial` is client data that arrived with
+        the CONNECT request and is sent upstream first.
+        """
+        for sock in (client, upstream):
+            sock.setblocking(False)
+        tunnel = _Tunnel(client, upstream, initial, self.splice,
+                         self.buffer_size)
+        with self._lock:
+            self.opened += 1
+            loop = next(self._next)
+        loop.submit(tunnel)
+
+    def _finished(self, tunnel):
+        with self._lock:
+            self.closed += 1
+            self.bytes += tunnel.bytes
+
+    def stats(self):
+        with self._lock:
+            return {"active": self.opened - self.closed, "opened": self.opened,
+                    "bytes": self.bytes, "splice": self.splice}
+
+    def stop(self):
+        for loop in self._loops:
+            loop.stopping = True
+            loop.wake()
+        for loop in self._loops:
+            loop.join(timeout=2)
+        logging.info("Tunnel relay: %s", self.stats())
+
+
+def build_relay(cfg):
+    r = cfg["relay"]
+    return Relay(r["threads"], r["buffer_bytes"], r["idle_timeout"], r["splice"])
@@ -0,0 +1,191 @@
+"""Cached name resolution and parallel ("Happy Eyeballs") connects.
+
+`socket.create_connection` resolves the name with a blocking getaddrinfo on
+every call, then tries each address in turn, so a slow resolver or a dead
+first address adds its full latency to every miss. The Resolver keeps
+answers for `positive_ttl` seconds (failures for `negative_ttl`) in a
+bounded LRU shared by all workers. `connect` races the addresses RFC 8305
+style: families interleaved, a new attempt started every
+`happy_eyeballs_delay` seconds (or as soon as one fails), first to connect
+wins.
+
+getaddrinfo doesn't report record TTLs, so the TTLs here are a policy,
+not the DNS ones.
+"""
+import errno
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY}
+
+
+def _interleave(infos):
+    """Alternate address families, keeping getaddrinfo's order within each."""
+    by_family = OrderedDict()
+    for info in infos:
+        by_family.setdefault(info[0], []).append(info)
+    queues = list(by_family.values())
+    out = []
+    while queues:
+        for q in list(queues):
+            out.append(q.pop(0))
+            if not q:
+                queues.remove(q)
+    return out
+
+
+def _with_port(info, port):
+    family, type_, proto, canon, sockaddr = info
+    return family, type_, proto, canon, (sockaddr[0], port) + tuple(sockaddr[2:])
+
+
+class Resolver:
+    """Shared DNS cache plus a multi-address connect."""
+
+    def __init__(self, positive_ttl=60, negative_ttl=5, max_entries=1024,
+                 happy_eyeballs_delay=0.25):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.delay = happy_eyeballs_delay
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()     # host -> (expires_at, infos or error)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.resolve_seconds = 0.0      # time spent in getaddrinfo
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.fallbacks = 0              # connects won by a later address
+
+    def resolve(self, host, port):
+        """getaddrinfo(host, port) for TCP, from the cache when possible.
+        A cached failure is raised again until it expires.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._cache.get(host)
+            if item is not None and now < item[0]:
+                self._cache.move_to_end(host)
+                if isinstance(item[1], Exception):
+                    self.negative_hits += 1
+                    raise socket.gaierror(*item[1].args)
+                self.hits += 1
+                return [_with_port(info, port) for info in item[1]]
+        start = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            result, ttl = infos, self.positive_ttl
+        except socket.gaierror as e:
+            result, ttl = e, self.negative_ttl
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.misses += 1
+            self.resolve_seconds += elapsed
+            if ttl > 0:
+                self._cache[host] = (start + elapsed + ttl, result)
+                self._cache.move_to_end(host)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        if isinstance(result, Exception):
+            raise socket.gaierror(*result.args)
+        return result
+
+    def connect(self, host, port, timeout):
+        """Open a TCP connection to host:port; returns a blocking socket
+        with `timeout` set.
+        """
+        infos = _interleave(self.resolve(host, port))
+        start = time.monotonic()
+        if len(infos) == 1:
+            sock, index = _connect_one(infos[0], timeout), 0
+        else:
+            sock, index = self._race(infos, timeout)
+        with self._lock:
+            self.connects += 1
+            self.connect_seconds += time.monotonic() - start
+            self.fallbacks += index > 0
+        sock.settimeout(timeout)
+        return sock
+
+    def _race(self, infos, timeout):
+        """Staggered parallel connect; returns (socket, index of winner)."""
+        sel = selectors.DefaultSelector()
+        pending = {}                    # socket -> index into infos
+        errors = []
+        deadline = time.monotonic() + timeout
+        next_start = 0.0
+        index = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if index < len(infos) and (now >= next_start or not pending):
+                    family, type_, proto, _, sockaddr = infos[index]
+                    sock = socket.socket(family, type_, proto)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                    if err == 0:
+                        return sock, index
+                    if err in _IN_PROGRESS:
+                        sel.register(sock, selectors.EVENT_WRITE)
+                        pending[sock] = index
+                    else:
+                        errors.append(OSError(err, f"connect to {sockaddr[0]}"
+                                              f": {errno.errorcode.get(err)}"))
+                        sock.close()
+                    index += 1
+                    next_start = now + self.delay
+                    continue
+                if not pending:
+                    raise errors[-1] if errors else OSError("No addresses")
+                if now >= deadline:
+                    raise socket.timeout("timed out")
+                wake = deadline if index >= len(infos) else min(deadline, next_start)
+                for key, _ in sel.select(max(0.0, wake - now)):
+                    sock = key.fileobj
+                    sel.unregister(sock)
+                    won = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        sock.setblocking(True)
+                        return sock, won
+                    errors.append(OSError(err, f"connect: {errno.errorcode.get(err)}"))
+                    sock.close()
+                    next_start = 0.0    # a failure starts the next attempt now
+        finally:
+            for sock in pending:
+                sock.close()
+            sel.close()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "negative_hits": self.negative_hits,
+                    "misses": self.misses, "entries": len(self._cache),
+                    "resolve_ms": round(self.resolve_seconds * 1000, 1),
+                    "connects": self.connects, "fallbacks": self.fallbacks,
+                    "connect_ms": round(self.connect_seconds * 1000, 1)}
+
+    def log_stats(self):
+        logging.info("Resolver: %s", self.stats())
+
+
+def _connect_one(info, timeout):
+    family, type_, proto, _, sockaddr = info
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def build_resolver(cfg):
+    d = cfg["dns"]
+    ttl, negative = (d["positive_ttl"], d["negative_ttl"]) if d["enabled"] else (0, 0)
+    return Resolver(ttl, negative, d["max_entries"], d["happy_eyeballs_delay"])
@@ -7,179 +7,632 @@ Key fixes over the original:
   * Bounded ThreadPoolExecutor instead of unbounded threads.
   * Socket timeouts everywhere so a stalled peer can't pin a worker forever.
   * Cacheability decided by HTTP method/status/Cache-Control, not blindly.
-  * Real HTTPS support via CONNECT tunnelling.
+  * Real HTTPS support via CONNECT tunnelling, relayed by a few event
+    loop threads instead of a worker per tunnel (see relay.py).
+  * Keep-alive connection pool to origins (see upstream.py).
+  * Persistent client connections with in-order pipelining.
+  * Concurrent misses for one key share a single origin fetch.
+  * Cache keys use normalised URLs and honour Vary (see cachekey.py).
+  * Range requests are answered (206) from fully cached objects.
+  * Cached DNS answers and parallel connects across addresses (resolver.py).
+  * Log rows are batched by a background writer (see logs.py).
+  * Optional gzip variants of cached text, made off the request path.
+  * Expired entries are revalidated (304) or served stale while refreshing.
+  * Optional asyncio event-loop mode (see aio.py) for many idle connections.
 """
+import functools
 import logging
+import os
 import select
+import signal
 import socket
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
 import cache as cachelib
+import cachekey
+import coalesce
+import compress
 import config
 import filtering
 import logs
+import metrics
 import parse
+import prefork
+import relay
+import resolver
+import upstream
 
 BUFSIZE = 65536
 CACHEABLE_STATUS = {200, 203, 300, 301, 308}
 
 
-def recv_full_request(sock, max_header, max_body):
-    """Read headers until the blank-line terminator, then any Content-Length
-    body. Returns (head_bytes, headers_list, body_bytes).
+def recv_request_head(sock, max_header, pending=b""):
+    """Read a request head up to its blank-line terminator. `pending` holds
+    bytes already read past the previous request on a keep-alive
+    connection. Returns (head_bytes, headers_list, rest_bytes); the rest is
+    the start of the body (see RequestBody) and maybe of the next request.
+
+    The head is parsed incrementally (see parse.HeadParser).
     """
-    buf = b""
-    while b"\r\n\r\n" not in buf:
+    parser = parse.HeadParser(max_header, pending)
+    while not parser.complete:
         chunk = sock.recv(BUFSIZE)
         if not chunk:
             break
-        buf += chunk
-        if len(buf) > max_header:
-            raise ValueError("Request header too large")
-
-    head, _, body = buf.partition(b"\r\n\r\n")
+        parser.feed(chunk)
+    head = parser.head
     if not head:
         return b"", [], b""
+    return head, parser.headers, bytes(parser.rest)
 
-    headers = parse.parse_headers(head)
-    content_length = parse.get_header(headers, "content-length")
-    if content_length:
-        try:
-            needed = int(content_length)
-        except ValueError:
-            needed = 0
-        if needed > max_body:
-            raise ValueError("Request body too large")
-        while len(body) < needed:
-            chunk = sock.recv(BUFSIZE)
-            if not chunk:
-                break
-            body += chunk
-    return head, headers, body
 
+class RequestBody:
+    """A request body, read from the client while it is sent upstream.
 
-def tunnel(client_sock, host, port, timeout):
-    """Blindly relay bytes both ways for a CONNECT (HTTPS) tunnel."""
-    upstream = socket.create_connection((host, port), timeout=timeout)
-    client_sock.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-    client_sock.setblocking(False)
-    upstream.setblocking(False)
-    peers = [client_sock, upstream]
-    try:
-        while True:
-            readable, _, errored = select.select(peers, [], peers, timeout)
-            if errored or not readable:
-                break
-            for sock in readable:
-                other = upstream if sock is client_sock else client_sock
-                try:
-                    data = sock.recv(BUFSIZE)
-                except (BlockingIOError, InterruptedError):
-                    continue
+    Iterating yields the body as it arrives, in its wire form: chunked
+    framing is followed (parse.ChunkedScanner) but passed through, so at
+    most one socket read is held in memory whatever the upload size. After
+    iteration, `complete` says whether the whole body arrived and
+    `leftover` holds the bytes read past its end (a pipelined request).
+    Bodies above `max_body` bytes (0 = no limit) raise ValueError, and a
+    client that closes before the end of the body ConnectionError.
+    """
+
+    def __init__(self, sock, headers, buffered=b"", max_body=0):
+        self.sock = sock
+        self.max_body = max_body
+        self.framing, length = parse.request_body_framing(headers)
+        if max_body and (length or 0) > max_body:
+            raise ValueError("Request body too large")
+        self._remaining = length
+        self._chunks = parse.ChunkedScanner() if self.framing == "chunked" else None
+        self._buffered = buffered
+        self.size = 0
+        self.complete = self.framing == "none"
+        self.leftover = buffered if self.complete else b""
+
+    def __bool__(self):
+        return self.framing != "none"
+
+    def __iter__(self):
+        data, self._buffered = self._buffered, b""
+        while not self.complete:
+            if not data:
+                data = self.sock.recv(BUFSIZE)
                 if not data:
-                    return
-                other.sendall(data)
-    finally:
-        try:
-            upstream.close()
-        except OSError:
+                    # The client went away mid-body. Raise, so the upstream
+                    # socket holding half a request is closed, not pooled.
+                    raise ConnectionError("Client closed the connection mid-body")
+            if self._chunks is not None:
+                used = self._chunks.feed(data)
+                self.complete = self._chunks.done
+            else:
+                used = min(len(data), self._remaining)
+                self._remaining -= used
+                self.complete = self._remaining == 0
+            self.size += used
+            if self.max_body and self.size > self.max_body:
+                raise ValueError("Request body too large")
+            if used:
+                yield data[:used] if used < len(data) else data
+            if self.complete:
+                self.leftover = data[used:]
+            data = b""
+
+    def drain(self):
+        """Read and drop whatever of the body hasn't been consumed."""
+        for _ in self:
             pass
 
 
+def _wait_for_request(sock, timeout):
+    """Wait up to `timeout` seconds for the next request on an idle
+    keep-alive connection. False means the client stayed silent.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], timeout)
+    except (OSError, ValueError):
+        return False
+    return bool(readable)
+
+
+TUNNEL_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+
+
+def open_tunnel(client_sock, upstream_sock, relay, pending):
+    """Confirm a CONNECT and hand both sockets to the relay, which owns
+    (and eventually closes) them from here on. `pending` is whatever the
+    client sent after the CONNECT head, typically its TLS ClientHello.
+    """
+    try:
+        client_sock.sendall(TUNNEL_ESTABLISHED)
+    except OSError:
+        upstream_sock.close()
+        raise
+    relay.add(client_sock, upstream_sock, pending)
+
+
 def _compute_ttl(resp_headers, status, default_ttl):
     """Return a TTL in seconds, or None if the response must not be cached."""
     if status not in CACHEABLE_STATUS:
         return None
-    cc = (parse.get_header(resp_headers, "cache-control", "") or "").lower()
+    cc = parse.parse_cache_control(parse.get_header(resp_headers, "cache-control"))
     if any(d in cc for d in ("no-store", "no-cache", "private")):
         return None
-    for part in cc.split(","):
-        part = part.strip()
-        if part.startswith("max-age="):
+    try:
+        return max(0, int(cc["max-age"]))
+    except (KeyError, TypeError, ValueError):
+        return default_ttl
+
+
+def _stale_window(head):
+    """Seconds a cached response may be served stale while it is refreshed
+    in the background (its `stale-while-revalidate`), or 0.
+    """
+    cc = parse.parse_cache_control(
+        parse.get_header(parse.parse_headers(head), "cache-control"))
+    try:
+        return max(0, int(cc.get("stale-while-revalidate")))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _refreshed_ttl(stored_head, not_modified_headers, default_ttl):
+    """TTL for a stored response after a 304: the 304's own Cache-Control if
+    it sent one, else the stored response's, applied to the stored status.
+    """
+    headers = not_modified_headers
+    if parse.get_header(headers, "cache-control") is None:
+        headers = parse.parse_headers(stored_head)
+    return _compute_ttl(headers, parse.parse_response_status(stored_head),
+                        default_ttl)
+
+
+class ResponseCapture:
+    """Follows a streamed origin response: its header block, the byte count,
+    and -- once the head says it is cacheable -- a cache writer that the
+    body is teed into while it still fits under the object limit. Memory use
+    stays constant however large the response. Shared by both serving modes.
+    """
+
+    def __init__(self, cache, key, capturing, cfg, store_key=None):
+        self.cache = cache
+        self.key = key
+        self.store_key = store_key    # resp headers -> key to store under
+        self.cfg = cfg
+        self._head = parse.HeadParser(cfg["max_header_bytes"])
+        self.head_done = False
+        self.total = 0
+        self.capturing = capturing
+        self.writer = None
+        self.stored = False           # the fill was committed to the cache
+        self.status = None
+        self.headers = []
+
+    def feed(self, chunk):
+        self.total += len(chunk)
+        if not self.head_done:
             try:
-                return max(0, int(part.split("=", 1)[1]))
-            except ValueError:
-                pass
-    return default_ttl
+                if not self._head.feed(chunk):
+                    return
+            except ValueError:                # oversized head: relay uncached
+                self.head_done = True
+                return
+            self.head_done = True
+            head, rest = self._head.head, bytes(self._head.rest)
+            self._head = None
+            self._on_head(head)
+            # Stored heads are client-ready (see parse.with_connection),
+            # whichever mode relayed them.
+            if not parse.is_rebuilt_head(head):
+                head = parse.rebuild_response_head(head)[:-4]
+            chunk = head + b"\r\n\r\n" + rest   # plus any body bytes so far
+        if self.writer is not None:
+            if self.total > self.cfg["cache"]["max_object_bytes"]:
+                self._drop()                  # too big to cache; keep relaying
+                return
+            try:
+                self.writer.write(chunk)
+            except OSError as e:              # e.g. disk full: relay uncached
+                logging.warning("Cache fill failed: %s", e)
+                self._drop()
+
+    def _on_head(self, head):
+        self.status = parse.parse_response_status(head)
+        self.headers = parse.parse_headers(head)
+        if self.capturing:
+            if self.store_key is not None:
+                self.key = self.store_key(self.headers)
+            ttl = _compute_ttl(self.headers, self.status,
+                               self.cfg["cache"]["default_ttl"])
+            if ttl and self.key is not None:
+                try:
+                    self.writer = self.cache.writer(self.key, ttl)
+                except OSError as e:
+                    logging.warning("Cache fill failed: %s", e)
+
+    def _drop(self):
+        try:
+            self.writer.discard()
+        except OSError:
+            pass
+        self.writer = None
+
+    def commit(self, complete=True):
+        """Install the cache fill if the response arrived whole."""
+        if self.writer is not None:
+            if complete:
+                self.writer.commit()
+                self.stored = True
+            else:
+                self._drop()
+
+    def finish(self, request_id, elapsed_ms, complete=True):
+        """Commit the cache fill, then write the MISS log rows."""
+        self.commit(complete)
+        logs.log_response(request_id, "MISS", self.status,
+                          parse.get_header(self.headers, "content-type", "unknown"),
+                          self.total, elapsed_ms)
+        logs.update_request_status(request_id, self.status or 0)
+
+    def abort(self):
+        """The relay failed part-way: throw away any partial fill."""
+        if self.writer is not None:
+            self._drop()
+
+
+class Revalidator:
+    """Background refreshes for entries served under stale-while-revalidate.
+
+    At most one refresh per key is queued or running; a request that finds
+    one already pending just serves the stale copy.
+    """
+
+    def __init__(self, cache, upstreams, cfg, compressor=None):
+        self.cache = cache
+        self.upstreams = upstreams
+        self.cfg = cfg
+        self.compressor = compressor
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = ThreadPoolExecutor(
+            max_workers=cfg["cache"]["revalidate_workers"],
+            thread_name_prefix="revalidate")
+
+    def submit(self, key, host, port, request, stored_head, store_key=None):
+        """Refresh `key` in the background. `store_key` picks the key a
+        full response is stored under, as for ResponseCapture.
+        """
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._pool.submit(self._run, key, host, port, request, stored_head,
+                          store_key)
+
+    def _run(self, key, host, port, request, stored_head, store_key=None):
+        try:
+            with self.upstreams.fetch(host, port, "GET", request) as resp:
+                if resp.status == 304:
+                    for _ in resp.iter_body():
+                        pass
+                    ttl = _refreshed_ttl(stored_head, resp.headers,
+                                         self.cfg["cache"]["default_ttl"])
+                    if ttl:
+                        self.cache.refresh(key, ttl)
+                    return
+                capture = ResponseCapture(self.cache, key, True, self.cfg,
+                                          store_key)
+                try:
+                    capture.feed(parse.rebuild_response_head(resp.head))
+                    for chunk in resp.iter_body():
+                        capture.feed(chunk)
+                except BaseException:
+                    capture.abort()
+                    raise
+                capture.commit(resp.complete)
+                queue_compression(self.compressor, capture)
+        except Exception as e:  # noqa: BLE001 - the stale copy was already served
+            logging.warning("Background revalidation failed: %s", e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
 
 
-def serve_http(client_sock, host, port, method, path, forward,
-               request_id, cfg, cache):
-    """Handle a plain HTTP request: try cache, else fetch + stream + maybe store."""
-    cacheable_request = method.upper() == "GET"
-    key = cachelib.make_key(method, host, port, path)
+def record_hit(request_id, status, ctype, size, tier=None):
+    """Write the HIT log rows for a response served from the cache."""
+    logs.log_response(request_id, "HIT", status, ctype or "unknown", size, 0, tier)
+    logs.update_request_status(request_id, status or 0)
+
+
+def plan_ranges(hit, method, req_headers):
+    """Byte ranges of `hit` that answer the request's Range header.
+
+    Returns None to send the whole response -- no Range, not a GET, an
+    If-Range that no longer matches, or a stored response that isn't a
+    full 200 with a Content-Length body -- else a list of (start, length)
+    slices, empty when none is satisfiable (416).
+    """
+    value = parse.get_header(req_headers, "range")
+    if value is None or method.upper() != "GET":
+        return None
+    if hit.status != 200 or hit.framing != "length":
+        return None
+    if parse.get_header(hit.headers, "content-length") != str(hit.length):
+        return None
+    if_range = parse.get_header(req_headers, "if-range")
+    if if_range is not None:
+        if if_range.startswith(('"', "W/")):
+            # Strong comparison (RFC 7233): a weak tag never matches, so
+            # neither does the W/ tag of a gzipped entry (see compress.py).
+            matches = not if_range.startswith("W/") and if_range == hit.etag
+        else:
+            matches = if_range == hit.last_modified
+        if not matches:
+            return None
+    return parse.parse_range(value, hit.length)
+
+
+def range_parts(hit, ranges, connection):
+    """Lay out a 206 (or 416) answer from `hit`.
+
+    Returns (head, parts, trailer): `parts` are (prefix, start, length), the
+    bytes to send before each body slice -- empty for a single range, a
+    multipart/byteranges part header otherwise.
+    """
+    stored = hit.headers
+    size = hit.length
+    if not ranges:
+        lines = ["HTTP/1.1 416 Range Not Satisfiable",
+                 f"Content-Range: bytes */{size}", "Content-Length: 0"]
+        return (parse.rebuild_response_head(
+            "\r\n".join(lines).encode("iso-8859-1"), connection), [], b"")
+
+    if len(ranges) == 1:
+        start, length = ranges[0]
+        drop = {"content-length", "content-range"}
+        extra = [f"Content-Range: bytes {start}-{start + length - 1}/{size}",
+                 f"Content-Length: {length}"]
+        parts = [(b"", start, length)]
+        trailer = b""
+    else:
+        boundary = os.urandom(12).hex()
+        ctype = hit.ctype
+        drop = {"content-length", "content-range", "content-type"}
+        parts = []
+        for start, length in ranges:
+            prefix = f"\r\n--{boundary}\r\n"
+            if ctype:
+                prefix += f"Content-Type: {ctype}\r\n"
+            prefix += (f"Content-Range: bytes {start}-{start + length - 1}"
+                       f"/{size}\r\n\r\n")
+            parts.append((prefix.encode("iso-8859-1"), start, length))
+        trailer = f"\r\n--{boundary}--\r\n".encode("ascii")
+        total = sum(len(p) + n for p, _, n in parts) + len(trailer)
+        extra = [f"Content-Type: multipart/byteranges; boundary={boundary}",
+                 f"Content-Length: {total}"]
+    lines = ["HTTP/1.1 206 Partial Content"]
+    lines += [f"{k}: {v}" for k, v in stored if k.lower() not in drop]
+    lines += extra
+    head = parse.rebuild_response_head(
+        "\r\n".join(lines).encode("iso-8859-1"), connection)
+    return head, parts, trailer
+
+
+def send_hit(client_sock, hit, connection, ranges=None):
+    """Send a cached response, or the `ranges` of it (see plan_ranges).
+
+    File-backed bodies go kernel-to-socket via sendfile -- a range is just
+    an offset into the entry file -- and in-memory bodies are sent from a
+    view, without a copy. Returns (status, bytes sent) for the log.
+    """
+    status = hit.status if ranges is None else (206 if ranges else 416)
+    if ranges is None:
+        head = parse.with_connection(hit.head, connection)
+        parts, trailer = [(b"", 0, hit.length)], b""
+    else:
+        head, parts, trailer = range_parts(hit, ranges, connection)
+    client_sock.sendall(head)
+    sent = len(head)
+    for prefix, start, length in parts:
+        if prefix:
+            client_sock.sendall(prefix)
+        if hit.file is not None:
+            client_sock.sendfile(hit.file, hit.offset + start, length)
+        else:
+            client_sock.sendall(hit.body[start:start + length])
+        sent += len(prefix) + length
+    if trailer:
+        client_sock.sendall(trailer)
+    return status, sent + len(trailer)
+
+
+def serve_http(client_sock, host, port, method, path, headers, forward,
+               request_id, cfg, cache, keys, upstreams, flights,
+               keep_alive=False, revalidator=None, compressor=None, body=None):
+    """Handle a plain HTTP request: try cache, else fetch + stream + maybe store.
+
+    Concurrent misses for the same key are coalesced: the first one fetches,
+    the rest follow its bytes (see coalesce.py). Keys come from `keys`
+    (normalised URL, plus the request headers a response Varies on). An
+    expired entry is served stale while a background refresh runs if the
+    origin allowed it (stale-while-revalidate), or else revalidated with a
+    conditional request so a 304 costs a header round trip instead of the
+    whole body. With a `compressor`, text hits go out gzipped or decoded per
+    client. A request `body` (RequestBody) is streamed to the origin after
+    `forward`, the request head; requests with a body bypass the cache.
+
+    Returns True if the client connection can carry another request: the
+    client asked for keep-alive and the response had a definite length.
+    """
+    cacheable_request = method.upper() == "GET" and not body
+    primary, rewritten = keys.primary(method, host, port, path)
+    key = keys.lookup(primary, headers)
+    flight = None
+    stale = None
 
     if cacheable_request:
-        cached = cache.get(key)
-        if cached is not None:
-            client_sock.sendall(cached)
-            head = cached.split(b"\r\n\r\n", 1)[0]
-            status = parse.parse_response_status(head)
-            ctype = parse.get_header(parse.parse_headers(head),
-                                     "content-type", "unknown")
-            logs.log_response(request_id, "HIT", status, ctype, len(cached), 0)
-            logs.update_request_status(request_id, status or 0)
-            return
+        hit = cache.open(key, stale=cfg["cache"]["revalidate"])
+        if hit is not None and hit.stale:
+            etag, last_modified = hit.etag, hit.last_modified
+            if (revalidator is not None
+                    and time.time() < hit.expires + _stale_window(hit.head)):
+                revalidator.submit(key, host, port,
+                                   parse.with_validators(forward, etag, last_modified),
+                                   hit.head,
+                                   functools.partial(keys.for_response, primary,
+                                                     headers))
+            elif etag or last_modified:
+                stale = hit
+                forward = parse.with_validators(forward, etag, last_modified)
+                hit = None
+            else:
+                hit.close()
+                hit = None
+        if hit is not None:
+            keys.record_hit(rewritten)
+            if compressor is not None:
+                hit = compressor.select(hit, key, headers)
+            return _serve_hit(client_sock, hit, method, headers, request_id,
+                              keep_alive)
+
+        if stale is None:
+            flight, leader = flights.join(key)
+            if flight is not None and not leader:
+                keep = follow_flight(client_sock, flight, method, request_id, cfg,
+                                     keep_alive)
+                flights.record(keep is not None)
+                if keep is not None:
+                    return keep
+                flight = None                 # not shareable: fetch our own
 
     start = time.time()
-    head_buf = b""
-    head_done = False
-    total = 0
-    cache_buf = bytearray()
-    capturing = cacheable_request
-    cache_limit = cfg["cache"]["max_object_bytes"]
-
-    upstream = socket.create_connection((host, port), timeout=cfg["upstream_timeout"])
-    upstream.settimeout(cfg["upstream_timeout"])
+    capture = ResponseCapture(
+        cache, key, cacheable_request, cfg,
+        functools.partial(keys.for_response, primary, headers))
+    complete = False
+
     try:
-        upstream.sendall(forward)
-        while True:
-            chunk = upstream.recv(BUFSIZE)
-            if not chunk:
-                break
-            client_sock.sendall(chunk)        # stream straight through
-            total += len(chunk)
-            if not head_done:
-                head_buf += chunk
-                if b"\r\n\r\n" in head_buf:
-                    head_done = True
-            if capturing:
-                cache_buf += chunk
-                if len(cache_buf) > cache_limit:   # too big to cache; keep relaying
-                    capturing = False
-                    cache_buf = bytearray()
+        with upstreams.fetch(host, port, method, forward, body or ()) as resp:
+            if stale is not None and resp.status == 304:
+                for _ in resp.iter_body():
+                    pass
+                ttl = _refreshed_ttl(stale.head, resp.headers,
+                                     cfg["cache"]["default_ttl"])
+                if ttl:
+                    cache.refresh(key, ttl)
+                hit, stale = stale, None
+                keys.record_hit(rewritten)
+                if compressor is not None:
+                    hit = compressor.select(hit, key, headers)
+                return _serve_hit(client_sock, hit, method, headers,
+                                  request_id, keep_alive)
+            keep = keep_alive and resp.framing != "close"
+            head = parse.rebuild_response_head(resp.head, _connection(keep))
+            capture.feed(head)
+            if flight is not None:
+                # Followers joined under our key, so a response that Varies
+                # on headers we didn't key by can't be handed to them.
+                ttl = _compute_ttl(resp.headers, resp.status,
+                                   cfg["cache"]["default_ttl"])
+                too_big = (resp.framing == "length"
+                           and resp.length > cfg["cache"]["max_object_bytes"])
+                flight.publish(resp.head, resp.framing,
+                               bool(ttl) and not too_big and capture.key == key)
+            client_sock.sendall(head)
+            for chunk in resp.iter_body():
+                if flight is not None:
+                    flight.append(chunk)
+                client_sock.sendall(chunk)    # stream straight through
+                capture.feed(chunk)
+            complete = resp.complete
+    except BaseException:
+        capture.abort()
+        raise
     finally:
-        try:
-            upstream.close()
-        except OSError:
-            pass
+        if stale is not None:
+            stale.close()
+        if flight is not None:
+            flights.leave(key, flight, complete)
 
-    elapsed_ms = (time.time() - start) * 1000
-    head = head_buf.split(b"\r\n\r\n", 1)[0]
-    status = parse.parse_response_status(head)
-    resp_headers = parse.parse_headers(head)
+    capture.finish(request_id, (time.time() - start) * 1000, complete)
+    metrics.record_response(method, "MISS", capture.status, capture.total)
+    queue_compression(compressor, capture)
+    return keep and complete
+
+
+def queue_compression(compressor, capture):
+    """Queue a freshly stored response for compression, if it wants it."""
+    if (compressor is not None and capture.stored
+            and compressor.wants(capture.status, capture.headers)):
+        compressor.submit(capture.key)
 
-    if capturing and head_done:
-        ttl = _compute_ttl(resp_headers, status, cfg["cache"]["default_ttl"])
-        if ttl:
-            cache.put(key, bytes(cache_buf), ttl)
 
+def _serve_hit(client_sock, hit, method, req_headers, request_id, keep_alive):
+    """Send a cache hit, log it, and return the keep-alive decision."""
+    try:
+        ranges = plan_ranges(hit, method, req_headers)
+        keep = keep_alive and hit.framing != "close"
+        status, sent = send_hit(client_sock, hit, _connection(keep), ranges)
+    finally:
+        hit.close()
+    record_hit(request_id, status, hit.ctype, sent, hit.tier)
+    metrics.record_response(method, "HIT", status, sent)
+    return keep
+
+
+def follow_flight(client_sock, flight, method, request_id, cfg, keep_alive):
+    """Relay another request's in-flight fetch to this client.
+
+    Returns the keep-alive decision, or None if the leader's response can't
+    be shared and the caller must fetch for itself.
+    """
+    start = time.time()
+    head, framing = flight.wait_head(cfg["upstream_timeout"])
+    if head is None:
+        return None
+    keep = keep_alive and framing != "close"
+    out = parse.rebuild_response_head(head, _connection(keep))
+    client_sock.sendall(out)
+    total = len(out)
+    for chunk in flight.iter_body(cfg["upstream_timeout"]):
+        client_sock.sendall(chunk)
+        total += len(chunk)
+
+    status = parse.parse_response_status(head)
     logs.log_response(request_id, "MISS", status,
-                      parse.get_header(resp_headers, "content-type", "unknown"),
-                      total, elapsed_ms)
+                      parse.get_header(parse.parse_headers(head),
+                                       "content-type", "unknown"),
+                      total, (time.time() - start) * 1000)
     logs.update_request_status(request_id, status or 0)
+    metrics.record_response(method, "MISS", status, total)
+    return keep
 
 
-def handle_client(client_sock, addr, cfg, cache):
+def _connection(keep_alive):
+    return "keep-alive" if keep_alive else "close"
+
+
+def handle_request(client_sock, addr, cfg, cache, keys, upstreams, flights,
+                   pending, revalidator=None, compressor=None, relay=None):
+    """Read and answer one request. Returns (keep_open, leftover_bytes);
+    leftover is None once the connection has been handed to the relay.
+    """
     client_ip, client_port = addr
     request_id = None
+    started = None
     try:
-        client_sock.settimeout(cfg["client_timeout"])
-        head, headers, body = recv_full_request(
-            client_sock, cfg["max_header_bytes"], cfg["max_body_bytes"])
+        head, headers, rest = recv_request_head(
+            client_sock, cfg["max_header_bytes"], pending)
         if not head:
-            return
+            return False, b""
+        started = time.perf_counter()
+        metrics.RECEIVED_BYTES.inc(amount=len(head) + 4)
 
         method, target, version = parse.parse_request_line(head)
         host, port, path = parse.resolve_target(method, target, headers)
@@ -192,42 +645,174 @@ def handle_client(client_sock, addr, cfg, cache):
             filtering.send_forbidden(client_sock)
             logs.log_response(request_id, "MISS", 403, "text/html", 0, 0)
             logs.update_request_status(request_id, 403)
-            return
+            metrics.record_response(method, None, 403,
+                                    len(filtering.forbidden_response()))
+            return False, b""
 
         if method.upper() == "CONNECT":
-            tunnel(client_sock, host, port, cfg["upstream_timeout"])
+            open_tunnel(client_sock, upstreams.connect(host, port), relay,
+                        rest)
             logs.update_request_status(request_id, 200)
-            return
-
+            metrics.record_response(method, None, 200, len(TUNNEL_ESTABLISHED))
+            return False, None
+
+        body = RequestBody(client_sock, headers, rest, cfg["max_body_bytes"])
+        if body and parse.expects_continue(headers):
+            # We answer the client's Expect ourselves: the body is already
+            # on its way by the time the origin could say 100 Continue.
+            client_sock.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+            headers = [(k, v) for k, v in headers if k.lower() != "expect"]
+        keep_alive = (cfg["keepalive_timeout"] > 0
+                      and parse.wants_keep_alive(version, headers))
         forward = parse.build_forward_request(
-            method, path, version, headers, body, host, port)
-        serve_http(client_sock, host, port, method, path, forward,
-                   request_id, cfg, cache)
+            method, path, version, headers, b"", host, port,
+            keep_alive=upstreams.enabled, chunked=body.framing == "chunked")
+        keep_open = serve_http(client_sock, host, port, method, path, headers,
+                               forward, request_id, cfg, cache, keys,
+                               upstreams, flights, keep_alive, revalidator,
+                               compressor, body)
+        metrics.RECEIVED_BYTES.inc(amount=body.size)
+        # The next request starts after this body; if it wasn't read to its
+        # end the connection can't be reused.
+        return keep_open and body.complete, body.leftover
 
     except Exception as e:  # noqa: BLE001 - log and keep the server alive
         logging.warning("Error handling %s:%s -> %s", client_ip, client_port, e)
         if request_id is None:
             logs.log_request(client_ip, client_port, "unknown", 0,
                              "unknown", "unknown", "unknown", error_message=str(e))
+        return False, b""
     finally:
-        try:
-            client_sock.close()
-        except OSError:
-            pass
+        if started is not None:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
 
 
-def main():
-    cfg = config.load_config()
-    logging.basicConfig(level=logging.INFO,
-                        format="%(asctime)s %(levelname)s %(message)s")
-    logs.configure(cfg["db_name"])
-    logs.init_db()
-    cache = cachelib.build_cache(cfg)
+def handle_client(client_sock, addr, cfg, cache, keys, upstreams, flights,
+                  revalidator=None, compressor=None, relay=None):
+    """Serve requests on one client connection until either side closes it.
+
+    Responses go out strictly in request order, so pipelined requests are
+    just the leftover bytes read for the next loop iteration. Between
+    requests the connection may sit idle for `keepalive_timeout` seconds;
+    `client_timeout` still bounds reading a request once it has started.
+    A CONNECT ends the loop and leaves the socket open for the relay.
+    """
+    handed_off = False
+    try:
+        client_sock.settimeout(cfg["client_timeout"])
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pending = b""
+        for _ in range(cfg["max_keepalive_requests"]):
+            keep_open, pending = handle_request(
+                client_sock, addr, cfg, cache, keys, upstreams, flights,
+                pending, revalidator, compressor, relay)
+            if pending is None:
+                handed_off = True
+                break
+            if not keep_open:
+                break
+            if not pending and not _wait_for_request(
+                    client_sock, cfg["keepalive_timeout"]):
+                break
+    except OSError:
+        pass
+    finally:
+        if not handed_off:
+            try:
+                client_sock.close()
+            except OSError:
+                pass
 
+
+def _serve_queued(*args):
+    """Pool entry point: handle_client, keeping the worker gauges."""
+    metrics.WORKERS_QUEUED.dec()
+    metrics.WORKERS_BUSY.inc()
+    try:
+        handle_client(*args)
+    finally:
+        metrics.WORKERS_BUSY.dec()
+
+
+def _terminate(signum, frame):
+    """SIGTERM shuts down like Ctrl+C, so queued log rows get written. Only
+    the first signal interrupts: a second one must not cut the shutdown short.
+    """
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def listen_socket(cfg, reuse_port=False):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind((cfg["listen_host"], cfg["listen_port"]))
     server.listen(128)
+    return server
+
+
+def main(cfg=None):
+    """Run the proxy until Ctrl+C or SIGTERM. `cfg` defaults to
+    config.json merged over the defaults. With `workers` > 1 this process
+    becomes the supervisor of that many pre-forked workers (prefork.py).
+    """
+    if cfg is None:
+        cfg = config.load_config()
+    signal.signal(signal.SIGTERM, _terminate)
+    workers = cfg["workers"]
+    if workers > 1 and not prefork.available():
+        workers = 1
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s "
+               + ("[%(process)d] " if workers > 1 else "") + "%(message)s")
+    if workers != cfg["workers"]:
+        logging.warning("workers=%s needs fork and SO_REUSEPORT; "
+                        "running one process", cfg["workers"])
+        cfg = dict(cfg, workers=1)
+    logs.configure(cfg["db_name"])
+    logs.init_db()
+    if workers > 1:
+        prefork.Supervisor(workers, functools.partial(serve, cfg)).run()
+    else:
+        serve(cfg)
+
+
+def serve(cfg, worker=0):
+    """One serving process: worker number `worker` of cfg["workers"]."""
+    workers = cfg["workers"]
+    if cfg["log_writer"]["enabled"]:
+        w = cfg["log_writer"]
+        logs.start_writer(w["queue_size"], w["flush_interval"], w["batch_size"],
+                          w["overflow"], w["block_timeout"], worker, workers)
+    cache = cachelib.build_cache(cfg)
+    keys = cachekey.build_keys(cfg)
+    compressor = compress.build_compressor(cfg, cache)
+    dns = resolver.build_resolver(cfg)
+    metrics.watch_cache(cache)
+    metrics.watch_resolver(dns)
+    admin = metrics.start_admin(cfg, worker)
+
+    if cfg["server_mode"] == "asyncio":
+        import aio                  # imports this module; only needed here
+        aio.run(cfg, cache, keys, compressor, dns)
+        if admin is not None:
+            admin.stop()
+        logs.stop_writer()
+        return
+
+    upstreams = upstream.build_pool(cfg, dns)
+    flights = coalesce.build_coalescer(cfg)
+    metrics.watch_coalescer(flights)
+    tunnels = relay.build_relay(cfg)
+    tunnels.start()
+    metrics.watch_relay(tunnels)
+    revalidator = None
+    if cfg["cache"]["revalidate"] and cfg["cache"]["stale_while_revalidate"]:
+        revalidator = Revalidator(cache, upstreams, cfg, compressor)
+    server = listen_socket(cfg, reuse_port=workers > 1)
     logging.info("Proxy listening on %s:%s  (filter=%s, cache=%s)",
                  cfg["listen_host"], cfg["listen_port"],
                  cfg["filter_mode"], cfg["cache"]["backend"])
@@ -236,11 +821,26 @@ def main():
         try:
             while True:
                 client_sock, addr = server.accept()
-                pool.submit(handle_client, client_sock, addr, cfg, cache)
+                metrics.WORKERS_QUEUED.inc()
+                pool.submit(_serve_queued, client_sock, addr, cfg, cache,
+                            keys, upstreams, flights, revalidator, compressor,
+                            tunnels)
         except KeyboardInterrupt:
             logging.info("Shutting down.")
         finally:
             server.close()
+            if admin is not None:
+                admin.stop()
+            if revalidator is not None:
+                revalidator.shutdown()
+            if compressor is not None:
+                compressor.shutdown()
+            tunnels.stop()
+            upstreams.close_all()
+            logging.info("Miss coalescing: %s", flights.stats())
+            keys.log_stats()
+            dns.log_stats()
+    logs.stop_writer()                # after the workers' last log rows
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""Unit tests for aio.py -- run with: pytest"""
+import asyncio
+import copy
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import aio  # noqa: E402
+import cache as cachelib  # noqa: E402
+import cachekey  # noqa: E402
+import config  # noqa: E402
+import logs  # noqa: E402
+
+
+class _Origin(BaseHTTPRequestHandler):
+    """A cacheable GET, counting how often it was asked for."""
+
+    protocol_version = "HTTP/1.1"
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        self.send_response(200)
+        self.send_header("Cache-Control", "max-age=60")
+        self.send_header("Content-Length", "5")
+        self.send_header("Keep-Alive", "timeout=5")
+        self.end_headers()
+        self.wfile.write(b"hello")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    _Origin.hits = 0
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Origin)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
+async def _read_body(data, framing, length, max_body=0, eof=True):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    if eof:
+        reader.feed_eof()
+    chunks = [c async for c in aio.request_body(reader, framing, length,
+                                                max_body, timeout=5)]
+    return b"".join(chunks), await reader.read()
+
+
+def test_request_body_framing_limits_and_short_bodies():
+    # One request per connection in this mode: bytes past the end are
+    # dropped rather than kept for a next request.
+    body, _ = asyncio.run(_read_body(
+        b"3\r\nabc\r\n0\r\n\r\nGET /next", "chunked", None))
+    assert body == b"3\r\nabc\r\n0\r\n\r\n"
+    body, rest = asyncio.run(_read_body(b"abcdefGET", "length", 6))
+    assert body == b"abcdef" and rest == b"GET"
+    with pytest.raises(ValueError):
+        asyncio.run(_read_body(b"abcdef", "length", 6, max_body=4))
+    with pytest.raises(ConnectionError):
+        asyncio.run(_read_body(b"abc", "length", 10))
+
+
+@pytest.fixture
+def proxy(tmp_path, monkeypatch):
+    """Run `client(port)` against a proxy on a fresh event loop:
+    proxy(client) -> (client's result, the proxy's cache).
+    """
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "logs.db"))
+    logs.init_db()
+    cfg = copy.deepcopy(config.DEFAULTS)
+    cfg["filter_mode"] = "off"
+    mem = cachelib.MemoryCache(10)
+    keys = cachekey.CacheKeys()
+
+    async def serve(client):
+        srv = await asyncio.start_server(
+            lambda r, w: aio.handle_client(r, w, cfg, mem, keys),
+            "127.0.0.1", 0)
+        try:
+            return await client(srv.sockets[0].getsockname()[1])
+        finally:
+            srv.close()
+            await srv.wait_closed()
+
+    return lambda client: (asyncio.run(serve(client)), mem)
+
+
+async def _ask(port, request, then=b""):
+    """Send `request` (and `then`, after a half-close if given), return
+    everything the proxy sends back.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    if then:
+        assert (await reader.readuntil(b"\r\n\r\n")).startswith(b"HTTP/1.1 200")
+        writer.write(then)
+        writer.write_eof()
+    reply = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return reply
+
+
+def test_miss_is_stored_and_the_next_request_is_a_hit(origin, proxy):
+    request = (b"GET http://127.0.0.1:%d/x HTTP/1.1\r\n"
+               b"Host: 127.0.0.1\r\n\r\n" % origin)
+
+    async def fetch_twice(port):
+        return [await _ask(port, request) for _ in range(2)]
+
+    (miss, hit), _ = proxy(fetch_twice)
+    assert miss.startswith(b"HTTP/1.1 200") and miss.endswith(b"\r\n\r\nhello")
+    assert hit.startswith(b"HTTP/1.1 200") and hit.endswith(b"\r\n\r\nhello")
+    for reply in (miss, hit):
+        assert b"Keep-Alive" not in reply and b"Connection: close\r\n" in reply
+    assert _Origin.hits == 1
+    rows = logs.query("SELECT cache_status FROM responses ORDER BY id")
+    assert [r[0] for r in rows] == ["MISS", "HIT"]
+
+
+def test_a_truncated_response_is_relayed_but_not_stored(proxy):
+    async def short_origin(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n"
+                     b"Content-Length: 100\r\n\r\nhello")
+        writer.close()
+
+    async def fetch_twice(port):
+        origin = await asyncio.start_server(short_origin, "127.0.0.1", 0)
+        request = (b"GET http://127.0.0.1:%d/x HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+                   % origin.sockets[0].getsockname()[1])
+        try:
+            return [await _ask(port, request) for _ in range(2)]
+        finally:
+            origin.close()
+
+    replies, mem = proxy(fetch_twice)
+    assert all(r.endswith(b"\r\n\r\nhello") for r in replies)
+    assert mem.stats()["entries"] == 0
+    rows = logs.query("SELECT cache_status FROM responses ORDER BY id")
+    assert [r[0] for r in rows] == ["MISS", "MISS"]
+
+
+def test_tunnel_half_close_lets_the_reply_through(proxy):
+    async def counting_origin(reader, writer):
+        data = await reader.read()              # until the client's EOF
+        writer.write(b"got %d" % len(data))
+        await writer.drain()
+        writer.close()
+
+    async def tunnel(port):
+        origin = await asyncio.start_server(counting_origin, "127.0.0.1", 0)
+        target = b"127.0.0.1:%d" % origin.sockets[0].getsockname()[1]
+        try:
+            return await _ask(port, b"CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n"
+                              % (target, target), then=b"x" * 10)
+        finally:
+            origin.close()
+
+    reply, _ = proxy(tunnel)
+    assert reply == b"got 10"
@@ -0,0 +1,403 @@
+"""Unit tests for cache.py -- run with: pytest"""
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import cache as cachelib  # noqa: E402
+import cachekey  # noqa: E402
+import compress  # noqa: E402
+
+
+def test_make_key_is_stable_and_method_sensitive():
+    a = cachelib.make_key("get", "example.com", 80, "/p")
+    assert a == cachelib.make_key("GET", "example.com", 80, "/p")
+    assert a != cachelib.make_key("HEAD", "example.com", 80, "/p")
+
+
+def test_normalize_path():
+    norm = cachekey.normalize_path
+    assert norm("/p?b=2&a=1&utm_source=x&a=0", drop_params=("utm_*",)) == \
+        "/p?a=1&a=0&b=2"
+    assert norm("/%7euser/a%2fb?q=%3a") == "/~user/a%2Fb?q=%3A"
+    assert norm("/p?utm_medium=x", drop_params=("utm_*",)) == "/p"
+    assert norm("/A/B", lowercase_path=True) == "/a/b"
+
+
+def test_vary_keys_split_variants():
+    keys = cachekey.CacheKeys()
+    a, rewritten = keys.primary("GET", "Example.com", 80, "/p?b=1&a=2")
+    b, _ = keys.primary("GET", "example.com", 80, "/p?a=2&b=1")
+    assert a == b and rewritten
+    gzip = [("Accept-Encoding", "gzip, br")]
+    assert keys.lookup(a, gzip) == a                # Vary not known yet
+    stored = keys.for_response(a, gzip, [("Vary", "Accept-Encoding")])
+    assert stored != a
+    assert keys.lookup(a, [("accept-encoding", "gzip,br")]) == stored
+    assert keys.lookup(a, []) not in (a, stored)
+    assert keys.for_response(a, gzip, [("Vary", "*")]) is None
+    keys.primary("POST", "example.com", 80, "/p?b=1&a=2")   # never a hit
+    assert keys.stats()["requests"] == 2 and keys.stats()["rewritten"] == 1
+
+
+def test_memory_cache_ttl_and_lru():
+    c = cachelib.MemoryCache(2)
+    c.put("a", b"1", 60)
+    c.put("b", b"2", 60)
+    assert c.get("a") == b"1"          # a is now most recent
+    c.put("c", b"3", 60)               # evicts b
+    assert c.get("b") is None
+    c.put("d", b"4", -1)               # already expired
+    assert c.get("d") is None
+
+
+def test_memory_cache_byte_budget():
+    c = cachelib.MemoryCache(100, max_bytes=10)
+    c.put("a", b"12345", 60)
+    c.put("b", b"12345", 60)
+    c.put("c", b"123", 60)             # 13 bytes > 10: evicts a
+    assert c.get("a") is None
+    assert c.get("b") == b"12345" and c.get("c") == b"123"
+    c.put("huge", b"x" * 11, 60)       # bigger than the whole budget
+    assert c.get("huge") is None
+    assert c.stats() == {"entries": 2, "bytes": 8}
+
+
+def test_memory_cache_shards_share_budgets():
+    c = cachelib.MemoryCache(64, max_bytes=64 * 4, shards=8)
+    for i in range(200):
+        c.put(f"k{i}", b"abcd", 60)
+    stats = c.stats()
+    assert stats["entries"] <= 64 and stats["bytes"] <= 64 * 4
+
+
+def test_file_writer_commit_and_discard(tmp_path):
+    c = cachelib.FileCache(str(tmp_path), 10, 1024)
+    w = c.writer(b"k", 60)
+    w.write(b"HTTP/1.1 200 OK\r\n\r\n")
+    w.write(b"body")
+    assert c.get(b"k") is None          # not visible until committed
+    w.commit()
+    assert c.get(b"k") == b"HTTP/1.1 200 OK\r\n\r\nbody"
+
+    w = c.writer(b"gone", 60)
+    w.write(b"partial")
+    w.discard()
+    assert c.get(b"gone") is None
+    assert sorted(os.listdir(tmp_path)) == [b"k".hex()]
+
+
+def test_file_cache_open_returns_body_range(tmp_path):
+    c = cachelib.FileCache(str(tmp_path), 10, 1024)
+    w = c.writer(b"k", 60)
+    w.write(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r")   # terminator split
+    w.write(b"\n\r\nbody")
+    w.commit()
+    for cache in (c, cachelib.FileCache(str(tmp_path), 10, 1024)):
+        hit = cache.open(b"k")
+        try:
+            assert hit.head == b"HTTP/1.1 200 OK\r\nContent-Length: 4"
+            assert hit.length == 4 and hit.tier == "disk"
+            hit.file.seek(hit.offset)
+            assert hit.file.read(hit.length) == b"body"
+        finally:
+            hit.close()
+
+
+def test_entries_carry_parsed_metadata(tmp_path):
+    value = (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nETag: \"v1\"\r\n"
+             b"Content-Length: 4\r\nConnection: close\r\n\r\nbody")
+    key = cachelib.make_key("GET", "example.com", 80, "/")
+    assert len(key) == 32
+    mem = cachelib.MemoryCache(10)
+    files = cachelib.FileCache(str(tmp_path), 10, 1024)
+    mem.put(key, value, 60)
+    files.put(key, value, 60)
+    reopened = cachelib.FileCache(str(tmp_path), 10, 1024)    # rebuilt index
+    for c in (mem, files, reopened):
+        hit = c.open(key)
+        assert (hit.status, hit.ctype, hit.framing, hit.etag) == (
+            200, "text/plain", "length", '"v1"')
+        hit.add_header("Vary", "Accept-Encoding")
+        assert hit.head.endswith(b"Vary: Accept-Encoding\r\nConnection: close")
+        hit.close()
+    assert os.listdir(tmp_path) == [key.hex()]
+
+
+def test_file_cache_lru_eviction_and_index_rebuild(tmp_path):
+    c = cachelib.FileCache(str(tmp_path), 2, 1024)
+    c.put(b"a", b"1", 60)
+    time.sleep(0.01)
+    c.put(b"b", b"2", 60)
+    assert c.get(b"a") == b"1"          # a is now most recent
+    c.put(b"c", b"3", 60)               # evicts b
+    assert c.get(b"b") is None
+    assert sorted(os.listdir(tmp_path)) == sorted([b"a".hex(), b"c".hex()])
+
+    reopened = cachelib.FileCache(str(tmp_path), 2, 1024)
+    assert reopened.get(b"a") == b"1" and reopened.get(b"c") == b"3"
+
+
+def test_file_cache_expired_entry_is_removed(tmp_path):
+    c = cachelib.FileCache(str(tmp_path), 10, 1024)
+    c.put(b"old", b"x", -1)
+    assert c.get(b"old") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_file_cache_failed_commit_leaves_no_temp_file(tmp_path, monkeypatch):
+    c = cachelib.FileCache(str(tmp_path), 10, 1024)
+
+    def fstat(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(cachelib.os, "fstat", fstat)
+    c.put(b"k", b"HTTP/1.1 200 OK\r\n\r\nbody", 60)
+    assert os.listdir(tmp_path) == [] and c.get(b"k") is None
+
+
+def test_stale_open_and_refresh(tmp_path):
+    for c in (cachelib.MemoryCache(10),
+              cachelib.FileCache(str(tmp_path), 10, 1024)):
+        c.put(b"k", b"HTTP/1.1 200 OK\r\n\r\nbody", 0)
+        assert c.open(b"k", stale=True).stale
+        c.refresh(b"k", 60)
+        hit = c.open(b"k")
+        assert not hit.stale and hit.length == len(b"body")
+        hit.close()
+    reopened = cachelib.FileCache(str(tmp_path), 10, 1024)
+    assert reopened.get_with_expiry(b"k")[1] > time.time() + 50
+
+
+def test_tiered_cache_promotes_and_counts_tiers(tmp_path):
+    l1 = cachelib.MemoryCache(10)
+    l2 = cachelib.FileCache(str(tmp_path), 10, 1024)
+    c = cachelib.TieredCache(l1, l2, l1_max_object_bytes=4)
+    c.put(b"small", b"abc", 60)
+    c.put(b"big", b"abcdefgh", 60)
+    assert c.lookup(b"small") == (b"abc", "memory")
+    assert c.lookup(b"big") == (b"abcdefgh", "disk")   # too big for L1
+    l1.clear()
+    assert c.lookup(b"small") == (b"abc", "disk")
+    assert c.lookup(b"small") == (b"abc", "memory")    # promoted
+    assert c.stats()["hits"] == {"memory": 2, "disk": 2}
+
+
+def test_tiered_cache_demotes_l1_evictions(tmp_path):
+    l1 = cachelib.MemoryCache(1)
+    l2 = cachelib.FileCache(str(tmp_path), 10, 1024)
+    c = cachelib.TieredCache(l1, l2, l1_max_object_bytes=64)
+    c.put(b"a", b"1", 60)
+    l2.clear()                         # L2 lost its copy...
+    c.put(b"b", b"2", 60)               # ...so evicting a from L1 writes it back
+    assert l2.get(b"a") == b"1"
+
+
+def test_compressor_replaces_the_entry_and_decodes_for_identity_clients():
+    mem = cachelib.MemoryCache(10)
+    body = b"hello world " * 200
+    head = (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+            b"ETag: \"v1\"\r\nContent-Length: %d" % len(body))
+    mem.put(b"k", head + b"\r\n\r\n" + body, 60)
+    comp = compress.Compressor(mem, workers=1)
+    plain = comp.select(mem.open(b"k"), b"k", [])          # not compressed yet
+    assert plain.body == body and plain.head.endswith(b"Vary: Accept-Encoding")
+    comp._run(b"k")
+    assert mem.stats()["entries"] == 1 and mem.stats()["bytes"] < len(body)
+    hit = comp.select(mem.open(b"k"), b"k", [("Accept-Encoding", "br, gzip")])
+    assert b"Content-Encoding: gzip" in hit.head and b'W/"v1"' in hit.head
+    assert b"X-Proxy-Gzip" not in hit.head
+    assert gzip.decompress(bytes(hit.body)) == body
+    plain = comp.select(mem.open(b"k"), b"k", [("Accept-Encoding", "gzip;q=0")])
+    assert plain.body == body and b"Content-Encoding" not in plain.head
+    assert b"Content-Length: %d\r\n" % len(body) in plain.head
+    assert plain.head.endswith(b"Connection: close")
+
+    mem.put(b"k", head + b"\r\n\r\n" + body, 5)         # a refill is identity
+    hit = comp.select(mem.open(b"k"), b"k", [("Accept-Encoding", "gzip")])
+    assert hit.body == body and b"Content-Encoding" not in hit.head
+    comp.shutdown()
+    off = compress.Compressor(mem, enabled=False)
+    off.submit(b"k")
+    assert off.stats()["compressed"] == 0
+
+
+def test_compressor_is_cheap_on_hits_and_uncounted_in_the_background(tmp_path):
+    tiered = cachelib.TieredCache(cachelib.MemoryCache(10),
+                                  cachelib.FileCache(str(tmp_path), 10, 1 << 20),
+                                  1 << 20)
+    body = b"hello world " * 200
+    head = (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+            b"Content-Length: %d" % len(body))
+    tiered.put(b"k", head + b"\r\n\r\n" + body, 60)
+    tiered.put(b"big", head.replace(b"%d" % len(body), b"%d" % (len(body) * 2))
+               + b"\r\n\r\n" + body * 2, 60)
+    comp = compress.Compressor(tiered, workers=1, max_bytes=len(body))
+    calls = []
+    comp.wants = lambda *a: calls.append(a) or compress.Compressor.wants(comp, *a)
+    for _ in range(3):
+        comp.select(tiered.open(b"k"), b"k", [])
+    assert len(calls) == 1                          # decided once per head
+
+    before = tiered.stats()
+    comp._run(b"k")
+    comp._run(b"big")                               # past max_bytes: kept as is
+    after = tiered.stats()
+    assert (after["hits"], after["misses"]) == (before["hits"], before["misses"])
+    assert comp.stats()["compressed"] == 1
+    assert tiered.get(b"big").endswith(body * 2)
+    comp.shutdown()
+
+
+def test_shared_file_caches_see_each_others_fills(tmp_path):
+    a = cachelib.FileCache(str(tmp_path), 10, 1024, shared=True)
+    b = cachelib.FileCache(str(tmp_path), 10, 1024, shared=True)
+    a.put(b"k", b"HTTP/1.1 200 OK\r\n\r\none", 60)
+    assert b.get(b"k") == b"HTTP/1.1 200 OK\r\n\r\none"    # not in b's index
+    a.put(b"k", b"HTTP/1.1 200 OK\r\nX: 1\r\n\r\ntwo!", 60)
+    hit = b.open(b"k")                                    # b's entry is stale
+    assert hit.head.endswith(b"X: 1") and hit.length == 4
+    hit.close()
+    a.put(b"old", b"HTTP/1.1 200 OK\r\n\r\nx", 0)
+    hit = b.open(b"old", stale=True)
+    assert hit.stale
+    hit.close()
+    a.refresh(b"old", 60)
+    assert b.get(b"old") is not None                      # refreshed by a
+
+
+def test_shared_file_caches_bound_the_directory_not_each_other(tmp_path):
+    value = b"HTTP/1.1 200 OK\r\n\r\nx"
+    a = cachelib.FileCache(str(tmp_path), 4, 1024, shared=True)
+    for i in range(4):
+        a.put(b"a%d" % i, value, 60)
+        os.utime(a._path(b"a%d" % i), (1000 + i, 1000 + i))
+    b = cachelib.FileCache(str(tmp_path), 4, 1024, shared=True)  # a restart
+    assert a.get(b"a0") is not None             # a hit makes a0 recent again
+    b.put(b"b0", value, 60)                     # b's index drops a0, not its file
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        k.hex() for k in (b"a0", b"a2", b"a3", b"b0"))
+    assert b"a0" not in b and b.get(b"a0") is not None
+
+
+def test_shared_cache_across_instances_and_ring_wrap(tmp_path):
+    path = str(tmp_path / "shm")
+    a = cachelib.SharedCache(path, 64, 4096, 1024)
+    b = cachelib.SharedCache(path, 64, 4096, 1024)     # another process's view
+    key = cachelib.make_key("GET", "h", 80, "/")
+    a.put(key, b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody", 60)
+    hit = b.open(key)
+    assert hit.status == 200 and hit.framing == "length"
+    assert bytes(hit.body) == b"body" and hit.tier == "shared"
+    a.put(key, b"x", 0)
+    assert b.get(key) is None and b.open(key, stale=True).stale
+    b.refresh(key, 60)
+    assert a.get(key) == b"x"
+    # 4 KB ring: writing 8 KB of other values overwrites the first ones.
+    keys = [cachelib.make_key("GET", "h", 80, f"/{i}") for i in range(16)]
+    for k in keys:
+        a.put(k, b"v" * 500, 60)
+    assert b.get(keys[0]) is None and b.get(keys[-1]) == b"v" * 500
+    assert 0 < b.stats()["entries"] < 16
+    a.clear()
+    assert b.get(keys[-1]) is None and b.stats()["entries"] == 0
+    a.close()
+    b.close()
+
+
+def test_shared_cache_refuses_foreign_or_relaid_files(tmp_path):
+    import pytest
+    path = tmp_path / "shm"
+    cachelib.SharedCache(str(path), 64, 4096, 1024).close()
+    size = path.stat().st_size
+    with pytest.raises(OSError):                    # other geometry: not wiped
+        cachelib.SharedCache(str(path), 64, 8192, 1024)
+    assert path.stat().st_size == size
+    os.chmod(path, 0o644)
+    with pytest.raises(OSError):
+        cachelib.SharedCache(str(path), 64, 4096, 1024)
+    os.symlink(path, tmp_path / "link")
+    with pytest.raises(OSError):
+        cachelib.SharedCache(str(tmp_path / "link"), 64, 4096, 1024)
+
+
+def test_segment_cache_replay_compaction_and_torn_tail(tmp_path):
+    def seg_cache():
+        return cachelib.SegmentCache(str(tmp_path), 8, 1024,
+                                     segment_bytes=1024, compact_interval=0)
+
+    keys = [cachelib.make_key("GET", "h", 80, f"/{i}") for i in range(12)]
+    c = seg_cache()
+    for k in keys:                                   # evicts the first four
+        c.put(k, b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nold", 60)
+    for k in keys[4:8]:                              # replaced: old copies dead
+        c.put(k, b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nnew", 60)
+    c.refresh(keys[-1], 600)
+    hit = c.open(keys[4])
+    assert hit.status == 200 and hit.tier == "disk" and bytes(hit.body) == b"new"
+    before = c.stats()
+    assert before["entries"] == 8 and before["segments"] > 1
+
+    assert c.compact() > 0
+    after = c.stats()
+    assert after["segment_bytes"] < before["segment_bytes"]
+    assert bytes(hit.body) == b"new"                 # still mapped after compaction
+    assert len(os.listdir(tmp_path)) == after["segments"]
+
+    # A crash mid-append leaves a torn record behind; replay stops before it.
+    c.put(keys[0], b"HTTP/1.1 200 OK\r\n\r\nlost", 60)
+    item = c._index[keys[0]]
+    end = item.offset + c.RECORD.size + item.length
+    item.seg.mm[end - 2:end] = b"??"
+    reopened = seg_cache()
+    assert reopened.get(keys[0]) is None and reopened.get(keys[3]) is None
+    assert [reopened.get(k)[-3:] for k in keys[4:]] == [b"new"] * 4 + [b"old"] * 4
+    assert reopened.get_with_expiry(keys[-1])[1] > time.time() + 500
+    assert reopened._active is None                 # the torn segment was sealed
+    reopened.clear()
+    assert os.listdir(tmp_path) == [] and seg_cache().get(keys[4]) is None
+
+
+def test_segment_cache_restart_appends_and_expired_entries_stay_gone(tmp_path):
+    def seg_cache():
+        return cachelib.SegmentCache(str(tmp_path), 8, 1024,
+                                     segment_bytes=4096, compact_interval=0)
+
+    c = seg_cache()
+    c.put(b"k" * 32, b"HTTP/1.1 200 OK\r\n\r\nfresh", 60)
+    c.put(b"e" * 32, b"HTTP/1.1 200 OK\r\n\r\nexpired", -1)
+    c.put(b"x" * 32, b"HTTP/1.1 200 OK\r\n\r\nlong gone", -2 * c.KEEP_EXPIRED)
+    assert c.get(b"e" * 32) is None                 # dropped on lookup
+    c.compact()                                     # drops the long-expired one
+    c.close()
+    reopened = seg_cache()
+    assert reopened.open(b"e" * 32, stale=True) is None
+    assert reopened.open(b"x" * 32, stale=True) is None
+    reopened.put(b"n" * 32, b"HTTP/1.1 200 OK\r\n\r\nnext run", 60)
+    assert len(os.listdir(tmp_path)) == 1           # same segment, appended to
+    assert seg_cache().get(b"k" * 32).endswith(b"fresh")
+
+
+def test_segment_cache_fills_stream_through_a_bounded_spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(cachelib, "SPOOL_BYTES", 64)
+    c = cachelib.SegmentCache(str(tmp_path), 8, 4096,
+                              segment_bytes=8192, compact_interval=0)
+    value = b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n" + b"x" * 1000
+    w = c.writer(b"k" * 32, 60)
+    for i in range(0, len(value), 100):
+        w.write(value[i:i + 100])
+    assert w.spool._rolled                          # on disk, not in RAM
+    w.commit()
+    hit = c.open(b"k" * 32)
+    assert hit.status == 200 and bytes(hit.head) == value[:value.index(b"\r\n\r\n")]
+    assert c.get(b"k" * 32) == value
+    assert cachelib.SegmentCache(str(tmp_path), 8, 4096, segment_bytes=8192,
+                                 compact_interval=0).get(b"k" * 32) == value
+
+    big = c.writer(b"b" * 32, 60)                   # past max_object_bytes
+    big.write(b"HTTP/1.1 200 OK\r\n\r\n" + b"y" * 5000)
+    big.commit()
+    assert c.get(b"b" * 32) is None
+    assert os.listdir(tmp_path) == ["seg-00000001.log"]  # no spool left behind
@@ -0,0 +1,69 @@
+"""Unit tests for coalesce.py -- run with: pytest"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import coalesce  # noqa: E402
+
+
+def test_followers_relay_the_leaders_response():
+    flights = coalesce.Coalescer(buffer_limit=1024)
+    leader, is_leader = flights.join(b"k")
+    follower, is_leader_too = flights.join(b"k")
+    assert is_leader and not is_leader_too
+    got = []
+
+    def follow():
+        assert follower.wait_head(5) == (b"HTTP/1.1 200 OK", "chunked")
+        got.extend(follower.iter_body(5))
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    leader.publish(b"HTTP/1.1 200 OK", "chunked", True)
+    for chunk in (b"a", b"b", b"c"):
+        leader.append(chunk)
+    flights.leave(b"k", leader, True)
+    thread.join(5)
+    assert got == [b"a", b"b", b"c"] and leader.followers == 0
+    assert flights.join(b"k")[1]                   # the flight has gone
+
+
+def test_unshared_and_failed_flights():
+    flights = coalesce.Coalescer(buffer_limit=1024)
+    leader, _ = flights.join(b"k")
+    follower, _ = flights.join(b"k")
+    leader.publish(b"HTTP/1.1 200 OK", "length", False)    # private
+    assert follower.wait_head(5) == (None, None)
+    assert flights.join(b"k") == (None, False)             # sealed
+
+    leader, _ = flights.join(b"j")
+    follower, _ = flights.join(b"j")
+    leader.publish(b"HTTP/1.1 200 OK", "close", True)
+    leader.append(b"part")
+    flights.leave(b"j", leader, False)
+    follower.wait_head(5)
+    with pytest.raises(coalesce.FlightFailed):
+        list(follower.iter_body(5))
+
+
+def test_buffer_stays_bounded_and_slow_followers_are_detached():
+    flights = coalesce.Coalescer(buffer_limit=10)
+    leader, _ = flights.join(b"k")
+    fast, _ = flights.join(b"k")
+    slow, _ = flights.join(b"k")
+    leader.publish(b"HTTP/1.1 200 OK", "chunked", True)
+    body = fast.iter_body(5)
+    for i in range(10):
+        leader.append(b"%05d" % i)
+        assert next(body) == b"%05d" % i
+        assert leader._size <= 10
+    assert flights.join(b"k") == (None, False)     # past the limit: sealed
+    assert slow.detached and leader.followers == 1
+    with pytest.raises(coalesce.FlightFailed):
+        list(slow.iter_body(5))
+    flights.leave(b"k", leader, True)
+    assert list(body) == []
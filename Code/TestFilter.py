@@ -0,0 +1,64 @@
+"""Unit tests for filtering.py -- run with: pytest"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import filtering  # noqa: E402
+import logs  # noqa: E402
+
+
+def test_suffix_trie_patterns():
+    trie = filtering.SuffixTrie(["Example.com", "*.ads.net", ".tracker.org."])
+    assert trie.matches("example.com") and trie.matches("EXAMPLE.com.")
+    assert not trie.matches("www.example.com")
+    assert trie.matches("x.ads.net") and trie.matches("a.b.ads.net")
+    assert not trie.matches("ads.net")
+    assert trie.matches("tracker.org") and trie.matches("cdn.tracker.org")
+    assert not trie.matches("org") and not trie.matches("nottracker.org")
+
+
+def test_filter_lists_reload_on_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "filters.db"))
+    logs.init_db()
+    assert filtering.is_allowed("www.blocked.com", "blacklist")
+    filtering.add_to_filter_list("*.blocked.com", "blacklist")
+    assert not filtering.is_allowed("www.blocked.com", "blacklist")
+    assert filtering.is_allowed("blocked.com", "blacklist")
+    filtering.remove_from_filter_list("*.blocked.com", "blacklist")
+    assert filtering.is_allowed("www.blocked.com", "blacklist")
+
+
+def test_first_load_is_waited_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "filters.db"))
+    logs.init_db()
+    filtering.add_to_filter_list("blocked.com", "blacklist")
+    query = logs.query
+
+    def slow_query(*args):
+        time.sleep(0.05)
+        return query(*args)
+
+    monkeypatch.setattr(logs, "query", slow_query)
+    lists = filtering.FilterLists()
+    seen = []
+    threads = [threading.Thread(
+        target=lambda: seen.append(lists.get("blacklist").matches("blocked.com")))
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [True] * 8
+
+
+def test_remove_matches_rows_stored_before_normalisation(tmp_path, monkeypatch):
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "filters.db"))
+    logs.init_db()
+    logs.execute_with_retry(
+        "INSERT INTO filters (address, type) VALUES (?, ?)",
+        ("Blocked.COM.", "blacklist"))
+    filtering.remove_from_filter_list("blocked.com", "blacklist")
+    assert logs.query("SELECT address FROM filters") == []
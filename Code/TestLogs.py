@@ -0,0 +1,66 @@
+"""Unit tests for logs.py -- run with: pytest"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import logs  # noqa: E402
+
+
+ROW = ("2024-01-01", "127.0.0.1", 1, "h", 80, "GET", "/", "HTTP/1.1", None)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "logs.db"))
+    logs.init_db()
+    return logs.DB_NAME
+
+
+def test_worker_writers_split_request_ids(db):
+    logs.execute_with_retry(logs.INSERT_REQUEST, (5,) + ROW)
+    writers = [logs.LogWriter(db, flush_interval=0.01,
+                              offset=n, stride=2) for n in range(2)]
+    for writer in writers:
+        writer.start()
+    ids = [[writer.next_id() for _ in range(3)] for writer in writers]
+    assert ids == [[6, 8, 10], [7, 9, 11]]
+    for writer, taken in zip(writers, ids):
+        for request_id in taken:
+            writer.submit(logs.INSERT_REQUEST, (request_id,) + ROW)
+        writer.stop()
+    assert [r[0] for r in logs.query("SELECT id FROM requests ORDER BY id")] == [
+        5, 6, 7, 8, 9, 10, 11]
+
+
+def test_dropped_rows_are_counted_across_threads(tmp_path):
+    writer = logs.LogWriter(str(tmp_path / "logs.db"), queue_size=1)  # not started
+    threads = [threading.Thread(
+        target=lambda: [writer.submit("SELECT 1", ()) for _ in range(500)])
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.dropped == 8 * 500 - 1
+
+
+def test_rejected_batches_are_dropped_and_stop_is_prompt(db):
+    writer = logs.LogWriter(db, flush_interval=60)   # rows wait for stop()
+    writer.start()
+    writer.submit(logs.INSERT_REQUEST, (1,) + ROW)
+    writer.submit(logs.INSERT_REQUEST, (1,) + ROW)   # duplicate id: rejected
+    writer._queue.put(logs._WAKE)                    # flush that batch now
+    deadline = time.monotonic() + 5
+    while writer.dropped < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.dropped == 2 and writer._thread.is_alive()
+    writer.submit(logs.INSERT_REQUEST, (2,) + ROW)
+    start = time.monotonic()
+    writer.stop()
+    assert time.monotonic() - start < 1
+    assert [r[0] for r in logs.query("SELECT id FROM requests")] == [2]
@@ -0,0 +1,98 @@
+"""Unit tests for metrics.py -- run with: pytest"""
+import os
+import socket
+import sys
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import coalesce  # noqa: E402
+import metrics  # noqa: E402
+import resolver  # noqa: E402
+
+
+def test_counter_sums_thread_shards_including_exited_threads():
+    reg = metrics.Registry()
+    c = reg.counter("t_requests_total", "Requests.", ("method",))
+
+    def work():
+        for _ in range(1000):
+            c.inc("GET")
+        c.inc("POST", amount=5)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    c.inc("GET")                     # a live shard next to the retired ones
+    assert c.values() == {("GET",): 4001, ("POST",): 20}
+    assert 't_requests_total{method="GET"} 4001' in reg.render()
+
+
+def test_histogram_buckets_are_cumulative():
+    reg = metrics.Registry()
+    h = reg.histogram("t_seconds", "Latency.", buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 3.0):
+        h.observe(v)
+    text = reg.render()
+    assert 't_seconds_bucket{le="0.1"} 2' in text
+    assert 't_seconds_bucket{le="1"} 3' in text
+    assert 't_seconds_bucket{le="+Inf"} 4' in text
+    assert "t_seconds_sum 3.65" in text
+    assert "t_seconds_count 4" in text
+
+
+def test_admin_endpoint_serves_prometheus_text():
+    reg = metrics.Registry()
+    reg.gauge("t_queue", "Queue depth.").inc(amount=3)
+    reg.callback("t_entries", "Entries.", "gauge",
+                 lambda: {("memory",): 7}, ("tier",))
+    admin = metrics.AdminServer("127.0.0.1", 0, reg)
+    admin.start()
+    try:
+        url = "http://127.0.0.1:%d/metrics" % admin.server_address[1]
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            text = resp.read().decode()
+    finally:
+        admin.stop()
+    assert "# TYPE t_queue gauge\nt_queue 3\n" in text
+    assert 't_entries{tier="memory"} 7' in text
+
+
+def test_coalescing_is_exported_live():
+    reg = metrics.Registry()
+    flights = coalesce.Coalescer(1024)
+    metrics.watch_coalescer(flights, reg)
+    flight, leader = flights.join(b"k")
+    follower, _ = flights.join(b"k")
+    flights.record(True)
+    text = reg.render()
+    assert "proxy_coalesce_leaders_total 1\n" in text
+    assert "proxy_coalesce_saved_fetches_total 1\n" in text
+    assert "proxy_coalesce_in_flight 1\n" in text
+    flights.leave(b"k", flight, False)
+    flights.record(False)
+    text = reg.render()
+    assert "proxy_coalesce_fallbacks_total 1\n" in text
+    assert "proxy_coalesce_in_flight 0\n" in text
+
+
+def test_resolver_is_exported_live():
+    reg = metrics.Registry()
+    dns = resolver.Resolver(60, 5, 16, 0.25)
+    metrics.watch_resolver(dns, reg)
+    server = socket.create_server(("127.0.0.1", 0))
+    try:
+        for _ in range(2):
+            dns.connect("127.0.0.1", server.getsockname()[1], 5).close()
+    finally:
+        server.close()
+    text = reg.render()
+    assert 'proxy_dns_lookups_total{result="hit"} 1\n' in text
+    assert 'proxy_dns_lookups_total{result="miss"} 1\n' in text
+    assert "proxy_dns_cache_entries 1\n" in text
+    assert "proxy_upstream_connects_total 2\n" in text
+    assert "proxy_upstream_connect_fallbacks_total 0\n" in text
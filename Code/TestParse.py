@@ -53,6 +53,163 @@ def test_build_forward_strips_hop_by_hop_and_forces_close():
     assert "Accept: */*" in text
 
 
+def test_build_forward_keep_alive():
+    out = parse.build_forward_request(
+        "GET", "/p", "HTTP/1.1", [("Connection", "close")], b"",
+        "example.com", 80, keep_alive=True)
+    text = out.decode("iso-8859-1")
+    assert "Connection: keep-alive" in text
+    assert "Connection: close" not in text
+
+
+def test_build_forward_chunked_drops_content_length():
+    headers = [("Transfer-Encoding", "chunked"), ("Content-Length", "5")]
+    text = parse.build_forward_request(
+        "POST", "/p", "HTTP/1.1", headers, b"", "example.com", 80,
+        chunked=True).decode("iso-8859-1")
+    assert "Content-Length" not in text
+    assert text.count("Transfer-Encoding: chunked") == 1
+
+
+def test_rebuild_response_head_replaces_connection_headers():
+    head = (b"HTTP/1.1 200 OK\r\nConnection: keep-alive, X-Hop\r\n"
+            b"Keep-Alive: timeout=5\r\nX-Hop: 1\r\n"
+            b"Transfer-Encoding: chunked\r\nContent-Type: text/html")
+    out = parse.rebuild_response_head(head).decode("iso-8859-1")
+    assert out.startswith("HTTP/1.1 200 OK\r\n")
+    assert out.endswith("Connection: close\r\n\r\n")
+    assert "Keep-Alive" not in out and "X-Hop" not in out
+    assert "Transfer-Encoding: chunked" in out
+    assert "Content-Type: text/html" in out
+
+
+def test_wants_keep_alive():
+    assert parse.wants_keep_alive("HTTP/1.1", [])
+    assert not parse.wants_keep_alive("HTTP/1.1", [("Connection", "close")])
+    assert not parse.wants_keep_alive("HTTP/1.0", [])
+    assert parse.wants_keep_alive("HTTP/1.0", [("Proxy-Connection", "Keep-Alive")])
+
+
+def test_body_framing():
+    assert parse.body_framing("HEAD", 200, [("Content-Length", "9")]) == ("none", 0)
+    assert parse.body_framing("GET", 304, []) == ("none", 0)
+    assert parse.body_framing("GET", 200, [("Content-Length", "9")]) == ("length", 9)
+    assert parse.body_framing(
+        "GET", 200, [("Transfer-Encoding", "chunked")]) == ("chunked", None)
+    assert parse.body_framing("GET", 200, []) == ("close", None)
+
+
+def test_parse_cache_control():
+    cc = parse.parse_cache_control('max-age=60, Stale-While-Revalidate=30, '
+                                   'no-cache="Set-Cookie", public')
+    assert cc == {"max-age": "60", "stale-while-revalidate": "30",
+                  "no-cache": "Set-Cookie", "public": None}
+    assert parse.parse_cache_control(None) == {}
+
+
+def test_with_validators_replaces_client_conditionals():
+    req = (b"GET /x HTTP/1.1\r\nHost: h\r\nIf-None-Match: \"old\"\r\n"
+           b"Connection: close\r\n\r\n")
+    out = parse.with_validators(req, '"new"', None)
+    assert out.endswith(b"If-None-Match: \"new\"\r\n\r\n")
+    assert b"old" not in out and out.startswith(b"GET /x HTTP/1.1\r\n")
+
+
 def test_parse_response_status():
     assert parse.parse_response_status(b"HTTP/1.1 404 Not Found\r\n") == 404
-    assert parse.parse_response_status(b"garbage") is None
\ No newline at end of file
+    assert parse.parse_response_status(b"garbage") is None
+
+
+def test_parse_range():
+    assert parse.parse_range("bytes=0-99", 1000) == [(0, 100)]
+    assert parse.parse_range("bytes=900-", 1000) == [(900, 100)]
+    assert parse.parse_range("bytes=-100", 1000) == [(900, 100)]
+    assert parse.parse_range("bytes=990-2000", 1000) == [(990, 10)]
+    assert parse.parse_range("bytes=0-0, 5-9", 1000) == [(0, 1), (5, 5)]
+    assert parse.parse_range("bytes=1000-", 1000) == []
+    assert parse.parse_range("bytes=5-1", 1000) is None
+    assert parse.parse_range("items=0-1", 1000) is None
+    assert parse.parse_range("bytes=" + ",".join(["0-1"] * 17), 1000) is None
+    assert parse.parse_range("bytes=" + ",".join(["0-"] * 16), 1000) == [(0, 1000)]
+    assert parse.parse_range("bytes=5-9, 0-4, 20-29, -985", 1000) == [
+        (0, 10), (15, 985)]
+
+
+def test_accepts_encoding():
+    assert parse.accepts_encoding([("Accept-Encoding", "gzip, br")], "gzip")
+    assert parse.accepts_encoding([("Accept-Encoding", "*")], "gzip")
+    assert not parse.accepts_encoding([("Accept-Encoding", "gzip;q=0, *")], "gzip")
+    assert not parse.accepts_encoding([("Accept-Encoding", "br")], "gzip")
+    assert not parse.accepts_encoding([], "gzip")
+
+
+def test_headers_index():
+    headers = parse.parse_headers(b"HTTP/1.1 200 OK\r\nSet-Cookie: a=1\r\n"
+                                  b"content-type: text/html\r\nSET-COOKIE: b=2")
+    assert headers == [("Set-Cookie", "a=1"), ("content-type", "text/html"),
+                       ("SET-COOKIE", "b=2")]
+    assert parse.get_header(headers, "Content-Type") == "text/html"
+    assert parse.get_all_headers(headers, "set-cookie") == ["a=1", "b=2"]
+    assert parse.get_header(headers, "missing", "x") == "x"
+
+
+def test_head_parser_incremental():
+    message = (b"POST /p HTTP/1.1\r\nHost: h\r\nContent-Length: 4\r\n\r\n"
+               b"bodyGET /next")
+    parser = parse.HeadParser(1024)
+    for i in range(len(message)):       # one byte at a time
+        if parser.feed(message[i:i + 1]):
+            break
+    assert parser.head == b"POST /p HTTP/1.1\r\nHost: h\r\nContent-Length: 4"
+    assert parse.get_header(parser.headers, "content-length") == "4"
+    assert bytes(parser.rest) == b""
+    parser = parse.HeadParser(1024, message)
+    assert parser.complete and bytes(parser.rest) == b"bodyGET /next"
+
+
+def test_head_parser_limit():
+    import pytest
+    parser = parse.HeadParser(16)
+    with pytest.raises(ValueError):
+        parser.feed(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 32)
+
+
+def test_with_connection_swaps_stored_connection_line():
+    stored = parse.rebuild_response_head(
+        b"HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nX-A: 1")[:-4]
+    assert parse.with_connection(stored, "keep-alive") == (
+        b"HTTP/1.1 200 OK\r\nX-A: 1\r\nConnection: keep-alive\r\n\r\n")
+    assert parse.with_connection(b"HTTP/1.1 200 OK\r\nX-A: 1") == (
+        parse.rebuild_response_head(b"HTTP/1.1 200 OK\r\nX-A: 1"))
+    raw = (b"HTTP/1.1 200 OK\r\nKeep-Alive: timeout=5\r\nX-Hop: 1\r\n"
+           b"Connection: X-Hop, keep-alive")
+    assert parse.with_connection(raw) == b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n"
+    assert not parse.is_rebuilt_head(b"HTTP/1.1 200 OK\r\nKeep-Alive: 5\r\n"
+                                     b"Connection: keep-alive")
+
+
+def test_request_body_framing():
+    import pytest
+    assert parse.request_body_framing([]) == ("none", 0)
+    assert parse.request_body_framing([("Content-Length", "0")]) == ("none", 0)
+    assert parse.request_body_framing([("Content-Length", "7")]) == ("length", 7)
+    assert parse.request_body_framing(
+        [("Transfer-Encoding", "Chunked"), ("Content-Length", "7")]) == ("chunked", None)
+    for bad in ([("Content-Length", "-1")], [("Transfer-Encoding", "gzip")]):
+        with pytest.raises(ValueError):
+            parse.request_body_framing(bad)
+
+
+def test_chunked_scanner_finds_end_across_reads():
+    body = b"5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n"
+    scanner = parse.ChunkedScanner()
+    passed = b""
+    data = body + b"GET /next"
+    for i in range(0, len(data), 3):        # awkward split points
+        piece = data[i:i + 3]
+        used = scanner.feed(piece)
+        passed += piece[:used]
+        if scanner.done:
+            rest = piece[used:] + data[i + 3:]
+            break
+    assert passed == body and rest == b"GET /next" and scanner.size == 11
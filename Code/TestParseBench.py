@@ -0,0 +1,106 @@
+"""Benchmarks for parse.py -- run with: pytest TestParseBench.py
+
+Compares the incremental HeadParser and the indexed Headers lookups with
+the old approach (grow a bytes buffer and rescan it; lower-case every
+header name per lookup). Needs pytest-benchmark; skipped without it.
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import parse  # noqa: E402
+
+HEAD = (b"GET http://example.com/some/path?a=1&b=2 HTTP/1.1\r\n"
+        b"Host: example.com\r\n"
+        b"User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101\r\n"
+        b"Accept: text/html,application/xhtml+xml;q=0.9,*/*;q=0.8\r\n"
+        b"Accept-Language: en-US,en;q=0.5\r\n"
+        b"Accept-Encoding: gzip, deflate, br\r\n"
+        b"Cookie: session=0123456789abcdef; theme=dark\r\n"
+        b"Connection: keep-alive\r\n"
+        b"Upgrade-Insecure-Requests: 1\r\n\r\n")
+LONG_HEAD = (HEAD[:-2] + b"".join(b"X-Filler-%d: %s\r\n" % (i, b"v" * 60)
+                                  for i in range(100)) + b"\r\n")
+BODY = os.urandom(1 << 20)
+CHUNK = 1460                    # one TCP segment at a time
+LOOKUPS = ("host", "content-length", "transfer-encoding", "connection",
+           "accept-encoding", "range", "if-none-match", "cache-control")
+
+
+def _segments(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def _old_read(segments, needed):
+    buf = b""
+    it = iter(segments)
+    while b"\r\n\r\n" not in buf:
+        buf += next(it)
+    head, _, body = buf.partition(b"\r\n\r\n")
+    for chunk in it:
+        if len(body) >= needed:
+            break
+        body += chunk
+    return head, body[:needed]
+
+
+def _new_read(segments, needed):
+    parser = parse.HeadParser(1 << 16)
+    it = iter(segments)
+    while not parser.feed(next(it)):
+        pass
+    body = bytearray(needed)
+    view = memoryview(body)
+    got = len(parser.rest)
+    view[:got] = parser.rest
+    for chunk in it:
+        if got >= needed:
+            break
+        view[got:got + len(chunk)] = chunk
+        got += len(chunk)
+    return parser.head, body
+
+
+@pytest.mark.parametrize("reader", [_old_read, _new_read], ids=["old", "new"])
+def test_bench_read_head(benchmark, reader):
+    segments = [LONG_HEAD[i:i + 64] for i in range(0, len(LONG_HEAD), 64)]
+    head, _ = benchmark(reader, segments, 0)
+    assert head.startswith(b"GET ")
+
+
+@pytest.mark.parametrize("reader", [_old_read, _new_read], ids=["old", "new"])
+def test_bench_read_body(benchmark, reader):
+    segments = _segments(HEAD + BODY)
+    _, body = benchmark(reader, segments, len(BODY))
+    assert bytes(body) == BODY
+
+
+def _old_headers(head):
+    text = head.decode("iso-8859-1", errors="replace")
+    return [tuple(p.strip() for p in line.partition(":")[::2])
+            for line in text.split("\r\n")[1:] if ":" in line]
+
+
+def _old_lookups(headers):
+    for name in LOOKUPS:
+        for k, v in headers:
+            if k.lower() == name:
+                break
+
+
+@pytest.mark.parametrize("impl", ["old", "new"])
+def test_bench_header_lookups(benchmark, impl):
+    head = HEAD[:-4]
+    if impl == "old":
+        benchmark(lambda: _old_lookups(_old_headers(head)))
+    else:
+        def run():
+            headers = parse.parse_headers(head)
+            for name in LOOKUPS:
+                parse.get_header(headers, name)
+        benchmark(run)
@@ -0,0 +1,107 @@
+"""Unit tests for prefork.py -- run with: pytest"""
+import copy
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import config  # noqa: E402
+import prefork  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not prefork.available(),
+                                reason="needs fork and SO_REUSEPORT")
+
+
+def _fail(number):
+    raise RuntimeError(f"worker {number} broke")
+
+
+def test_restart_backs_off_while_a_worker_keeps_dying(monkeypatch):
+    sup = prefork.Supervisor(1, _fail)
+    sup.spawn(0)
+    pid, status = os.wait()
+    assert sup.children.pop(pid) == 0 and os.waitstatus_to_exitcode(status) == 1
+
+    clock = [1000.0]
+    slept, spawned = [], []
+    monkeypatch.setattr(prefork.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(prefork.time, "sleep", slept.append)
+    monkeypatch.setattr(sup, "spawn", spawned.append)
+    for _ in range(7):                          # dies young, over and over
+        sup.started[0] = clock[0]
+        sup._restart(0, pid, status)
+    assert slept == [1, 2, 4, 8, 16, 30, 30] and spawned == [0] * 7
+    sup.started[0] = clock[0] - prefork.HEALTHY_UPTIME
+    sup._restart(0, pid, status)                # lived long enough: reset
+    assert slept[-1] == prefork.RESTART_DELAY
+
+
+def test_stop_terminates_every_worker():
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    sup = prefork.Supervisor(2, lambda number: time.sleep(60))
+    try:
+        for number in range(2):
+            sup.spawn(number)
+        pids = list(sup.children)
+        start = time.monotonic()
+        sup.stop()
+        assert time.monotonic() - start < prefork.STOP_TIMEOUT
+        assert sup.children == {}
+        for pid in pids:
+            with pytest.raises(ChildProcessError):
+                os.waitpid(pid, os.WNOHANG)     # reaped
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+
+
+def test_ctrl_c_to_the_group_stops_workers_cleanly(tmp_path):
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    cfg = copy.deepcopy(config.DEFAULTS)
+    cfg.update(listen_port=port, workers=2, filter_mode="off",
+               db_name=str(tmp_path / "logs.db"))
+    cfg["metrics"]["enabled"] = False
+    cfg["log_writer"]["flush_interval"] = 60     # rows stay queued until stop
+    cfg["cache"]["dir"] = str(tmp_path / "cache")
+    (tmp_path / "cfg.json").write_text(json.dumps(cfg))
+    proc = subprocess.Popen(
+        [sys.executable, "-c", "import json, sys, server; "
+         "server.main(json.load(open(sys.argv[1])))", str(tmp_path / "cfg.json")],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        deadline = time.monotonic() + 10
+        sent = 0
+        while sent < 6 and time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", port), 1) as c:
+                    c.sendall(b"GET http://127.0.0.1:1/ HTTP/1.1\r\n"
+                              b"Host: 127.0.0.1:1\r\n\r\n")
+                    c.recv(1024)
+                sent += 1
+            except OSError:
+                time.sleep(0.1)                 # workers still starting
+        time.sleep(0.5)
+        os.killpg(proc.pid, signal.SIGINT)      # Ctrl+C in a terminal
+        _, err = proc.communicate(timeout=prefork.STOP_TIMEOUT)
+    finally:
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+    assert proc.returncode == 0 and sent == 6
+    assert b"failed" not in err and b"did not stop" not in err
+    assert err.count(b"Log writer: ") == 2
+    db = sqlite3.connect(str(tmp_path / "logs.db"))
+    assert db.execute("SELECT COUNT(*) FROM requests").fetchone()[0] == 6
+    db.close()
@@ -0,0 +1,88 @@
+"""Unit tests for relay.py -- run with: pytest"""
+import fcntl
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import relay  # noqa: E402
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+@pytest.mark.parametrize("splice", [False, True])
+def test_relay_half_close_and_backpressure(splice):
+    if splice and not relay.splice_available():
+        pytest.skip("os.splice not available")
+    r = relay.Relay(threads=1, buffer_size=4096, use_splice=splice)
+    r.start()
+    client, client_end = socket.socketpair()
+    origin, origin_end = socket.socketpair()
+    for s in (client, origin):
+        s.settimeout(5)
+    try:
+        r.add(client_end, origin_end, initial=b"hello ")
+        client.sendall(b"world")
+        client.shutdown(socket.SHUT_WR)
+        assert _recv_all(origin) == b"hello world"   # FIN passed on
+
+        # The client isn't reading: once the socket buffers and the relay's
+        # 4 KB are full, the origin can't write any more.
+        payload = os.urandom(8 << 20)
+        origin.setblocking(False)
+        pushed = 0
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and pushed < len(payload):
+            try:
+                pushed += origin.send(payload[pushed:pushed + 65536])
+            except BlockingIOError:
+                time.sleep(0.05)
+                try:
+                    pushed += origin.send(payload[pushed:pushed + 65536])
+                except BlockingIOError:
+                    break
+        assert pushed < len(payload)
+        origin.settimeout(5)
+        with ThreadPoolExecutor(1) as pool:
+            received = pool.submit(_recv_all, client)
+            origin.sendall(payload[pushed:])
+            origin.shutdown(socket.SHUT_WR)
+            assert received.result() == payload
+        deadline = time.monotonic() + 5
+        while r.stats()["active"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert r.stats()["active"] == 0
+        assert r.stats()["bytes"] == len(payload) + len(b"hello world")
+    finally:
+        r.stop()
+        for s in (client, origin):
+            s.close()
+
+
+def test_splice_buffer_never_exceeds_the_pipe():
+    if not relay.splice_available():
+        pytest.skip("os.splice not available")
+    a, b = socket.socketpair()
+    try:
+        for asked in (4096, 64 << 20):
+            d = relay._Direction(a, b, asked, splice=True)
+            size = fcntl.fcntl(d.pipe[1], fcntl.F_GETPIPE_SZ)
+            assert d.limit == min(asked, size)
+            d.close()
+        plain = relay._Direction(a, b, 64 << 20)
+        assert plain.limit == 64 << 20
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,102 @@
+"""Unit tests for resolver.py -- run with: pytest"""
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import resolver  # noqa: E402
+
+
+def _info(ip, port=80, family=socket.AF_INET):
+    return family, socket.SOCK_STREAM, 6, "", (ip, port)
+
+
+@pytest.fixture
+def dns(monkeypatch):
+    """A fake getaddrinfo and clock: (answers, calls, clock)."""
+    answers, calls, clock = {}, [], [100.0]
+
+    def getaddrinfo(host, port, type=0):
+        calls.append(host)
+        if host not in answers:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [_info(ip, port) for ip in answers[host]]
+
+    monkeypatch.setattr(resolver.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(resolver.time, "monotonic", lambda: clock[0])
+    return answers, calls, clock
+
+
+def test_answers_are_cached_for_their_ttl(dns):
+    answers, calls, clock = dns
+    answers.update({"a": ["10.0.0.1"], "b": ["10.0.0.2"], "c": ["10.0.0.3"]})
+    r = resolver.Resolver(positive_ttl=60, max_entries=2)
+    assert r.resolve("a", 80) == [_info("10.0.0.1", 80)]
+    assert r.resolve("a", 8080) == [_info("10.0.0.1", 8080)]   # port swapped in
+    assert calls == ["a"]
+    clock[0] += 61
+    r.resolve("a", 80)
+    assert calls == ["a", "a"]
+    r.resolve("b", 80)
+    r.resolve("c", 80)                          # evicts a, the least recent
+    r.resolve("a", 80)
+    assert calls[-1] == "a" and r.stats()["entries"] == 2
+    assert r.stats()["hits"] == 1 and r.stats()["misses"] == 5
+
+
+def test_failures_are_cached_for_the_negative_ttl(dns):
+    answers, calls, clock = dns
+    r = resolver.Resolver(negative_ttl=5)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            r.resolve("nowhere", 80)
+    assert calls == ["nowhere"] and r.stats()["negative_hits"] == 1
+    clock[0] += 6
+    answers["nowhere"] = ["10.0.0.9"]           # it exists now
+    assert r.resolve("nowhere", 80) == [_info("10.0.0.9", 80)]
+
+
+def test_ttl_zero_disables_the_cache(dns):
+    answers, calls, _ = dns
+    answers["a"] = ["10.0.0.1"]
+    r = resolver.Resolver(positive_ttl=0, negative_ttl=0)
+    r.resolve("a", 80)
+    r.resolve("a", 80)
+    assert calls == ["a", "a"] and r.stats()["entries"] == 0
+
+
+def test_interleave_alternates_families():
+    v4 = [_info("10.0.0.%d" % i) for i in (1, 2, 3)]
+    v6 = [_info("::%d" % i, family=socket.AF_INET6) for i in (1, 2)]
+    assert resolver._interleave(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_race_falls_back_past_a_refused_address(monkeypatch):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    infos = [_info("127.0.0.1", _closed_port()), _info("127.0.0.1", port)]
+    monkeypatch.setattr(resolver.Resolver, "resolve", lambda self, h, p: infos)
+    r = resolver.Resolver(happy_eyeballs_delay=5)   # a failure mustn't wait
+    sock = r.connect("h", port, timeout=2)
+    assert sock.getpeername() == ("127.0.0.1", port) and sock.gettimeout() == 2
+    assert r.stats()["connects"] == 1 and r.stats()["fallbacks"] == 1
+    assert r.stats()["connect_ms"] < 1000
+    sock.close()
+    listener.close()
+
+    infos[:] = [_info("127.0.0.1", _closed_port()) for _ in range(2)]
+    with pytest.raises(OSError):
+        r.connect("h", 80, timeout=2)
@@ -0,0 +1,169 @@
+"""Unit tests for server.py -- run with: pytest"""
+import copy
+import functools
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import cache as cachelib  # noqa: E402
+import cachekey  # noqa: E402
+import coalesce  # noqa: E402
+import config  # noqa: E402
+import logs  # noqa: E402
+import server  # noqa: E402
+import upstream  # noqa: E402
+
+
+class _Echo(BaseHTTPRequestHandler):
+    """Answers a POST with the body it received, and a GET with the
+    Accept-Language it was sent (Varying on it).
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.headers.get("Accept-Language", "").encode("ascii")
+        self.send_response(200)
+        self.send_header("Cache-Control", "max-age=60")
+        self.send_header("Vary", "Accept-Language")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Echo)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
+def _body(data, headers, max_body=0):
+    """A RequestBody fed from a socket pair: (body, the client's end)."""
+    ours, theirs = socket.socketpair()
+    ours.settimeout(5)
+    theirs.sendall(data)
+    return server.RequestBody(ours, headers, b"", max_body), theirs
+
+
+def test_request_body_stops_at_its_end_and_keeps_pipelined_bytes():
+    body, client = _body(b"3\r\nabc\r\n0\r\n\r\nGET /next",
+                         [("Transfer-Encoding", "chunked")])
+    assert b"".join(body) == b"3\r\nabc\r\n0\r\n\r\n"
+    assert body.complete and body.leftover == b"GET /next"
+    client.close()
+
+
+def test_request_body_limits():
+    with pytest.raises(ValueError):
+        server.RequestBody(None, [("Content-Length", "11")], max_body=10)
+    body, client = _body(b"5\r\nhello\r\n6\r\n world\r\n",
+                         [("Transfer-Encoding", "chunked")], max_body=10)
+    with pytest.raises(ValueError):
+        body.drain()
+    client.close()
+
+    body, client = _body(b"abc", [("Content-Length", "10")])
+    client.close()                          # gone after 3 of 10 bytes
+    with pytest.raises(ConnectionError):
+        body.drain()
+    assert not body.complete
+
+
+def test_response_capture_stores_a_client_ready_head():
+    mem = cachelib.MemoryCache(10)
+    cfg = copy.deepcopy(config.DEFAULTS)
+    capture = server.ResponseCapture(mem, b"k", True, cfg)
+    raw = (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n"
+           b"Keep-Alive: timeout=5\r\nConnection: keep-alive\r\n"
+           b"Content-Length: 2\r\n\r\nok")
+    for i in range(0, len(raw), 7):          # as raw upstream reads arrive
+        capture.feed(raw[i:i + 7])
+    capture.commit()
+    assert mem.get(b"k") == (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n"
+                             b"Content-Length: 2\r\nConnection: close\r\n\r\nok")
+
+
+def test_if_range_uses_strong_comparison():
+    def hit(etag):
+        return cachelib.Hit.from_bytes(
+            b"HTTP/1.1 200 OK\r\nETag: %s\r\nLast-Modified: Mon, 01 Jan 2024 "
+            b"00:00:00 GMT\r\nContent-Length: 10\r\n\r\n0123456789" % etag,
+            "memory")
+
+    def plan(stored, if_range):
+        return server.plan_ranges(hit(stored), "GET", [
+            ("Range", "bytes=0-3"), ("If-Range", if_range)])
+
+    assert plan(b'"v1"', '"v1"') == [(0, 4)]
+    assert plan(b'"v1"', 'W/"v1"') is None
+    assert plan(b'W/"v1"', 'W/"v1"') is None           # e.g. a gzipped entry
+    assert plan(b'"v1"', '"v2"') is None
+    assert plan(b'"v1"', "Mon, 01 Jan 2024 00:00:00 GMT") == [(0, 4)]
+
+
+def test_expect_continue_is_answered_and_body_forwarded(tmp_path, origin,
+                                                       monkeypatch):
+    monkeypatch.setattr(logs, "DB_NAME", str(tmp_path / "logs.db"))
+    logs.init_db()
+    cfg = copy.deepcopy(config.DEFAULTS)
+    cfg["filter_mode"] = "off"
+    upstreams = upstream.build_pool(cfg)
+    client, ours = socket.socketpair()
+    client.settimeout(5)
+    client.sendall(b"POST http://127.0.0.1:%d/echo HTTP/1.1\r\n"
+                   b"Host: 127.0.0.1\r\nContent-Length: 5\r\n"
+                   b"Expect: 100-continue\r\n\r\n" % origin)
+
+    def send_body():
+        assert client.recv(25) == b"HTTP/1.1 100 Continue\r\n\r\n"
+        client.sendall(b"hello")
+
+    sender = threading.Thread(target=send_body)
+    sender.start()
+    keep_open, leftover = server.handle_request(
+        ours, ("127.0.0.1", 1), cfg, cachelib.MemoryCache(10),
+        cachekey.CacheKeys(), upstreams, coalesce.Coalescer(1 << 20), b"")
+    sender.join()
+    reply = client.recv(65536)
+    assert reply.startswith(b"HTTP/1.1 200") and reply.endswith(b"\r\n\r\nhello")
+    assert leftover == b""
+    upstreams.close_all()
+    for s in (client, ours):
+        s.close()
+
+
+def test_background_refresh_stores_under_the_vary_key(origin):
+    cfg = copy.deepcopy(config.DEFAULTS)
+    mem = cachelib.MemoryCache(10)
+    keys = cachekey.CacheKeys()
+    upstreams = upstream.build_pool(cfg)
+    headers = [("Accept-Language", "de")]
+    primary, _ = keys.primary("GET", "127.0.0.1", origin, "/v")
+    request = (b"GET /v HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+               b"Accept-Language: de\r\n\r\n")
+    revalidator = server.Revalidator(mem, upstreams, cfg)
+    revalidator._run(primary, "127.0.0.1", origin, request, b"HTTP/1.1 200 OK",
+                     functools.partial(keys.for_response, primary, headers))
+    variant = keys.lookup(primary, headers)       # the Vary is known now
+    assert variant != primary and mem.get(primary) is None
+    assert mem.get(variant).endswith(b"\r\n\r\nde")
+    upstreams.close_all()
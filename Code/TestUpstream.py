@@ -0,0 +1,209 @@
+"""Unit tests for upstream.py -- run with: pytest"""
+import io
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import upstream  # noqa: E402
+
+
+class Origin:
+    """A scripted origin: each accepted connection is handed to `script`,
+    called with (connection, number of the connection).
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            conn.settimeout(5)
+            threading.Thread(target=self._serve, args=(conn, self.connections),
+                             daemon=True).start()
+
+    def _serve(self, conn, number):
+        with conn:
+            try:
+                self.script(conn, number)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+def _read_request(conn, body_length=0):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += conn.recv(65536)
+    head, _, body = data.partition(b"\r\n\r\n")
+    while len(body) < body_length:
+        body += conn.recv(65536)
+    return head, body
+
+
+def _pool(max_idle=4):
+    return upstream.UpstreamPool(max_idle, idle_timeout=30, timeout=5,
+                                 max_header=65536)
+
+
+def test_fetch_streams_body_and_a_short_body_closes_the_socket():
+    bodies = []
+
+    def script(conn, number):
+        while True:
+            _, body = _read_request(conn, 6)
+            bodies.append(body)
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+    origin = Origin(script)
+    pool = _pool()
+    with pool.fetch("127.0.0.1", origin.port, "POST", b"POST / HTTP/1.1\r\n"
+                    b"Content-Length: 6\r\n\r\n", [b"abc", b"def"]) as resp:
+        assert b"".join(resp.iter_body()) == b"ok"
+    assert bodies == [b"abcdef"] and pool.stats()["idle"] == 1
+
+    def cut_short():
+        yield b"abc"
+        raise ConnectionError("client went away")
+
+    with pytest.raises(ConnectionError):
+        pool.fetch("127.0.0.1", origin.port, "POST", b"POST / HTTP/1.1\r\n"
+                   b"Content-Length: 6\r\n\r\n", cut_short())
+    assert pool.stats()["idle"] == 0      # the half-sent request isn't reused
+    pool.close_all()
+    origin.close()
+
+
+def test_chunked_response_after_interim_is_relayed_and_pooled():
+    response = (b"HTTP/1.1 100 Continue\r\n\r\n"
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5;ext\r\nhello\r\n6\r\n world\r\n0\r\nX-T: 1\r\n\r\n")
+
+    def script(conn, number):
+        while True:
+            _read_request(conn)
+            conn.sendall(response)
+
+    origin = Origin(script)
+    pool = _pool()
+    for _ in range(2):
+        with pool.fetch("127.0.0.1", origin.port, "GET",
+                        b"GET / HTTP/1.1\r\n\r\n") as resp:
+            assert resp.status == 200 and resp.framing == "chunked"
+            assert b"".join(resp.iter_body()) == response[response.index(b"5;"):]
+            assert resp.complete
+    assert origin.connections == 1
+    assert pool.stats() == {"hits": 1, "misses": 1, "idle": 1}
+    pool.close_all()
+    origin.close()
+
+
+def test_truncated_responses_are_not_pooled():
+    def script(conn, number):
+        _read_request(conn)
+        if number == 1:
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort")
+        else:
+            conn.sendall(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                         b"a\r\nshort")
+
+    origin = Origin(script)
+    pool = _pool()
+    for _ in range(2):
+        with pool.fetch("127.0.0.1", origin.port, "GET",
+                        b"GET / HTTP/1.1\r\n\r\n") as resp:
+            assert b"short" in b"".join(resp.iter_body())
+            assert not resp.complete
+    assert pool.stats()["idle"] == 0
+    pool.close_all()
+    origin.close()
+
+
+def test_stale_pooled_socket_is_retried_once():
+    def script(conn, number):
+        _read_request(conn)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+        if number <= 2:         # then drops the connection unanswered
+            _read_request(conn)
+            return
+        while True:
+            _read_request(conn)
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+    origin = Origin(script)
+    pool = _pool()
+    request = b"GET / HTTP/1.1\r\n\r\n"
+    first = pool.fetch("127.0.0.1", origin.port, "GET", request)
+    second = pool.fetch("127.0.0.1", origin.port, "GET", request)
+    for resp in (first, second):
+        with resp:
+            list(resp.iter_body())
+    assert pool.stats()["idle"] == 2
+    # Both pooled sockets die once used: the request is retried on the
+    # second one, but not a second time.
+    with pytest.raises(ConnectionError):
+        pool.fetch("127.0.0.1", origin.port, "GET", request)
+    with pool.fetch("127.0.0.1", origin.port, "GET", request) as resp:
+        assert b"".join(resp.iter_body()) == b"ok"
+    assert origin.connections == 3
+    pool.close_all()
+    origin.close()
+
+
+def test_release_caps_idle_sockets_and_sweeps_expired_ones(monkeypatch):
+    pool = upstream.UpstreamPool(2, idle_timeout=30, timeout=5, max_header=65536)
+    now = [1000.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    pool._last_sweep = now[0]
+    pairs = [socket.socketpair() for _ in range(4)]
+    for ours, _ in pairs[:3]:
+        pool.release(("a", 80), ours)
+    assert pool.stats()["idle"] == 2 and pairs[2][0].fileno() == -1
+    now[0] += 31
+    pool.release(("b", 80), pairs[3][0])     # sweeps the expired "a" sockets
+    assert pool.stats()["idle"] == 1 and pairs[0][0].fileno() == -1
+    pool.close_all()
+    for _, theirs in pairs:
+        theirs.close()
+
+
+def test_read_head_consumes_only_the_head():
+    class Trickle(io.RawIOBase):
+        """Hands out a few bytes per read, like a slow origin."""
+
+        def __init__(self, data):
+            self.data = data
+
+        def readable(self):
+            return True
+
+        def readinto(self, b):
+            n = min(len(b), 5, len(self.data))
+            b[:n], self.data = self.data[:n], self.data[n:]
+            return n
+
+    reader = io.BufferedReader(Trickle(
+        b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody"))
+    assert upstream._read_head(reader, 1024) == (
+        b"HTTP/1.1 200 OK\r\nContent-Length: 4")
+    assert reader.read() == b"body"
+    assert upstream._read_head(io.BufferedReader(Trickle(b"")), 1024) == b""
+    with pytest.raises(ValueError):
+        upstream._read_head(io.BufferedReader(Trickle(
+            b"HTTP/1.1 200 OK\r\nX: " + b"x" * 2000 + b"\r\n\r\n")), 1024)
@@ -0,0 +1,292 @@
+"""Keep-alive connections to origin servers.
+
+Every cache miss used to open a fresh TCP connection, send
+`Connection: close` and read until EOF. The pool instead keeps idle
+connections per (host, port) and frames each response by Content-Length or
+chunked encoding, so the connection can be reused by the next request.
+Chunked bodies are relayed with their framing intact; only the chunk sizes
+are parsed, to find where the message ends.
+"""
+import collections
+import logging
+import select
+import socket
+import threading
+import time
+
+import metrics
+import parse
+
+BUFSIZE = 65536
+MAX_LINE = 8192            # longest chunk-size / trailer line we accept
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+
+
+def _close(sock):
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+
+def _still_open(sock):
+    """An idle keep-alive socket is only readable if the origin closed it
+    (EOF) or sent garbage; either way it must not be reused.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+def _read_head(reader, max_header):
+    """Read one response header block (without the blank line), or b"" on EOF.
+
+    Whatever `reader` has buffered goes to a parse.HeadParser in one piece,
+    not line by line, and only the head itself is consumed from it.
+    """
+    parser = parse.HeadParser(max_header)
+    while True:
+        data = reader.peek()
+        if not data:
+            return parser.head              # EOF: empty, or a truncated head
+        seen = len(parser.buf)
+        if parser.feed(data):
+            reader.read(parser.end + 4 - seen)
+            return parser.head
+        reader.read(len(data))
+
+
+class UpstreamResponse:
+    """One origin response, positioned at the start of its body.
+
+    Iterate `iter_body()` to relay the body, then call `close()`: the
+    connection goes back to the pool only if the whole message was read and
+    the origin allows reuse.
+    """
+
+    def __init__(self, pool, key, sock, reader, method, head):
+        self._pool = pool
+        self._key = key
+        self._sock = sock
+        self._reader = reader
+        self.head = head
+        self.status = parse.parse_response_status(head)
+        self.headers = parse.parse_headers(head)
+        self.framing, self.length = parse.body_framing(
+            method, self.status, self.headers)
+        self.complete = self.framing == "none"
+
+    @property
+    def keep_alive(self):
+        if self.framing == "close":
+            return False
+        conn = (parse.get_header(self.headers, "connection", "") or "").lower()
+        if "close" in conn:
+            return False
+        if self.head.startswith(b"HTTP/1.0"):
+            return "keep-alive" in conn
+        return True
+
+    def iter_body(self):
+        """Yield the raw body bytes as they arrive (chunk framing included)."""
+        if self.framing == "length":
+            yield from self._iter_length()
+        elif self.framing == "chunked":
+            yield from self._iter_chunked()
+        elif self.framing == "close":
+            while True:
+                data = self._reader.read1(BUFSIZE)
+                if not data:
+                    break
+                yield data
+            self.complete = True
+
+    def _iter_length(self):
+        remaining = self.length
+        while remaining:
+            data = self._reader.read1(min(BUFSIZE, remaining))
+            if not data:
+                return                      # truncated: complete stays False
+            remaining -= len(data)
+            yield data
+        self.complete = True
+
+    def _iter_chunked(self):
+        reader = self._reader
+        while True:
+            line = reader.readline(MAX_LINE)
+            if not line.endswith(b"\n"):
+                return                      # EOF or oversized size line
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                return
+            if size == 0:
+                trailer = line
+                while True:
+                    t = reader.readline(MAX_LINE)
+                    if not t.endswith(b"\n"):
+                        return
+                    trailer += t
+                    if t in (b"\r\n", b"\n"):
+                        break
+                yield trailer
+                self.complete = True
+                return
+            pending = line                  # send the size line with its data
+            remaining = size + 2            # chunk data + CRLF
+            while remaining:
+                data = reader.read1(min(BUFSIZE, remaining))
+                if not data:
+                    if pending:
+                        yield pending
+                    return
+                remaining -= len(data)
+                yield pending + data if pending else data
+                pending = b""
+
+    def close(self):
+        try:
+            self._reader.close()
+        except OSError:
+            pass
+        if self.complete and self.keep_alive:
+            self._pool.release(self._key, self._sock)
+        else:
+            _close(self._sock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UpstreamPool:
+    """Idle keep-alive sockets per (host, port), most recently used first."""
+
+    def __init__(self, max_idle_per_host, idle_timeout, timeout, max_header,
+                 resolver=None):
+        self.max_idle = max_idle_per_host
+        self.resolver = resolver    # cached DNS + parallel connect, if set
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_header = max_header
+        self.hits = 0       # requests sent on a reused connection
+        self.misses = 0     # requests that had to open a new connection
+        self._lock = threading.Lock()
+        self._idle = {}     # (host, port) -> deque of (sock, idle_since)
+        self._last_sweep = time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.max_idle > 0
+
+    def _checkout(self, host, port):
+        key = (host, port)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                item = idle.pop() if idle else None
+                if item is None:
+                    self.misses += 1
+                    break
+            sock, since = item
+            if time.monotonic() - since < self.idle_timeout and _still_open(sock):
+                with self._lock:
+                    self.hits += 1
+                return sock, True
+            _close(sock)
+        return self.connect(host, port), False
+
+    def connect(self, host, port):
+        """A new, unpooled connection to host:port (also used for tunnels)."""
+        start = time.perf_counter()
+        if self.resolver is not None:
+            sock = self.resolver.connect(host, port, self.timeout)
+        else:
+            sock = socket.create_connection((host, port), timeout=self.timeout)
+            sock.settimeout(self.timeout)
+        metrics.UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - start)
+        return sock
+
+    def release(self, key, sock):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > self.idle_timeout:
+                self._sweep(now)
+            idle = self._idle.setdefault(key, collections.deque())
+            if len(idle) < self.max_idle:
+                idle.append((sock, now))
+                return
+        _close(sock)
+
+    def _sweep(self, now):
+        """Drop expired idle sockets for every origin. Caller holds _lock."""
+        self._last_sweep = now
+        for key in list(self._idle):
+            idle = self._idle[key]
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                _close(idle.popleft()[0])
+            if not idle:
+                del self._idle[key]
+
+    def fetch(self, host, port, method, request, body=()):
+        """Send `request` upstream and return its UpstreamResponse. `body`
+        is an iterable of bytes sent after it as they are produced (a
+        streamed request body).
+
+        A reused connection may have been closed by the origin just before
+        we wrote to it; idempotent requests without a body are retried once
+        on a new one (a streamed body can't be sent twice).
+        """
+        retried = False
+        while True:
+            sock, reused = self._checkout(host, port)
+            reader = None
+            try:
+                sock.sendall(request)
+                for chunk in body:
+                    sock.sendall(chunk)
+                sent = time.perf_counter()
+                reader = sock.makefile("rb")
+                head = _read_head(reader, self.max_header)
+                # Skip interim 1xx responses (e.g. 100 Continue).
+                while head and 100 <= (parse.parse_response_status(head) or 0) < 200:
+                    head = _read_head(reader, self.max_header)
+                if not head:
+                    raise ConnectionError("Empty response from origin")
+                metrics.UPSTREAM_FIRST_BYTE_SECONDS.observe(
+                    time.perf_counter() - sent)
+            except (OSError, ValueError):
+                if reader is not None:
+                    reader.close()
+                _close(sock)
+                if (reused and not retried and not body
+                        and method.upper() in IDEMPOTENT):
+                    retried = True
+                    continue
+                raise
+            return UpstreamResponse(self, (host, port), sock, reader, method, head)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(q) for q in self._idle.values())
+        return {"hits": self.hits, "misses": self.misses, "idle": idle}
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for sock, _ in idle:
+                    _close(sock)
+            self._idle.clear()
+        logging.info("Upstream pool: %s", self.stats())
+
+
+def build_pool(cfg, resolver=None):
+    p = cfg["upstream_pool"]
+    max_idle = p["max_idle_per_host"] if p["enabled"] else 0
+    return UpstreamPool(max_idle, p["idle_timeout"], cfg["upstream_timeout"],
+                        cfg["max_header_bytes"], resolver)